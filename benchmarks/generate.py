@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+"""Generate synthetic Philadelphia incident data and HunchLab missions for benchmarks.
+
+Makes data shaped like the real sources: the police_inct.csv dump (and the zipfile it comes
+in), pages of ArcGIS query results, and missions GeoJSON from the HunchLab API.  A set share
+of incidents have missing or non-numeric co-ordinates, or unusable dates, as the real data
+does.  The same seed always gives the same data.
+"""
+
+from argparse import ArgumentParser
+import calendar
+import csv
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import random
+import zipfile
+
+# number of incidents for each named size
+SIZES = {'10k': 10000, '1m': 1000000, '5m': 5000000}
+
+POLICE_COLUMNS = ['DC_DIST', 'SECTOR', 'DISPATCH_DATE_TIME', 'DISPATCH_DATE', 'DISPATCH_TIME',
+                  'HOUR', 'DC_KEY', 'LOCATION_BLOCK', 'UCR_GENERAL', 'OBJECTID',
+                  'TEXT_GENERAL_CODE', 'POINT_X', 'POINT_Y']
+# columns of the CSV that upload.py sends, as described in eventdata/README.md
+EVENT_COLUMNS = ['datasource', 'id', 'class', 'datetimefrom', 'datetimeto', 'report_time',
+                 'pointx', 'pointy', 'address', 'last_updated']
+MANIFEST_FILENAME = 'manifest.json'
+# bumped whenever the data made for the same settings changes, so old data is not reused
+DATA_VERSION = 1
+UPDATE_DATE_TEXT = 'This dataset is up to date as of Monday 05/12/14 at 03:15 AM EDT\n'
+
+# kinds of unusable incidents, and what PhillyUploader counts them as
+BAD_KINDS = {'missing_coords': 'missing_coords_ct',
+             'non_numeric_coords': 'non_numeric_ct',
+             'unreadable_date': 'bad_dt_ct',
+             'invalid_date': 'bad_dt_ct'}
+
+# incident classes, with UCR code and rough share of incidents; the real data pads some
+# class names with spaces
+_CLASSES = [('Thefts ', 600, 20), ('Other Assaults ', 800, 15),
+            ('All Other Offenses', 2600, 12), ('Vandalism/Criminal Mischief', 1400, 10),
+            ('Theft from Vehicle', 600, 9), ('Narcotic / Drug Law Violations', 1800, 7),
+            ('Fraud', 1100, 5), ('Burglary Residential', 500, 5),
+            ('Motor Vehicle Theft', 700, 4), ('Aggravated Assault No Firearm', 400, 4),
+            ('Robbery No Firearm', 300, 3), ('DRIVING UNDER THE INFLUENCE', 2100, 3),
+            ('Robbery Firearm', 300, 2), ('Burglary Non-Residential', 500, 1)]
+_STREETS = ['MARKET ST', 'CHESTNUT ST', 'BROAD ST', 'FRANKFORD AVE', 'KENSINGTON AVE',
+            'GERMANTOWN AVE', 'RIDGE AVE', 'LANCASTER AVE', 'COTTMAN AVE', 'CASTOR AVE',
+            'N 5TH ST', 'S 52ND ST', 'WOODLAND AVE', 'GIRARD AVE', 'ERIE AVE']
+# rough bounding box of Philadelphia
+_MIN_X, _MAX_X = -75.28, -74.96
+_MIN_Y, _MAX_Y = 39.87, 40.14
+_START = datetime(2006, 1, 1)
+_SPAN_SECONDS = 9 * 365 * 24 * 3600
+
+_SHIFTS = ['Day', 'Evening', 'Night']
+_RESOURCES = ['Patrol Car', 'Foot Patrol', 'Bike Patrol', 'Detective']
+_MODELS = ['Burglary', 'Robbery', 'Aggravated Assault', 'Theft from Vehicle',
+           'Motor Vehicle Theft', 'Homicide']
+# size of a mission cell, in degrees
+_CELL = 0.0025
+
+
+def _class_picker(rnd):
+    """Return function picking an incident class and UCR code, weighted by share."""
+    total = sum(share for _, _, share in _CLASSES)
+
+    def pick():
+        n = rnd.uniform(0, total)
+        for name, ucr, share in _CLASSES:
+            n -= share
+            if n <= 0:
+                return name, ucr
+        return _CLASSES[-1][:2]
+    return pick
+
+
+def iter_incidents(num_rows, bad_rate=0.01, seed=0, first=0):
+    """Generate num_rows synthetic incidents, as dictionaries of Python values.
+
+    Each has the incident number n, a datetime dt, co-ordinates x and y, a class and UCR
+    code, an address and a police district, and bad: None, or one of BAD_KINDS.
+
+    Arguments:
+    num_rows -- number of incidents
+    bad_rate -- share of incidents that are unusable
+    seed     -- random seed
+    first    -- number of the first incident
+    """
+    rnd = random.Random(seed * 1000003 + first)
+    pick_class = _class_picker(rnd)
+    kinds = sorted(BAD_KINDS)
+    for n in xrange(first, first + num_rows):
+        dist = rnd.randint(1, 39)
+        dt = _START + timedelta(seconds=rnd.randint(0, _SPAN_SECONDS) // 60 * 60)
+        name, ucr = pick_class()
+        yield {'n': n,
+               'dt': dt,
+               'x': round(rnd.uniform(_MIN_X, _MAX_X), 9),
+               'y': round(rnd.uniform(_MIN_Y, _MAX_Y), 9),
+               'class': name,
+               'ucr': ucr,
+               'address': '%d BLOCK %s' % (rnd.randint(1, 99) * 100, rnd.choice(_STREETS)),
+               'dist': dist,
+               'bad': rnd.choice(kinds) if rnd.random() < bad_rate else None}
+
+
+def police_row(inc):
+    """Format an incident from iter_incidents as a row of police_inct.csv."""
+    dt = inc['dt']
+    x = repr(inc['x'])
+    y = repr(inc['y'])
+    dt_str = dt.strftime('%Y-%m-%d %H:%M:%S')
+    bad = inc['bad']
+    if bad == 'missing_coords':
+        x = ''
+    elif bad == 'non_numeric_coords':
+        y = 'NULL'
+    elif bad == 'unreadable_date':
+        dt_str = ''
+    elif bad == 'invalid_date':
+        dt_str = dt.strftime('%Y-02-30 %H:%M:%S')
+
+    return [inc['dist'], 'ABCDEFGHJK'[inc['n'] % 10], dt_str, dt.strftime('%Y-%m-%d'),
+            dt.strftime('%H:%M:%S'), dt.hour, '%d%02d%06d' % (dt.year, inc['dist'], inc['n']),
+            inc['address'], inc['ucr'], inc['n'] + 1, inc['class'], x, y]
+
+
+def arcgis_feature(inc):
+    """Format an incident from iter_incidents as an ArcGIS query result feature."""
+    dt = inc['dt']
+    # ArcGIS gives local date/times as if they were UTC, in milliseconds
+    stamp = calendar.timegm(dt.timetuple()) * 1000
+    x = inc['x']
+    y = inc['y']
+    bad = inc['bad']
+    if bad == 'missing_coords':
+        x = None
+    elif bad == 'non_numeric_coords':
+        # as from a layer with its co-ordinates stored as text
+        x = y = 'NULL'
+    elif bad == 'unreadable_date':
+        stamp = None
+    elif bad == 'invalid_date':
+        stamp = 'NULL'
+
+    return {'attributes': {'OBJECTID': inc['n'] + 1,
+                           'DISPATCH_DATE_TIME': stamp,
+                           'DC_KEY': '%d%02d%06d' % (dt.year, inc['dist'], inc['n']),
+                           'TEXT_GENERAL_CODE': inc['class'],
+                           'LOCATION_BLOCK': inc['address'],
+                           'POINT_X': x,
+                           'POINT_Y': y}}
+
+
+def write_police_csv(path, num_rows, bad_rate=0.01, seed=0):
+    """Write a synthetic police_inct.csv; return counts of its unusable rows, by counter."""
+    counts = dict((name, 0) for name in BAD_KINDS.values())
+    with open(path, 'wb') as outf:
+        wtr = csv.writer(outf)
+        wtr.writerow(POLICE_COLUMNS)
+        for inc in iter_incidents(num_rows, bad_rate, seed):
+            if inc['bad']:
+                counts[BAD_KINDS[inc['bad']]] += 1
+            wtr.writerow(police_row(inc))
+
+    counts['bad_row_ct'] = sum(counts.values())
+    return counts
+
+
+def write_police_zip(out_dir, num_rows, bad_rate=0.01, seed=0):
+    """Write police_inct.zip, holding police_inct.csv and UPDATE_DATE.txt, to out_dir.
+
+    The CSV is also left in out_dir.  Returns counts of its unusable rows, by counter.
+    """
+    csv_path = os.path.join(out_dir, 'police_inct.csv')
+    counts = write_police_csv(csv_path, num_rows, bad_rate, seed)
+    with zipfile.ZipFile(os.path.join(out_dir, 'police_inct.zip'), 'w',
+                         zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+        z.write(csv_path, 'police_inct.csv')
+        z.writestr('UPDATE_DATE.txt', UPDATE_DATE_TEXT)
+    return counts
+
+
+def arcgis_page(offset, page_size, num_rows, bad_rate=0.01, seed=0):
+    """Return one page of an ArcGIS query for num_rows incidents, as a dictionary.
+
+    Any page can be made on its own, so a server can hand out pages without holding all of
+    the incidents in memory.
+    """
+    count = max(0, min(page_size, num_rows - offset))
+    features = [arcgis_feature(inc) for inc in iter_incidents(count, bad_rate, seed, offset)]
+    return {'features': features, 'exceededTransferLimit': offset + count < num_rows}
+
+
+def write_arcgis_pages(out_dir, num_rows, page_size=1000, bad_rate=0.01, seed=0):
+    """Write ArcGIS query result pages to out_dir, one JSON file per page.
+
+    Page files are numbered from 0, by offset / page_size.  Returns counts of the unusable
+    incidents, by counter.
+    """
+    counts = dict((name, 0) for name in BAD_KINDS.values())
+    for offset in xrange(0, num_rows, page_size):
+        count = min(page_size, num_rows - offset)
+        features = []
+        for inc in iter_incidents(count, bad_rate, seed, offset):
+            if inc['bad']:
+                counts[BAD_KINDS[inc['bad']]] += 1
+            features.append(arcgis_feature(inc))
+
+        page = {'features': features, 'exceededTransferLimit': offset + count < num_rows}
+        with open(os.path.join(out_dir, arcgis_page_filename(offset // page_size)), 'wb') as outf:
+            json.dump(page, outf)
+
+    counts['bad_row_ct'] = sum(counts.values())
+    return counts
+
+
+def arcgis_page_filename(num):
+    """Return name of the file write_arcgis_pages writes page number num to."""
+    return 'arcgis_page_%05d.json' % num
+
+
+def mission_feature(num, rnd):
+    """Return a synthetic mission, as a GeoJSON feature like those from /api/missions/."""
+    x = rnd.uniform(_MIN_X, _MAX_X - _CELL)
+    y = rnd.uniform(_MIN_Y, _MAX_Y - _CELL)
+    day = datetime(2014, 1, 1) + timedelta(days=rnd.randint(0, 364))
+    shift = rnd.randint(0, 2)
+    start = day + timedelta(hours=8 * shift)
+    models = rnd.sample(_MODELS, rnd.randint(1, 4))
+    resources = rnd.sample(_RESOURCES, rnd.randint(1, 3))
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Polygon',
+                     'coordinates': [[[x, y], [x + _CELL, y], [x + _CELL, y + _CELL],
+                                      [x, y + _CELL], [x, y]]]},
+        'properties': {
+            'id': num,
+            '_links': {'self': {'href': '/api/missions/%d/' % num}},
+            'bbox_leaflet': [[y, x], [y + _CELL, x + _CELL]],
+            'related_info': {'notes': '', 'nearby': [rnd.randint(1, 10 ** 6) for _ in range(3)]},
+            'recommended_dose': rnd.randint(5, 60),
+            'risk_percentile': round(rnd.uniform(90, 100), 3),
+            'risk_z_score': round(rnd.uniform(1, 6), 4),
+            'mission_set': {
+                'id': num // 20,
+                'shift_label': _SHIFTS[shift],
+                'period': {'start': start.strftime('%Y-%m-%dT%H:%M:%S-05:00'),
+                           'end': (start + timedelta(hours=8)).strftime(
+                               '%Y-%m-%dT%H:%M:%S-05:00')},
+                'resources': [{'resource_type': res,
+                               'number_of_resources': rnd.randint(1, 4),
+                               'time_percent': rnd.choice([10, 15, 20, 25]),
+                               'times_returning': rnd.randint(0, 3)} for res in resources]},
+            'event_models': [{'label': label, 'weight': round(rnd.uniform(0, 1), 3)}
+                             for label in models]}}
+
+
+def write_missions_geojson(path, num_features, seed=0):
+    """Write a missions GeoJSON FeatureCollection with num_features features to path.
+
+    Features are written one at a time, so memory use does not grow with the number of them.
+    """
+    rnd = random.Random(seed)
+    with open(path, 'wb') as outf:
+        outf.write('{"type": "FeatureCollection", "features": [')
+        for num in xrange(num_features):
+            if num:
+                outf.write(', ')
+            json.dump(mission_feature(num, rnd), outf)
+        outf.write(']}')
+
+
+def write_event_csv(path, num_rows, seed=0, datasource='benchmark'):
+    """Write a HunchLab event CSV of num_rows incidents, ready for upload, to path."""
+    with open(path, 'wb') as outf:
+        wtr = csv.writer(outf)
+        wtr.writerow(EVENT_COLUMNS)
+        for inc in iter_incidents(num_rows, 0, seed):
+            dt = inc['dt'].strftime('%Y-%m-%dT%H:%M:%S-05:00')
+            wtr.writerow([datasource, 'E%d' % inc['n'], inc['class'].strip(), dt, dt, dt,
+                          repr(inc['x']), repr(inc['y']), inc['address'], dt])
+
+
+def generate_all(out_dir, num_rows, num_missions=None, bad_rate=0.01, seed=0,
+                 page_size=1000):
+    """Write every kind of benchmark data to out_dir, with a manifest describing it.
+
+    Writes police_inct.zip (and police_inct.csv), ArcGIS pages in arcgis_pages/, and
+    missions.json.  The manifest, manifest.json, holds the settings used and the expected
+    counts of unusable incidents in the CSV and in the ArcGIS pages.  Returns the manifest.
+
+    Arguments:
+    out_dir      -- directory to write to; made if need be
+    num_rows     -- number of incidents
+    num_missions -- number of missions; defaults to num_rows
+    bad_rate     -- share of incidents that are unusable
+    seed         -- random seed
+    page_size    -- incidents per ArcGIS page
+    """
+    if num_missions is None:
+        num_missions = num_rows
+    pages_dir = os.path.join(out_dir, 'arcgis_pages')
+    if not os.path.isdir(pages_dir):
+        os.makedirs(pages_dir)
+
+    logging.info('Writing %d incidents to police_inct.zip...', num_rows)
+    csv_counts = write_police_zip(out_dir, num_rows, bad_rate, seed)
+    logging.info('Writing %d incidents as ArcGIS pages...', num_rows)
+    arcgis_counts = write_arcgis_pages(pages_dir, num_rows, page_size, bad_rate, seed)
+    logging.info('Writing %d missions...', num_missions)
+    write_missions_geojson(os.path.join(out_dir, 'missions.json'), num_missions, seed)
+
+    manifest = {'version': DATA_VERSION,
+                'rows': num_rows,
+                'missions': num_missions,
+                'bad_rate': bad_rate,
+                'seed': seed,
+                'page_size': page_size,
+                'csv_bad_counts': csv_counts,
+                'arcgis_bad_counts': arcgis_counts}
+    # written last, so a partly written data set has no manifest
+    with open(os.path.join(out_dir, MANIFEST_FILENAME), 'wb') as outf:
+        json.dump(manifest, outf, indent=2, sort_keys=True)
+    return manifest
+
+
+def read_manifest(out_dir):
+    """Return the manifest of the data set in out_dir, or None if there is not one."""
+    path = os.path.join(out_dir, MANIFEST_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as inf:
+        return json.load(inf)
+
+
+def ensure_data(out_dir, num_rows, num_missions=None, bad_rate=0.01, seed=0):
+    """Return manifest of the data set in out_dir, generating it first unless it matches."""
+    if num_missions is None:
+        num_missions = num_rows
+    wanted = {'version': DATA_VERSION, 'rows': num_rows, 'missions': num_missions,
+              'bad_rate': bad_rate, 'seed': seed}
+    manifest = read_manifest(out_dir)
+    if manifest and all(manifest.get(key) == value for key, value in wanted.items()):
+        logging.info('Using data in %s.', out_dir)
+        return manifest
+    return generate_all(out_dir, num_rows, num_missions, bad_rate, seed)
+
+
+def main():
+    desc = 'Generate synthetic incident and missions data for benchmarks.'
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('-o', '--out', default='bench_data', dest='out_dir',
+                        help="Directory to write data to.  Defaults to 'bench_data'.",
+                        metavar='DIR')
+    parser.add_argument('-s', '--size', default='10k', dest='size', choices=sorted(SIZES),
+                        help="Number of incidents.  Defaults to '10k'.")
+    parser.add_argument('-r', '--rows', type=int, dest='rows',
+                        help='Number of incidents, instead of one of the sizes')
+    parser.add_argument('-m', '--missions', type=int, dest='missions',
+                        help='Number of missions.  Defaults to the number of incidents.')
+    parser.add_argument('-b', '--bad-rate', type=float, default=0.01, dest='bad_rate',
+                        help='Share of incidents that are unusable.  Defaults to 0.01.')
+    parser.add_argument('--seed', type=int, default=0, dest='seed', help='Random seed')
+    parser.add_argument('-l', '--log-level', default='info', dest='log_level',
+                        help="Log level for console output.  Defaults to 'info'.",
+                        choices=['debug', 'info', 'warning', 'error', 'critical'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    num_rows = args.rows or SIZES[args.size]
+    manifest = generate_all(args.out_dir, num_rows, args.missions, args.bad_rate, args.seed)
+    logging.info('Unusable incidents in CSV: %s', manifest['csv_bad_counts'])
+    logging.info('Unusable incidents in ArcGIS pages: %s', manifest['arcgis_bad_counts'])
+    logging.info('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""Load test the upload client: many concurrent uploads against a stand-in HunchLab server.
+
+Each upload goes through eventdata/upload.py just as a real one does: the CSV is posted, then
+the import job is polled until it finishes.  The time to get the import job ID back, and the
+time until the import finished, are recorded for every upload, and summed up as throughput
+and latency percentiles.  The stand-in server is started in this process, with the latency,
+bandwidth and error options of standin_server.py, unless --url names one already running.
+"""
+
+from argparse import ArgumentParser
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import requests
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(_BENCH_DIR), 'eventdata'))
+
+import upload as hunchlab_upload
+
+import generate
+from results import peak_rss_mb, run_info
+import standin_server
+
+# latency percentiles to report
+PERCENTILES = [50, 90, 95, 99]
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values, by the nearest-rank method."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def latency_summary(values):
+    """Return dictionary of the mean, maximum and percentiles of a list of seconds."""
+    if not values:
+        return {}
+    summary = dict(('p%d' % pct, percentile(values, pct)) for pct in PERCENTILES)
+    summary['mean'] = sum(values) / len(values)
+    summary['max'] = max(values)
+    return summary
+
+
+def _upload_one(task):
+    """Upload the CSV once, as upload.upload does; return what happened and how long it took."""
+    num, settings, path, compress = task
+    result = {'upload': num, 'status': None, 'error': None, 'post_seconds': None,
+              'total_seconds': None}
+    start = time.time()
+    try:
+        s = hunchlab_upload.make_session(settings)
+        with open(path, 'rb') as f:
+            import_job_id = hunchlab_upload.post_csv(s, settings, f, compress=compress)
+        result['post_seconds'] = time.time() - start
+        result['import_job_id'] = import_job_id
+        final = hunchlab_upload.watch_imports(s, settings, [import_job_id])
+        result['status'] = final[str(import_job_id)]
+    except hunchlab_upload.UploadError as ex:
+        result['error'] = 'UploadError: %s' % ex
+    except requests.exceptions.RequestException as ex:
+        result['error'] = '%s: %s' % (type(ex).__name__, ex)
+    result['total_seconds'] = time.time() - start
+    return result
+
+
+def run_load(settings, path, uploads, clients, compress=False):
+    """Make uploads uploads of the CSV at path from clients threads at once.
+
+    Returns a dictionary summing up the results, with the results of each upload under
+    'results'.
+    """
+    size = os.path.getsize(path)
+    tasks = [(num, settings, path, compress) for num in range(uploads)]
+    pool = ThreadPool(clients)
+    start = time.time()
+    try:
+        results = pool.map(_upload_one, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    wall = time.time() - start
+
+    completed = [r for r in results if r['status'] == 'Completed']
+    outcomes = {}
+    for r in results:
+        outcome = r['status'] or r['error'] or 'unknown'
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    posted = [r['post_seconds'] for r in results if r['post_seconds'] is not None]
+    return {'uploads': uploads,
+            'clients': clients,
+            'compress': compress,
+            'file_mb': size / (1024.0 * 1024.0),
+            'wall_seconds': wall,
+            'completed': len(completed),
+            'outcomes': outcomes,
+            'uploads_per_sec': len(completed) / wall if wall else None,
+            'mb_per_sec': len(posted) * size / (1024.0 * 1024.0) / wall if wall else None,
+            'post_latency': latency_summary(posted),
+            'import_latency': latency_summary([r['total_seconds'] for r in completed]),
+            'results': results}
+
+
+def print_summary(summary):
+    print '%d uploads of %.1f MB from %d clients in %.1f s' % (
+        summary['uploads'], summary['file_mb'], summary['clients'], summary['wall_seconds'])
+    print 'Outcomes: %s' % ', '.join('%s: %d' % item for item in
+                                     sorted(summary['outcomes'].items()))
+    print 'Throughput: %.2f completed uploads/s, %.1f MB/s posted' % (
+        summary['uploads_per_sec'] or 0, summary['mb_per_sec'] or 0)
+    for label, key in (('Post', 'post_latency'), ('Post to import done', 'import_latency')):
+        latency = summary[key]
+        if latency:
+            print '%-20s mean %.3f  %s  max %.3f s' % (
+                label + ':', latency['mean'],
+                '  '.join('p%d %.3f' % (pct, latency['p%d' % pct]) for pct in PERCENTILES),
+                latency['max'])
+
+
+def main():
+    desc = 'Load test the upload client against a stand-in HunchLab server.'
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('-u', '--uploads', type=int, default=20, dest='uploads',
+                        help='Number of uploads to make.  Defaults to 20.')
+    parser.add_argument('-k', '--clients', type=int, default=4, dest='clients',
+                        help='Number of uploads to make at once.  Defaults to 4.')
+    parser.add_argument('--upload-rows', type=int, default=10000, dest='upload_rows',
+                        help='Rows in each uploaded CSV.  Defaults to 10,000.')
+    parser.add_argument('--csv', dest='csv',
+                        help='CSV to upload, instead of a generated one', metavar='FILE')
+    parser.add_argument('-z', '--compress', default=False, dest='compress',
+                        action='store_true', help='Gzip the CSV as it is sent')
+    parser.add_argument('--url', dest='url',
+                        help='Base URL of a stand-in server already running, instead of ' +
+                             'starting one')
+    standin_server.add_server_arguments(parser)
+    parser.add_argument('-o', '--output', default='load_results.json', dest='output',
+                        metavar='FILE',
+                        help="File to write results to.  Defaults to 'load_results.json'.")
+    parser.add_argument('-l', '--log-level', default='warning', dest='log_level',
+                        help="Log level for console output.  Defaults to 'warning'.",
+                        choices=['debug', 'info', 'warning', 'error', 'critical'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    work_dir = tempfile.mkdtemp(prefix='hunchlab_load_')
+    server = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            server = standin_server.server_from_args(args)
+            standin_server.start_in_thread(server)
+            base_url = server.url
+
+        path = args.csv
+        if not path:
+            path = os.path.join(work_dir, 'events.csv')
+            generate.write_event_csv(path, args.upload_rows)
+
+        settings = {'csvendpoint': base_url + '/api/dataservice/',
+                    'certificate': True,
+                    'token': args.token or 'load-test',
+                    'srid': '4326'}
+        summary = run_load(settings, path, args.uploads, args.clients, args.compress)
+
+        try:
+            summary['server_stats'] = requests.get(base_url + '/_stats', timeout=20).json()
+        except (requests.exceptions.RequestException, ValueError):
+            logging.warning('Could not get stand-in server stats.')
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary.update(run_info())
+    summary.update({'peak_rss_mb': peak_rss_mb(),
+                    'server': None if args.url else {
+                        'latency': args.latency, 'jitter': args.jitter,
+                        'bandwidth': args.bandwidth, 'error_rate': args.error_rate,
+                        'error_status': args.error_status,
+                        'max_concurrent': args.max_concurrent,
+                        'import_seconds': args.import_seconds,
+                        'import_rate': args.import_rate, 'fail_rate': args.fail_rate}})
+
+    print_summary(summary)
+    with open(args.output, 'wb') as outf:
+        json.dump(summary, outf, indent=2, sort_keys=True)
+    print 'Wrote results to %s.' % args.output
+    return 0 if summary['completed'] == args.uploads else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""Details of the run to keep with benchmark and load test results."""
+
+from datetime import datetime
+import os
+import platform
+import subprocess
+import sys
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peak_rss_mb():
+    """Return peak resident set size of this process in megabytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on OS X
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def git_info():
+    """Return the current git commit, and whether the working tree has changes, if known."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=_REPO_DIR).strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain',
+                                           '--untracked-files=no'], cwd=_REPO_DIR)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(changes.strip())
+
+
+def run_info():
+    """Return dictionary of the git commit, time, Python version and platform of this run."""
+    commit, changes = git_info()
+    return {'commit': commit,
+            'uncommitted_changes': changes,
+            'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform()}
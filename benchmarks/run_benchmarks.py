@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+
+"""Time the slow steps of the fetch, upload and missions scripts on synthetic data.
+
+Data is made by generate.py and kept between runs.  The zipfile download and the ArcGIS
+queries are served by the stand-in server in standin_server.py, so the fetch code runs as it
+does for real, without the network.  Each benchmark is run several times and the best time is
+kept.
+Results are written as JSON, with the git commit they were run on, so that results from two
+commits can be compared with --baseline.
+"""
+
+from argparse import ArgumentParser
+import csv
+from itertools import islice
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_REPO_DIR = os.path.dirname(_BENCH_DIR)
+for _script_dir in ('fetchdata', 'eventdata', 'geojson_to_shp'):
+    sys.path.insert(0, os.path.join(_REPO_DIR, _script_dir))
+
+from fetch_philly_crime_data import PhillyUploader
+from fetch_sources import Scheduler
+from incident_uploader import batch_transformer
+from geojson_to_shp import MissionsConverter
+import output_formats
+import upload as hunchlab_upload
+
+import generate
+from results import peak_rss_mb, run_info
+from standin_server import StandinServer, start_in_thread
+
+# None if NumPy is not installed
+BatchTransformer = batch_transformer()
+
+# most input rows to time process_row over
+_MAX_PROCESS_ROWS = 100000
+# rows per block for the NumPy batch conversion
+_BATCH_SIZE = 50000
+# sources to fetch in the scheduler benchmarks
+_SOURCES = 4
+# slow-down, as a share of the baseline time, to report as a regression
+DEFAULT_THRESHOLD = 0.10
+# the single command for the scripts, and the slow modules it should only load when needed
+_HUNCHLAB = os.path.join(_REPO_DIR, 'eventdata', 'hunchlab.py')
+_HEAVY_MODULES = ('requests', 'pytz', 'dateutil', 'tzlocal', 'numpy')
+# sizes of the mission sets parsed by parse_missions_large, as multiples of the data set's
+_MISSIONS_SCALES = (1, 4, 16)
+# parses the missions GeoJSON named by its argument in a new process, then prints the seconds
+# it took and the peak memory use of the process, as JSON
+_PARSE_MISSIONS_CODE = '''
+import json, sys, time
+from geojson_to_shp import MissionsConverter
+from results import peak_rss_mb
+mc = MissionsConverter('http://127.0.0.1', 'benchmark', 'missions', 'ogr2ogr')
+mc.json_filename = sys.argv[1]
+start = time.time()
+failed = mc.parseMissions()
+print json.dumps({'failed': failed, 'seconds': time.time() - start,
+                  'peak_rss_mb': peak_rss_mb()})
+'''
+
+BENCHMARKS = ['process_row_csv', 'process_row_arcgis', 'get_csv', 'get_csv_dictreader',
+              'get_csv_stream_zip', 'get_csv_batch', 'get_csv_all_formats', 'fetch_from_arcgis',
+              'fetch_sources_serial', 'fetch_sources', 'parse_missions', 'parse_missions_large',
+              'write_shapefile', 'encode_upload', 'encode_upload_gzip', 'startup_help',
+              'startup_bad_config']
+
+
+class BenchmarkRunner(object):
+    """Run benchmarks against one data set, each in a fresh working directory."""
+
+    def __init__(self, data_dir, manifest, work_dir):
+        """Arguments:
+        data_dir -- directory of data made by generate.generate_all
+        manifest -- manifest of that data
+        work_dir -- directory to run in; each run gets a new directory inside it
+        """
+        self.data_dir = data_dir
+        self.manifest = manifest
+        self.work_dir = work_dir
+        self.server = None
+        self._run_ct = 0
+        self._csv_rows = None
+        self._arcgis_rows = None
+        self._processed_csv = None
+
+    def start_server(self):
+        self.server = StandinServer(self.data_dir, self.manifest)
+        start_in_thread(self.server)
+
+    def stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def run(self, name):
+        """Run benchmark name once in a new working directory.
+
+        Returns seconds taken, number of items handled, and a dictionary of other results.
+        """
+        self._run_ct += 1
+        run_dir = os.path.join(self.work_dir, 'run%d' % self._run_ct)
+        os.mkdir(run_dir)
+        old_dir = os.getcwd()
+        os.chdir(run_dir)
+        try:
+            return getattr(self, 'bench_' + name)()
+        finally:
+            os.chdir(old_dir)
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    def bench_process_row_csv(self):
+        """PhillyUploader.process_row over rows of police_inct.csv."""
+        if self._csv_rows is None:
+            with open(os.path.join(self.data_dir, 'police_inct.csv'), 'rb') as inf:
+                rdr = csv.DictReader(inf)
+                self._csv_rows = list(islice(rdr, _MAX_PROCESS_ROWS))
+        return self._time_process_row(self._csv_rows, False)
+
+    def bench_process_row_arcgis(self):
+        """PhillyUploader.process_row over features from ArcGIS pages."""
+        if self._arcgis_rows is None:
+            input_fields = PhillyUploader().input_fields
+            self._arcgis_rows = []
+            num = 0
+            while len(self._arcgis_rows) < _MAX_PROCESS_ROWS:
+                path = os.path.join(self.data_dir, 'arcgis_pages',
+                                    generate.arcgis_page_filename(num))
+                if not os.path.isfile(path):
+                    break
+                with open(path, 'rb') as inf:
+                    for feature in json.load(inf)['features']:
+                        attrs = feature['attributes']
+                        self._arcgis_rows.append(dict((col, attrs.get(col)) for col in
+                                                      input_fields))
+                num += 1
+            del self._arcgis_rows[_MAX_PROCESS_ROWS:]
+        return self._time_process_row(self._arcgis_rows, True)
+
+    def _time_process_row(self, rows, from_arcgis):
+        p = PhillyUploader()
+        process_row = p.process_row
+        start = time.time()
+        for row in rows:
+            process_row(row, from_arcgis)
+        elapsed = time.time() - start
+        return elapsed, len(rows), {'bad_row_ct': p.bad_row_ct}
+
+    def bench_get_csv(self):
+        """PhillyUploader.get_csv: download, extract and convert the full zipfile."""
+        return self._time_get_csv(PhillyUploader())
+
+    def bench_get_csv_dictreader(self):
+        """PhillyUploader.get_csv, reading the extracted CSV with csv.DictReader."""
+        return self._time_get_csv(PhillyUploader(use_mmap=False))
+
+    def bench_get_csv_stream_zip(self):
+        """PhillyUploader.get_csv, reading the CSV straight out of the zipfile."""
+        return self._time_get_csv(PhillyUploader(stream_zip=True))
+
+    def bench_get_csv_batch(self):
+        """PhillyUploader.get_csv, converting blocks of rows with NumPy."""
+        if BatchTransformer is None:
+            return None
+        return self._time_get_csv(PhillyUploader(batch_size=_BATCH_SIZE))
+
+    def bench_get_csv_all_formats(self):
+        """PhillyUploader.get_csv, writing every output format installed in the same pass."""
+        formats = [fmt for fmt in output_formats.FORMATS
+                   if not output_formats.missing_dependency(fmt)]
+        elapsed, items, extra = self._time_get_csv(PhillyUploader(output_formats=formats))
+        for fmt in formats:
+            path = output_formats.output_path(PhillyUploader.OUTPUT_FILENAME, fmt)
+            extra['%s_mb' % fmt.replace('.', '_')] = _size_mb(path)
+        return elapsed, items, extra
+
+    def _time_get_csv(self, p):
+        p.downloader.url = self.server.url + '/police_inct.zip'
+        p.force_download = True
+        start = time.time()
+        ok = p.get_csv()
+        elapsed = time.time() - start
+        if not ok:
+            raise BenchmarkError('get_csv failed')
+        _check_counts(p, self.manifest['csv_bad_counts'])
+        return elapsed, p.row_ct, {'bad_row_ct': p.bad_row_ct,
+                                   'output_mb': _size_mb(p.OUTPUT_FILENAME)}
+
+    def bench_fetch_from_arcgis(self):
+        """PhillyUploader.fetch_from_arcgis, paging through every incident."""
+        p = PhillyUploader()
+        p.arcgis_url = self.server.url + '/query'
+        p.arcgis_page_size = self.manifest['page_size']
+        start = time.time()
+        ok = p.fetch_from_arcgis(30)
+        elapsed = time.time() - start
+        if not ok:
+            raise BenchmarkError('fetch_from_arcgis failed')
+        _check_counts(p, self.manifest['arcgis_bad_counts'])
+        return elapsed, p.row_ct, {'bad_row_ct': p.bad_row_ct}
+
+    def bench_fetch_sources_serial(self):
+        """Scheduler fetching the full CSV for several sources, one after another."""
+        return self._time_fetch_sources(1)
+
+    def bench_fetch_sources(self):
+        """Scheduler fetching the full CSV for several sources at once, sharing processes."""
+        return self._time_fetch_sources(_SOURCES, workers=_SOURCES)
+
+    def _time_fetch_sources(self, concurrency, workers=1):
+        jobs = [{'name': 'philly%d' % num,
+                 'source': 'philly',
+                 'directory': os.path.abspath('philly%d' % num),
+                 'upload_config': None,
+                 'formats': ['csv'],
+                 'batch_size': 0,
+                 'requests_per_second': None} for num in range(_SOURCES)]
+        scheduler = _StandinScheduler(self.server.url, jobs, concurrency=concurrency,
+                                      workers=workers, full_csv=True)
+        start = time.time()
+        results = scheduler.run()
+        elapsed = time.time() - start
+        if not all(results.values()):
+            raise BenchmarkError('Scheduler failed for %s' %
+                                 ', '.join(name for name, ok in results.items() if not ok))
+        return elapsed, self.manifest['rows'] * _SOURCES, {'sources': _SOURCES}
+
+    def bench_parse_missions(self):
+        """MissionsConverter.parseMissions over the missions GeoJSON, writing parsed GeoJSON."""
+        mc = MissionsConverter(self.server.url, 'benchmark', 'missions', 'ogr2ogr')
+        mc.json_filename = os.path.join(self.data_dir, 'missions.json')
+        start = time.time()
+        failed = mc.parseMissions()
+        elapsed = time.time() - start
+        if failed:
+            raise BenchmarkError('parseMissions failed with status %s' % failed)
+        return elapsed, self.manifest['missions'], {
+            'input_mb': _size_mb(mc.json_filename), 'output_mb': _size_mb(mc.parsed_json)}
+
+    def bench_write_shapefile(self):
+        """parseMissions and convertMissions writing the Shapefile itself, without ogr2ogr."""
+        mc = MissionsConverter(self.server.url, 'benchmark', 'missions', 'native')
+        mc.json_filename = os.path.join(self.data_dir, 'missions.json')
+        start = time.time()
+        failed = mc.parseMissions() or mc.convertMissions()
+        elapsed = time.time() - start
+        if failed:
+            raise BenchmarkError('Writing the Shapefile failed with status %s' % failed)
+        return elapsed, self.manifest['missions'], {
+            'input_mb': _size_mb(mc.json_filename),
+            'output_mb': sum(_size_mb(mc.shapefile + ext) for ext in ('.shp', '.shx', '.dbf'))}
+
+    def bench_parse_missions_large(self):
+        """parseMissions over larger and larger mission sets, each in a new Python process.
+
+        Reports the time and peak memory use for each set; memory use should not grow with it.
+        The larger sets are generated the first time, and kept with the data.
+        """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.join(_REPO_DIR, 'geojson_to_shp'), _BENCH_DIR]))
+        sizes = {}
+        for scale in _MISSIONS_SCALES:
+            num_missions = self.manifest['missions'] * scale
+            path = os.path.join(self.data_dir, 'missions.json')
+            if scale != 1:
+                path = os.path.join(self.data_dir, 'missions_%d.json' % num_missions)
+                if not os.path.exists(path):
+                    generate.write_missions_geojson(path + '.tmp', num_missions,
+                                                    self.manifest['seed'])
+                    os.rename(path + '.tmp', path)
+            out = subprocess.Popen([sys.executable, '-c', _PARSE_MISSIONS_CODE, path], env=env,
+                                   stdout=subprocess.PIPE).communicate()[0]
+            result = json.loads(out.splitlines()[-1])
+            if result['failed']:
+                raise BenchmarkError('parseMissions failed with status %s on %d missions' %
+                                     (result['failed'], num_missions))
+            sizes[num_missions] = {'seconds': result['seconds'],
+                                   'peak_rss_mb': result['peak_rss_mb'],
+                                   'input_mb': _size_mb(path)}
+
+        largest = max(sizes)
+        rss = [size['peak_rss_mb'] for size in sizes.values()]
+        return sizes[largest]['seconds'], largest, {
+            'sizes': sizes,
+            'rss_growth_mb': max(rss) - min(rss) if None not in rss else None}
+
+    def bench_encode_upload(self):
+        """Encoding the processed CSV as the multipart upload body."""
+        return self._time_encode(False)
+
+    def bench_encode_upload_gzip(self):
+        """Encoding the processed CSV as the multipart upload body, gzipped."""
+        return self._time_encode(True)
+
+    def _time_encode(self, compress):
+        path = self._get_processed_csv()
+        with open(path, 'rb') as f:
+            body = hunchlab_upload.MultipartEncoder({'srid': 4326}, 'events.csv', f,
+                                                    compress=compress)
+            start = time.time()
+            for _ in body:
+                pass
+            elapsed = time.time() - start
+        return elapsed, self.manifest['rows'], {
+            'input_mb': body.bytes_read / (1024.0 * 1024.0),
+            'body_mb': body.bytes_sent / (1024.0 * 1024.0)}
+
+    def bench_startup_help(self):
+        """hunchlab COMMAND --help for each subcommand, each in a new Python process."""
+        return self._time_startup([['upload', '--help'], ['fetch-philly', '--help'],
+                                   ['missions', '--help']])
+
+    def bench_startup_bad_config(self):
+        """Each hunchlab subcommand failing on a missing configuration file, in a new process."""
+        return self._time_startup([['upload', '-c', 'missing.ini', 'events.csv'],
+                                   ['fetch-philly', '-c', 'missing.ini', '--pipeline'],
+                                   ['missions', '-c', 'missing.ini']])
+
+    def _time_startup(self, commands):
+        """Time running hunchlab with each of commands, and note the slow modules each loads.
+
+        The .pyc files are written by a first run that is not timed.
+        """
+        seconds = {}
+        heavy = {}
+        with open(os.devnull, 'wb') as devnull:
+            for args in commands:
+                cmd = [sys.executable, _HUNCHLAB] + args
+                subprocess.call(cmd, stdout=devnull, stderr=devnull)
+                start = time.time()
+                subprocess.call(cmd, stdout=devnull, stderr=devnull)
+                seconds[args[0]] = time.time() - start
+
+                # Python 2 has no -X importtime; -v lists the modules imported
+                verbose = subprocess.Popen([sys.executable, '-v'] + cmd[1:], stdout=devnull,
+                                           stderr=subprocess.PIPE).communicate()[1]
+                heavy[args[0]] = sorted(set(
+                    line.split()[1].split('.')[0] for line in verbose.splitlines()
+                    if line.startswith('import ') and
+                    line.split()[1].split('.')[0] in _HEAVY_MODULES))
+        return sum(seconds.values()), len(commands), {'seconds': seconds,
+                                                      'heavy_modules': heavy}
+
+    def _get_processed_csv(self):
+        """Return path of the converted police_inct.csv, converting it the first time."""
+        if self._processed_csv is None:
+            p = PhillyUploader()
+            p.OUTPUT_FILENAME = os.path.join(self.work_dir, 'processed.csv')
+            with open(os.path.join(self.data_dir, 'police_inct.csv'), 'rb') as inf:
+                if not p.convert_csv(inf):
+                    raise BenchmarkError('Could not convert police_inct.csv')
+            self._processed_csv = p.OUTPUT_FILENAME
+        return self._processed_csv
+
+
+class _StandinScheduler(Scheduler):
+    """Scheduler fetching every source from the stand-in server."""
+
+    def __init__(self, server_url, jobs, **kwargs):
+        Scheduler.__init__(self, jobs, **kwargs)
+        self.server_url = server_url
+
+    def make_uploader(self, job):
+        p = Scheduler.make_uploader(self, job)
+        p.downloader.url = self.server_url + '/police_inct.zip'
+        p.arcgis_url = self.server_url + '/query'
+        return p
+
+
+class BenchmarkError(Exception):
+    """A benchmark did not do what it was timing, so its time means nothing."""
+    pass
+
+
+def _check_counts(p, expected):
+    """Check the bad row counters of PhillyUploader p against the data set's manifest."""
+    for name, count in expected.items():
+        if getattr(p, name) != count:
+            raise BenchmarkError('%s is %d; expected %d' % (name, getattr(p, name), count))
+
+
+def _size_mb(path):
+    return os.path.getsize(path) / (1024.0 * 1024.0)
+
+
+def run_benchmarks(runner, names, repeat):
+    """Run each named benchmark repeat times; return dictionary of name to results."""
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            outcome = runner.run(name)
+            if outcome is None:
+                break
+            runs.append(outcome)
+
+        if not runs:
+            print '%-20s skipped' % name
+            continue
+
+        times = [elapsed for elapsed, _, _ in runs]
+        best = min(times)
+        items = runs[0][1]
+        result = {'description': getattr(runner, 'bench_' + name).__doc__,
+                  'times': times,
+                  'best': best,
+                  'median': sorted(times)[len(times) // 2],
+                  'items': items,
+                  'items_per_sec': items / best if best else None,
+                  'peak_rss_mb': peak_rss_mb()}
+        result.update(runs[0][2])
+        results[name] = result
+        print '%-20s best %9.4f s  %12.0f items/s' % (name, best, result['items_per_sec'] or 0)
+
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Print each benchmark's best time against the baseline; return names that slowed down.
+
+    Arguments:
+    results   -- results from this run, as written by main
+    baseline  -- results from an earlier run
+    threshold -- slow-down, as a share of the baseline time, to count as a regression
+    """
+    if results['data'] != baseline.get('data'):
+        print 'Warning: baseline was run on different data: %s' % baseline.get('data')
+
+    print
+    print 'Compared with %s:' % (baseline.get('commit') or 'baseline')
+    regressions = []
+    for name in BENCHMARKS:
+        new = results['benchmarks'].get(name)
+        old = baseline.get('benchmarks', {}).get(name)
+        if not new or not old or not old['best']:
+            continue
+        ratio = new['best'] / old['best']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print '%-20s %8.3f s -> %8.3f s  (%.2fx)%s' % (name, old['best'], new['best'], ratio,
+                                                       flag)
+    return regressions
+
+
+def main():
+    desc = 'Time the fetch, upload and missions scripts on synthetic data.'
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('-s', '--size', default='10k', dest='size',
+                        choices=sorted(generate.SIZES),
+                        help="Number of incidents.  Defaults to '10k'.")
+    parser.add_argument('-r', '--rows', type=int, dest='rows',
+                        help='Number of incidents, instead of one of the sizes')
+    parser.add_argument('-m', '--missions', type=int, dest='missions',
+                        help='Number of missions.  Defaults to the number of incidents.')
+    parser.add_argument('-b', '--bad-rate', type=float, default=0.01, dest='bad_rate',
+                        help='Share of incidents that are unusable.  Defaults to 0.01.')
+    parser.add_argument('--seed', type=int, default=0, dest='seed', help='Random seed')
+    parser.add_argument('-d', '--data', dest='data_dir', metavar='DIR',
+                        help="Directory of generated data, made if need be.  Defaults to " +
+                             "'bench_data/<rows>' beside this script.")
+    parser.add_argument('-n', '--repeat', type=int, default=3, dest='repeat',
+                        help='Times to run each benchmark.  Defaults to 3.')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', dest='output',
+                        metavar='FILE',
+                        help="File to write results to.  Defaults to 'benchmark_results.json'.")
+    parser.add_argument('--baseline', dest='baseline', metavar='FILE',
+                        help='Results file of an earlier run to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        dest='threshold',
+                        help='Slow-down to report as a regression.  Defaults to 0.10 (10%%).')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='Benchmarks to run; defaults to all of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('-l', '--log-level', default='warning', dest='log_level',
+                        help="Log level for console output.  Defaults to 'warning'.",
+                        choices=['debug', 'info', 'warning', 'error', 'critical'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    names = args.benchmarks or BENCHMARKS
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(unknown))
+
+    num_rows = args.rows or generate.SIZES[args.size]
+    num_missions = args.missions if args.missions is not None else num_rows
+    data_dir = args.data_dir or os.path.join(_BENCH_DIR, 'bench_data', str(num_rows))
+    print 'Preparing data in %s...' % data_dir
+    manifest = generate.ensure_data(data_dir, num_rows, num_missions, args.bad_rate, args.seed)
+
+    results = run_info()
+    results.update({'numpy': BatchTransformer is not None,
+                    'repeat': args.repeat,
+                    'data': dict((key, manifest[key]) for key in
+                                 ('rows', 'missions', 'bad_rate', 'seed'))})
+
+    work_dir = tempfile.mkdtemp(prefix='hunchlab_bench_')
+    runner = BenchmarkRunner(data_dir, manifest, work_dir)
+    runner.start_server()
+    try:
+        results['benchmarks'] = run_benchmarks(runner, names, args.repeat)
+    finally:
+        runner.stop_server()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    with open(args.output, 'wb') as outf:
+        json.dump(results, outf, indent=2, sort_keys=True)
+    print 'Wrote results to %s.' % args.output
+
+    if args.baseline:
+        with open(args.baseline, 'rb') as inf:
+            baseline = json.load(inf)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print '%d benchmarks slowed down by more than %.0f%%.' % (len(regressions),
+                                                                      args.threshold * 100)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
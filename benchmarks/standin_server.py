@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+
+"""Local stand-in for the HunchLab API, the ArcGIS query service and the incident download.
+
+Serves the endpoints the scripts in this repository talk to, from data made by generate.py:
+
+  POST /api/dataservice/          takes a CSV upload; answers 202 with an import_job_id
+  GET  /api/dataservice/<id>/     import job status, going from SUBM through PROC to COMP
+                                  (or FAIL), with 202 until the job has finished
+  GET  /api/missions/             missions GeoJSON
+  GET  .../query                  ArcGIS query: counts, and pages by resultOffset
+  GET  .../police_inct.zip        incident zipfile, with ETag, Last-Modified and Range support
+  GET  /_stats                    counts of requests, bytes and injected errors, as JSON
+
+Latency, bandwidth caps, error injection and a limit on concurrent requests can be set, to
+see how the clients behave against a slow or flaky server.
+"""
+
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate
+import itertools
+import json
+import logging
+import os
+import random
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urlparse
+import zlib
+
+import generate
+
+DEFAULT_PORT = 8767
+# bytes to read or write at a time
+_CHUNK_SIZE = 64 * 1024
+# most seconds of data to send at once under a bandwidth cap, so the rate stays even
+_THROTTLE_SLICE = 0.05
+# how long a job stays in each state before the last, as a share of its import time
+_SUBMITTED_SHARE = 0.1
+
+
+def parse_rate(value):
+    """Parse a rate in bytes per second, such as 512k or 10M; return it as a number."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)\s*$', value)
+    if not match:
+        raise ValueError('Not a rate: %s' % value)
+    scale = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[match.group(2).lower()]
+    return float(match.group(1)) * scale
+
+
+class ImportJobState(object):
+    """An upload the stand-in has taken, and how its import will turn out."""
+
+    def __init__(self, job_id, rows, size, import_seconds, fail):
+        self.job_id = job_id
+        self.rows = rows
+        self.size = size
+        self.posted = time.time()
+        self.import_seconds = import_seconds
+        self.fail = fail
+        self.polls = 0
+
+    def status(self):
+        """Return the processing status code of the job now, and whether it has finished."""
+        elapsed = time.time() - self.posted
+        if elapsed >= self.import_seconds:
+            return ('FAIL' if self.fail else 'COMP'), True
+        elif elapsed < self.import_seconds * _SUBMITTED_SHARE:
+            return 'SUBM', False
+        return 'PROC', False
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server answering as HunchLab, ArcGIS and the incident download do."""
+
+    daemon_threads = True
+
+    def __init__(self, data_dir, manifest, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 bandwidth=None, error_rate=0.0, error_status=503, drop_rate=0.0,
+                 max_concurrent=None, import_seconds=1.0, import_rate=None, fail_rate=0.0,
+                 token=None, seed=None):
+        """Arguments:
+        data_dir       -- directory of data made by generate.generate_all
+        manifest       -- manifest of that data
+        host, port     -- address to listen on; port 0 picks a free port
+        latency        -- seconds to wait before answering each request
+        jitter         -- most extra seconds, picked at random, to add to the latency
+        bandwidth      -- most bytes per second to send or take in for each request
+        error_rate     -- share of requests to answer with error_status instead
+        error_status   -- HTTP status of injected errors
+        drop_rate      -- share of file downloads to cut off halfway through
+        max_concurrent -- most requests to work on at once; more are answered with 429
+        import_seconds -- seconds an import job takes to finish
+        import_rate    -- if given, rows per second an import job handles, on top of
+                          import_seconds
+        fail_rate      -- share of import jobs that end up Failed
+        token          -- if given, the API token requests to the HunchLab endpoints need
+        seed           -- random seed for the injected errors and failures
+        """
+        HTTPServer.__init__(self, (host, port), StandinHandler)
+        self.data_dir = data_dir
+        self.manifest = manifest
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.import_seconds = import_seconds
+        self.import_rate = import_rate
+        self.fail_rate = fail_rate
+        self.token = token
+        self.random = random.Random(seed)
+
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.jobs = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._active = 0
+        self.stats = {'requests': {}, 'responses': {}, 'injected_errors': 0, 'dropped': 0,
+                      'rejected': 0, 'bytes_in': 0, 'bytes_out': 0, 'peak_concurrent': 0,
+                      'jobs': 0, 'rows_imported': 0}
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, name, amount=1, key=None):
+        """Add amount to stat name, or to entry key of stat name."""
+        with self._lock:
+            if key is None:
+                self.stats[name] += amount
+            else:
+                self.stats[name][key] = self.stats[name].get(key, 0) + amount
+
+    def enter(self):
+        """Start work on a request; return False if there are too many already."""
+        if self.slots and not self.slots.acquire(False):
+            return False
+        with self._lock:
+            self._active += 1
+            self.stats['peak_concurrent'] = max(self.stats['peak_concurrent'], self._active)
+        return True
+
+    def leave(self):
+        with self._lock:
+            self._active -= 1
+        if self.slots:
+            self.slots.release()
+
+    def add_job(self, rows, size):
+        """Record a new import job for an upload of rows rows; return it."""
+        import_seconds = self.import_seconds
+        if self.import_rate:
+            import_seconds += rows / float(self.import_rate)
+        with self._lock:
+            job = ImportJobState(str(next(self._job_ids)), rows, size, import_seconds,
+                                 self.random.random() < self.fail_rate)
+            self.jobs[job.job_id] = job
+            self.stats['jobs'] += 1
+        return job
+
+    def get_stats(self):
+        with self._lock:
+            return json.loads(json.dumps(self.stats))
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Answer one request to the stand-in server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        self.body_read = False
+        url = urlparse.urlparse(self.path)
+        path = url.path
+        self.params = dict(urlparse.parse_qsl(url.query))
+        if path == '/_stats':
+            return self._send_json(200, self.server.get_stats())
+
+        if method == 'POST' and path.rstrip('/') == '/api/dataservice':
+            endpoint, handler = 'dataservice_post', self._post_upload
+        elif method == 'GET' and path.startswith('/api/dataservice/'):
+            endpoint, handler = 'dataservice_status', self._get_job_status
+        elif method == 'GET' and path.rstrip('/') == '/api/missions':
+            endpoint, handler = 'missions', self._get_missions
+        elif method == 'GET' and path.endswith('/query'):
+            endpoint, handler = 'arcgis', self._arcgis_query
+        elif method == 'GET' and path.endswith('/police_inct.zip'):
+            endpoint, handler = 'download', self._get_zipfile
+        else:
+            return self._send_error(404, 'Not found')
+
+        server = self.server
+        server.count('requests', key=endpoint)
+        if not server.enter():
+            server.count('rejected')
+            return self._send_error(429, 'Too many requests', retry_after=1)
+        try:
+            if server.latency or server.jitter:
+                time.sleep(server.latency + server.random.uniform(0, server.jitter))
+            if server.random.random() < server.error_rate:
+                server.count('injected_errors')
+                return self._send_error(server.error_status, 'Injected error', retry_after=1)
+            if endpoint in ('dataservice_post', 'dataservice_status', 'missions') and \
+                server.token and \
+                self.headers.get('Authorization') != 'Token ' + server.token:
+
+                return self._send_error(401, 'Invalid token')
+            handler()
+        finally:
+            server.leave()
+
+    def _post_upload(self):
+        """Take an uploaded CSV, counting its rows without keeping it; start an import job."""
+        reader = _MultipartFileCounter(self.headers.get('Content-Type', ''))
+        for chunk in self._iter_body():
+            reader.feed(chunk)
+        try:
+            reader.close()
+        except ValueError as ex:
+            return self._send_error(400, str(ex))
+
+        job = self.server.add_job(reader.rows, reader.size)
+        logging.info('Import job %s: %d rows, %d bytes%s.', job.job_id, reader.rows,
+                     reader.size, ' (gzipped)' if reader.gzipped else '')
+        self._send_json(202, {'import_job_id': job.job_id})
+
+    def _get_job_status(self):
+        job_id = self.path.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            return self._send_error(404, 'No such import job')
+
+        job.polls += 1
+        code, done = job.status()
+        if not done:
+            return self._send_json(202, {'processing_status': code, 'log': ''})
+        if code == 'COMP':
+            self.server.count('rows_imported', job.rows)
+            log = 'Imported %d rows.' % job.rows
+        else:
+            log = 'Import failed (injected by stand-in server).'
+        self._send_json(200, {'processing_status': code, 'log': log})
+
+    def _get_missions(self):
+        self._send_file(os.path.join(self.server.data_dir, 'missions.json'),
+                        'application/json')
+
+    def _arcgis_query(self):
+        manifest = self.server.manifest
+        if self.params.get('returnCountOnly') == 'true':
+            return self._send_json(200, {'count': manifest['rows']})
+
+        num = int(self.params.get('resultOffset', 0)) // manifest['page_size']
+        path = os.path.join(self.server.data_dir, 'arcgis_pages',
+                            generate.arcgis_page_filename(num))
+        if os.path.isfile(path):
+            self._send_file(path, 'application/json')
+        else:
+            self._send_json(200, {'features': [], 'exceededTransferLimit': False})
+
+    def _get_zipfile(self):
+        path = os.path.join(self.server.data_dir, 'police_inct.zip')
+        stat = os.stat(path)
+        etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag or \
+            (not self.headers.get('If-None-Match') and
+             self.headers.get('If-Modified-Since') == last_modified):
+
+            return self._send_empty(304, {'ETag': etag, 'Last-Modified': last_modified})
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        if match and (not if_range or if_range in (etag, last_modified)):
+            start = min(int(match.group(1)), stat.st_size)
+        self._send_file(path, 'application/zip', start,
+                        {'ETag': etag, 'Last-Modified': last_modified,
+                         'Accept-Ranges': 'bytes'},
+                        drop=self.server.random.random() < self.server.drop_rate)
+
+    def _iter_body(self):
+        """Generate chunks of the request body, whether sent with a length or chunked."""
+        self.body_read = True
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if not size:
+                    # skip any trailers
+                    while self.rfile.readline().strip():
+                        pass
+                    return
+                for chunk in self._read(size):
+                    yield chunk
+                self.rfile.readline()
+        else:
+            for chunk in self._read(int(self.headers.get('Content-Length', 0))):
+                yield chunk
+
+    def _read(self, size):
+        """Generate size bytes of the request body in chunks, keeping to the bandwidth cap."""
+        throttle = _Throttle(self.server.bandwidth)
+        while size > 0:
+            chunk = self.rfile.read(min(size, throttle.chunk_size))
+            if not chunk:
+                raise IOError('request body cut short')
+            size -= len(chunk)
+            self.server.count('bytes_in', len(chunk))
+            throttle.wait(len(chunk))
+            yield chunk
+
+    def _write(self, data):
+        """Write data as the response body, keeping to the bandwidth cap."""
+        throttle = _Throttle(self.server.bandwidth)
+        for pos in xrange(0, len(data), throttle.chunk_size):
+            chunk = data[pos:pos + throttle.chunk_size]
+            self.wfile.write(chunk)
+            self.server.count('bytes_out', len(chunk))
+            throttle.wait(len(chunk))
+
+    def _start_response(self, status, content_type, length, headers=None):
+        self.server.count('responses', key=str(status))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _send_json(self, status, obj, headers=None):
+        body = json.dumps(obj)
+        self._start_response(status, 'application/json', len(body), headers)
+        self._write(body)
+
+    def _send_error(self, status, message, retry_after=None):
+        if self.command == 'POST' and not self.body_read:
+            # take in the body first, or the client gets a broken pipe instead of the answer
+            for _ in self._iter_body():
+                pass
+        headers = {}
+        if retry_after is not None:
+            headers['Retry-After'] = str(retry_after)
+        self._send_json(status, {'detail': message}, headers)
+
+    def _send_empty(self, status, headers):
+        self._start_response(status, 'text/plain', 0, headers)
+
+    def _send_file(self, path, content_type, start=0, headers=None, drop=False):
+        """Send the file at path from byte start; if drop, hang up halfway through."""
+        size = os.path.getsize(path)
+        headers = dict(headers or {})
+        status = 200
+        if start:
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, size - 1, size)
+        self._start_response(status, content_type, size - start, headers)
+
+        stop = start + (size - start) // 2 if drop else size
+        with open(path, 'rb') as f:
+            f.seek(start)
+            throttle = _Throttle(self.server.bandwidth)
+            pos = start
+            while pos < stop:
+                chunk = f.read(min(throttle.chunk_size, stop - pos))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                self.server.count('bytes_out', len(chunk))
+                pos += len(chunk)
+                throttle.wait(len(chunk))
+
+        if drop:
+            self.server.count('dropped')
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        logging.debug('%s - ' + format, self.address_string(), *args)
+
+
+class _Throttle(object):
+    """Keep one transfer to a number of bytes per second, by sleeping between chunks."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.done = 0
+        self.chunk_size = _CHUNK_SIZE
+        if rate:
+            self.chunk_size = max(1, min(_CHUNK_SIZE, int(rate * _THROTTLE_SLICE)))
+
+    def wait(self, size):
+        """Count size bytes sent or taken in, and sleep until they are due."""
+        if not self.rate:
+            return
+        self.done += size
+        ahead = self.start + self.done / self.rate - time.time()
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class _MultipartFileCounter(object):
+    """Count the rows and bytes of the file part of a multipart/form-data body, as it comes.
+
+    Only the file part is looked at, and it has to be the last part, as upload.py sends it.
+    Gzipped files, with a name ending in .gz, are decompressed as they are counted.
+    """
+
+    def __init__(self, content_type):
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match or not content_type.startswith('multipart/form-data'):
+            raise ValueError('Not a multipart/form-data upload')
+        self.tail = '\r\n--' + match.group(1) + '--'
+        self.head = ''
+        self.in_file = False
+        self.held = ''
+        self.gzipped = False
+        self.gunzip = None
+        self.newlines = 0
+        self.size = 0
+        self.last_byte = ''
+
+    def feed(self, data):
+        if not self.in_file:
+            self.head += data
+            match = re.search(r'name="file"; filename="([^"]*)"[^\r]*\r\n(?:[^\r]+\r\n)*\r\n',
+                              self.head)
+            if not match:
+                return
+            self.in_file = True
+            self.gzipped = match.group(1).endswith('.gz')
+            if self.gzipped:
+                self.gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data, self.head = self.head[match.end():], None
+
+        # hold back enough to be sure the closing boundary is not counted as file data
+        data = self.held + data
+        keep = len(self.tail) + 2
+        self.held = data[-keep:]
+        self._count(data[:-keep])
+
+    def close(self):
+        if not self.in_file:
+            raise ValueError('No file in upload')
+        if not self.held.startswith(self.tail):
+            raise ValueError('Upload cut short')
+        if self.gunzip:
+            self._count_plain(self.gunzip.flush())
+
+    @property
+    def rows(self):
+        """Number of data rows: lines, less the header, counting a last line with no end."""
+        lines = self.newlines + (1 if self.last_byte not in ('', '\n') else 0)
+        return max(lines - 1, 0)
+
+    def _count(self, data):
+        if self.gunzip:
+            data = self.gunzip.decompress(data)
+        self._count_plain(data)
+
+    def _count_plain(self, data):
+        if data:
+            self.newlines += data.count('\n')
+            self.size += len(data)
+            self.last_byte = data[-1]
+
+
+def add_server_arguments(parser):
+    """Add options for data, latency, bandwidth and errors of a stand-in server to parser."""
+    parser.add_argument('-d', '--data', dest='data_dir', metavar='DIR',
+                        help="Directory of generated data, made if need be.  Defaults to " +
+                             "'bench_data/<rows>' beside this script.")
+    parser.add_argument('-s', '--size', default='10k', dest='size',
+                        choices=sorted(generate.SIZES),
+                        help="Number of incidents to serve.  Defaults to '10k'.")
+    parser.add_argument('-r', '--rows', type=int, dest='rows',
+                        help='Number of incidents, instead of one of the sizes')
+    parser.add_argument('--latency', type=float, default=0.0, dest='latency',
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--jitter', type=float, default=0.0, dest='jitter',
+                        help='Most extra seconds of latency, picked at random')
+    parser.add_argument('--bandwidth', type=parse_rate, dest='bandwidth', metavar='RATE',
+                        help='Most bytes per second for each request, such as 512k or 10M')
+    parser.add_argument('--error-rate', type=float, default=0.0, dest='error_rate',
+                        help='Share of requests to answer with an error')
+    parser.add_argument('--error-status', type=int, default=503, dest='error_status',
+                        help='HTTP status of injected errors.  Defaults to 503.')
+    parser.add_argument('--drop-rate', type=float, default=0.0, dest='drop_rate',
+                        help='Share of zipfile downloads to cut off halfway through')
+    parser.add_argument('--max-concurrent', type=int, dest='max_concurrent', metavar='N',
+                        help='Most requests to work on at once; more get HTTP status 429')
+    parser.add_argument('--import-seconds', type=float, default=1.0, dest='import_seconds',
+                        help='Seconds an import job takes.  Defaults to 1.')
+    parser.add_argument('--import-rate', type=int, dest='import_rate', metavar='ROWS',
+                        help='Rows per second an import job handles, on top of --import-seconds')
+    parser.add_argument('--fail-rate', type=float, default=0.0, dest='fail_rate',
+                        help='Share of import jobs that fail')
+    parser.add_argument('--token', dest='token',
+                        help='API token to require for the HunchLab endpoints')
+    parser.add_argument('--seed', type=int, dest='seed',
+                        help='Random seed for injected errors and failures')
+
+
+def server_from_args(args, host='127.0.0.1', port=0):
+    """Make the data named by args from add_server_arguments if need be; return a server."""
+    num_rows = args.rows or generate.SIZES[args.size]
+    data_dir = args.data_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'bench_data', str(num_rows))
+    manifest = generate.ensure_data(data_dir, num_rows)
+    return StandinServer(data_dir, manifest, host, port, latency=args.latency,
+                         jitter=args.jitter, bandwidth=args.bandwidth,
+                         error_rate=args.error_rate, error_status=args.error_status,
+                         drop_rate=args.drop_rate, max_concurrent=args.max_concurrent,
+                         import_seconds=args.import_seconds, import_rate=args.import_rate,
+                         fail_rate=args.fail_rate, token=args.token, seed=args.seed)
+
+
+def start_in_thread(server):
+    """Serve requests from a daemon thread; return the thread."""
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def main():
+    desc = 'Serve stand-ins for the HunchLab API, ArcGIS queries and the incident download.'
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('--host', default='127.0.0.1', dest='host',
+                        help="Address to listen on.  Defaults to '127.0.0.1'.")
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, dest='port',
+                        help='Port to listen on.  Defaults to %d.' % DEFAULT_PORT)
+    add_server_arguments(parser)
+    parser.add_argument('-l', '--log-level', default='info', dest='log_level',
+                        help="Log level for console output.  Defaults to 'info'.",
+                        choices=['debug', 'info', 'warning', 'error', 'critical'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    server = server_from_args(args, args.host, args.port)
+    logging.info('Serving on %s', server.url)
+    logging.info('For upload.py and geojson_to_shp.py, set BaseURL: %s in config.ini.',
+                 server.url)
+    logging.info('Incident zipfile: %s/police_inct.zip', server.url)
+    logging.info('ArcGIS query: %s/query', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info('Stats: %s', json.dumps(server.get_stats(), sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Configuration, logging and HTTP sessions shared by the upload, fetch and missions scripts.
+
+This module is quick to import: requests is only loaded when a session is made, so a script
+can print its help, or report a missing configuration file, without waiting for it.  The
+sessions themselves are set up in http_client.py.
+"""
+
+import ConfigParser
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+# format of the date/times in log files
+LOG_DATE_FORMAT = '%Y-%m-%d %I:%M:%S %p'
+# responses that mean the server is busy or briefly unavailable, so try again later
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def config_section_map(config, section):
+    """Return dictionary of the options in section of ConfigParser config."""
+    result = {}
+    options = config.options(section)
+    for option in options:
+        try:
+            result[option] = config.get(section, option)
+            if result[option] == -1:
+                logging.info('skip: %s', option)
+        except Exception:
+            logging.error('exception on %s!', option)
+            result[option] = None
+    return result
+
+
+def read_server_config(config_path):
+    """Return dictionary of the options in the Server section of config file config_path.
+
+    Raises ValueError if the file cannot be read, or has no Server section.
+    """
+    config = ConfigParser.ConfigParser()
+    if not config.read(config_path):
+        raise ValueError("Couldn't read configuration file %s." % config_path)
+    if not config.has_section('Server'):
+        raise ValueError('No Server section in configuration file %s.' % config_path)
+    return config_section_map(config, 'Server')
+
+
+def setup_logging(log_filename, log_level, threads=False):
+    """Log everything to log_filename, and messages of log_level and up to the console.
+
+    Arguments:
+    log_filename -- file to log to
+    log_level    -- name of the lowest level to show on the console, like 'info'
+    threads      -- if True, label each line with the name of the thread logging it
+    """
+    file_format = '%(asctime)s %(levelname)s: %(message)s'
+    console_format = '%(message)s'
+    if threads:
+        file_format = '%(asctime)s %(levelname)s [%(threadName)s]: %(message)s'
+        console_format = '[%(threadName)s] %(message)s'
+
+    # set up file logger
+    logging.basicConfig(filename=log_filename, level=logging.DEBUG, format=file_format,
+                        datefmt=LOG_DATE_FORMAT)
+
+    # add logger handler for console output
+    console = logging.StreamHandler()
+    console.setLevel(getattr(logging, log_level.upper()))
+    console.setFormatter(logging.Formatter(console_format))
+    # add the handler to the root logger
+    logging.getLogger('').addHandler(console)
+
+
+class _PoolFullFilter(logging.Filter):
+    """Drop urllib3's warnings of a connection put back in a full pool, from some threads."""
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        # identities of the threads whose warnings to drop
+        self.threads = set()
+
+    def filter(self, record):
+        return record.thread not in self.threads or \
+            'is full, discarding connection' not in str(record.msg)
+
+
+_pool_full_filter = _PoolFullFilter()
+logging.getLogger('requests.packages.urllib3.connectionpool').addFilter(_pool_full_filter)
+
+
+@contextmanager
+def ignore_pool_full(ignore=True):
+    """Drop urllib3's "pool is full" warnings logged by this thread within the block, if ignore.
+
+    requests 2.2.1 puts the connection of a request with a chunked body back in the pool as
+    soon as the response arrives, then again once the response has been read.  The second
+    time finds the connection already there and warns that the pool is full, though nothing
+    is wrong.
+    """
+    if not ignore:
+        yield
+        return
+    ident = threading.current_thread().ident
+    _pool_full_filter.threads.add(ident)
+    try:
+        yield
+    finally:
+        _pool_full_filter.threads.discard(ident)
+
+
+class TokenAuth(object):
+    """Attaches HTTP Token Authentication to the given Request object."""
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, r):
+        # modify and return the request
+        r.headers['Authorization'] = 'Token ' + self.token
+        return r
+
+
+def make_session(token=None, verify=True, **kwargs):
+    """Return a requests session, authenticating with HunchLab API token token if given.
+
+    verify is passed on to requests: True to check the server's certificate against the usual
+    certificate authorities, or the path of a certificate authority bundle to check it against.
+    Other keyword arguments, such as pool_maxsize, are as for http_client.make_session.
+    """
+    import http_client
+    return http_client.make_session(token, verify, **kwargs)
+
+
+def retry_after(response):
+    """Return seconds the response's Retry-After header asks to wait, or None."""
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    # a date; email.utils is slow to load, and few servers send one
+    from email.utils import mktime_tz, parsedate_tz
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        logging.debug('Ignoring unreadable Retry-After header: %s', value)
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
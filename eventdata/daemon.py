@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""Run jobs on a schedule in one long-running process, with a health endpoint on localhost.
+
+Each job runs in a thread of its own, every so many seconds, so a run never starts while the
+job's previous run is still going; slots missed because a run took too long are skipped, not
+made up.  Whatever a job keeps between runs, such as HTTP sessions, timezones and open
+databases, stays warm, instead of being set up again by a new process each time.
+
+The health endpoint answers:
+
+    /health  -- JSON of each job's last run: when it started, how long it took, whether it
+                succeeded, and how far behind schedule the job is.  The status is 503 if a
+                job's last run failed, or the job is a whole interval behind.
+    /metrics -- the same as Prometheus text, followed by the metrics recorded by the metrics
+                module, if they are on
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import signal
+import threading
+import time
+
+import metrics
+
+# host the health endpoint listens on; only this machine can reach it
+HEALTH_HOST = '127.0.0.1'
+
+
+class Job(object):
+    """A function run every so often, and how its runs have gone."""
+
+    def __init__(self, name, func, interval):
+        """Arguments:
+        name     -- name of the job, for log lines and the health endpoint
+        func     -- function to run, with no arguments; returns true if the run succeeded
+        interval -- seconds from the start of one run to the start of the next
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.running = False
+        # time the last run started, its seconds, whether it succeeded, and the seconds it
+        # started after it was due
+        self.last_start = None
+        self.last_seconds = None
+        self.last_ok = None
+        self.last_delay = None
+        self.next_due = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def run_forever(self, stop):
+        """Run the job when it is due, until threading.Event stop is set."""
+        self.next_due = time.time()
+        while not stop.is_set():
+            wait = self.next_due - time.time()
+            if wait > 0:
+                stop.wait(wait)
+                continue
+
+            self.run_once()
+
+            # the next slot after now; those passed while the run went on are skipped
+            now = time.time()
+            self.next_due += self.interval
+            if self.next_due <= now:
+                missed = int((now - self.next_due) // self.interval) + 1
+                logging.warning('Run of %s took longer than its interval; skipping %d run(s).',
+                                self.name, missed)
+                with self._lock:
+                    self.skipped += missed
+                self.next_due += missed * self.interval
+
+    def run_once(self):
+        """Run the job now; return whether it succeeded."""
+        start = time.time()
+        with self._lock:
+            self.running = True
+            self.last_start = start
+            self.last_delay = max(start - self.next_due, 0.0) if self.next_due else 0.0
+
+        logging.info('Starting run of %s.', self.name)
+        try:
+            ok = bool(self.func())
+        except Exception as ex:
+            logging.error('Run of %s failed.', self.name)
+            logging.exception(ex)
+            ok = False
+
+        seconds = time.time() - start
+        with self._lock:
+            self.running = False
+            self.runs += 1
+            self.last_seconds = seconds
+            self.last_ok = ok
+            if not ok:
+                self.failures += 1
+        logging.info('Run of %s %s in %.1f seconds.', self.name,
+                     'succeeded' if ok else 'did not succeed', seconds)
+        metrics.write()
+        return ok
+
+    def status(self, now):
+        """Return dictionary of how the job's runs have gone, as of time now."""
+        with self._lock:
+            # how long the next run has been due without starting; while a run goes on, that
+            # is the slot after the one it is running for
+            due = self.next_due
+            if due and self.running:
+                due += self.interval
+            lag = max(now - due, 0.0) if due else 0.0
+            return {'interval_seconds': self.interval,
+                    'running': self.running,
+                    'runs': self.runs,
+                    'failures': self.failures,
+                    'skipped_runs': self.skipped,
+                    'last_start': _iso_time(self.last_start),
+                    'last_run_seconds': self.last_seconds,
+                    'last_run_ok': self.last_ok,
+                    'last_start_delay_seconds': self.last_delay,
+                    'next_due': _iso_time(self.next_due),
+                    'lag_seconds': lag}
+
+    def healthy(self, now):
+        """Return whether the last run succeeded and the job is keeping to its schedule."""
+        status = self.status(now)
+        return status['last_run_ok'] is not False and status['lag_seconds'] < self.interval
+
+
+def _iso_time(when):
+    if when is None:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(when))
+
+
+class Daemon(object):
+    """Run jobs on their schedules until stopped, answering health checks meanwhile."""
+
+    def __init__(self, name, health_port=None):
+        """Arguments:
+        name        -- name of the daemon, for the Prometheus labels
+        health_port -- port for the health endpoint on localhost; no endpoint if not given
+        """
+        self.name = name
+        self.health_port = health_port
+        self.jobs = []
+        self.started = None
+        self._stop = threading.Event()
+        self._server = None
+
+    def add_job(self, name, func, interval):
+        """Run func every interval seconds, starting as soon as the daemon runs."""
+        self.jobs.append(Job(name, func, interval))
+
+    def run(self):
+        """Run the jobs until stop is called or the process is told to stop.
+
+        Runs in progress are left to finish.  Call from the main thread.
+        """
+        self.started = time.time()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self._on_signal)
+        if self.health_port:
+            self._start_health_server()
+
+        for job in self.jobs:
+            job.thread = threading.Thread(target=job.run_forever, args=(self._stop,),
+                                          name=job.name)
+            job.thread.start()
+            logging.info('Running %s every %d seconds.', job.name, job.interval)
+
+        # wait with a timeout, so signals are handled
+        while not self._stop.is_set():
+            self._stop.wait(1)
+
+        logging.info('Stopping; waiting for runs in progress to finish...')
+        for job in self.jobs:
+            job.thread.join()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        logging.info('Stopped.')
+
+    def stop(self):
+        self._stop.set()
+
+    def _on_signal(self, signum, frame):
+        logging.info('Got signal %d.', signum)
+        self.stop()
+
+    def _start_health_server(self):
+        self._server = HTTPServer((HEALTH_HOST, self.health_port), _HealthHandler)
+        self._server.daemon = self
+        thread = threading.Thread(target=self._server.serve_forever, name='health')
+        thread.daemon = True
+        thread.start()
+        logging.info('Health endpoint at http://%s:%d/health', HEALTH_HOST, self.health_port)
+
+    def status(self):
+        """Return dictionary of the status of the daemon and each of its jobs."""
+        now = time.time()
+        return {'started': _iso_time(self.started),
+                'uptime_seconds': now - self.started if self.started else 0.0,
+                'healthy': self.healthy(),
+                'jobs': dict((job.name, job.status(now)) for job in self.jobs)}
+
+    def healthy(self):
+        now = time.time()
+        return all(job.healthy(now) for job in self.jobs)
+
+    def prometheus_text(self):
+        """Return the status of the jobs, and the metrics recorded, as Prometheus text."""
+        now = time.time()
+        statuses = [(job.name, job.status(now)) for job in self.jobs]
+        lines = []
+
+        def metric(name, kind, help_text, key, convert=float):
+            full_name = '%s_daemon_%s' % (metrics.PREFIX, name)
+            lines.append('# HELP %s %s' % (full_name, help_text))
+            lines.append('# TYPE %s %s' % (full_name, kind))
+            for job_name, status in statuses:
+                if status[key] is not None:
+                    lines.append('%s{daemon="%s",job="%s"} %s' % (
+                        full_name, self.name, job_name, repr(convert(status[key]))))
+
+        metric('runs_total', 'counter', 'Runs of each job.', 'runs', int)
+        metric('failures_total', 'counter', 'Runs of each job that did not succeed.',
+               'failures', int)
+        metric('skipped_runs_total', 'counter',
+               'Runs of each job skipped because the one before was still going.',
+               'skipped_runs', int)
+        metric('running', 'gauge', 'Whether each job is running now.', 'running', int)
+        metric('last_run_seconds', 'gauge', 'Seconds the last run of each job took.',
+               'last_run_seconds')
+        metric('last_run_ok', 'gauge', 'Whether the last run of each job succeeded.',
+               'last_run_ok', int)
+        metric('lag_seconds', 'gauge', 'Seconds the next run of each job is overdue.',
+               'lag_seconds')
+        return '\n'.join(lines) + '\n' + metrics.prometheus_text()
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    """Answer health checks with the status of the daemon the server belongs to."""
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        path = self.path.split('?')[0]
+        if path == '/health':
+            body = json.dumps(daemon.status(), indent=2, sort_keys=True) + '\n'
+            self._send(200 if daemon.healthy() else 503, 'application/json', body)
+        elif path == '/metrics':
+            self._send(200, 'text/plain; version=0.0.4', daemon.prometheus_text())
+        else:
+            self._send(404, 'text/plain', 'Not found\n')
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Health endpoint: ' + format, *args)
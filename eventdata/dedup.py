@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""On-disk store of event rows already imported into HunchLab, kept in a SQLite database.
+
+Holds a hash of each row imported, keyed by datasource and id, so that a CSV can be cut down
+to the rows that are new or have changed before it is uploaded.  Also holds the content hash
+of each whole file imported, so that a file sent before can be skipped without reading it.
+
+Hashes of the rows in a file are held apart as pending until the file's import completes,
+so rows from a failed upload are sent again next time.
+"""
+
+import csv
+from datetime import datetime
+import hashlib
+from itertools import islice
+import logging
+import sqlite3
+
+import metrics
+from validator import open_csv
+
+# rows to look up at a time; SQLite allows at most 999 parameters per statement
+_LOOKUP_BATCH = 900
+# rows of CSV to read at a time
+_BLOCK_SIZE = 10000
+# columns left out of a row's hash, as they can change without the event changing
+_UNHASHED_COLUMNS = ('last_updated',)
+
+
+class DedupStore(object):
+    """Store of datasource and id keys to hashes of the rows imported for them."""
+
+    def __init__(self, path):
+        """Open (or create) the store database at path."""
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rows '
+                          '(key TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pending '
+                          '(file TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pending_file ON pending (file)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files '
+                          '(hash TEXT PRIMARY KEY, imported TEXT NOT NULL)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def file_imported(self, file_hash):
+        """Return whether a file with content hash file_hash was imported before."""
+        return self.conn.execute('SELECT 1 FROM files WHERE hash = ?',
+                                 (file_hash,)).fetchone() is not None
+
+    def filter_csv(self, path, out_path, file_hash):
+        """Write the rows of CSV file path that are new or changed to out_path.
+
+        The hashes of those rows are kept as pending for the file with content hash
+        file_hash, until commit_file is called for it.  Returns the number of rows written.
+        """
+        new_ct = changed_ct = unchanged_ct = 0
+        self.conn.execute('DELETE FROM pending WHERE file = ?', (file_hash,))
+
+        with metrics.span('dedup', file=path), open_csv(path) as inf, \
+                open(out_path, 'wb') as outf:
+            rdr = csv.reader(inf)
+            wr = csv.writer(outf)
+            header = next(rdr, [])
+            wr.writerow(header)
+            if 'datasource' not in header or 'id' not in header:
+                raise ValueError('%s needs datasource and id columns' % path)
+
+            source_col = header.index('datasource')
+            id_col = header.index('id')
+            # hash columns in name order, so that files with columns in another order agree
+            hash_cols = [header.index(col) for col in sorted(header)
+                         if col not in _UNHASHED_COLUMNS]
+
+            while True:
+                block = [ln for ln in islice(rdr, _BLOCK_SIZE) if ln]
+                if not block:
+                    break
+
+                keys = [ln[source_col] + '\x1f' + ln[id_col] for ln in block]
+                hashes = [hashlib.sha1('\x1f'.join(ln[i] for i in hash_cols)).hexdigest()
+                          for ln in block]
+                known = self._lookup(keys)
+
+                pending = []
+                for ln, key, row_hash in zip(block, keys, hashes):
+                    old_hash = known.get(key)
+                    if old_hash == row_hash:
+                        unchanged_ct += 1
+                        continue
+                    elif old_hash is None:
+                        new_ct += 1
+                    else:
+                        changed_ct += 1
+                    pending.append((file_hash, key, row_hash))
+                    wr.writerow(ln)
+
+                self.conn.executemany('INSERT INTO pending (file, key, hash) VALUES (?, ?, ?)',
+                                      pending)
+
+        self.conn.commit()
+        logging.info('%s has %d new, %d changed and %d already imported rows.', path, new_ct,
+                     changed_ct, unchanged_ct)
+        metrics.incr('rows_new', new_ct)
+        metrics.incr('rows_changed', changed_ct)
+        metrics.incr('rows_already_imported', unchanged_ct)
+        return new_ct + changed_ct
+
+    def commit_file(self, file_hash):
+        """Record the pending rows of the file with content hash file_hash as imported."""
+        self.conn.execute('INSERT OR REPLACE INTO rows (key, hash) '
+                          'SELECT key, hash FROM pending WHERE file = ?', (file_hash,))
+        self.conn.execute('DELETE FROM pending WHERE file = ?', (file_hash,))
+        self.conn.execute('INSERT OR REPLACE INTO files (hash, imported) VALUES (?, ?)',
+                          (file_hash, datetime.now().strftime('%Y-%m-%dT%H:%M:%S')))
+        self.conn.commit()
+
+    def _lookup(self, keys):
+        """Return dictionary of the hashes stored for any of the given keys."""
+        found = {}
+        keys = list(set(keys))
+        for start in xrange(0, len(keys), _LOOKUP_BATCH):
+            batch = keys[start:start + _LOOKUP_BATCH]
+            query = 'SELECT key, hash FROM rows WHERE key IN (%s)' % ','.join('?' * len(batch))
+            found.update(self.conn.execute(query, batch))
+        return found
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""HTTP sessions for the fetch, upload and missions scripts, all set up the same way.
+
+Sessions made by make_session:
+
+    pool     -- keep connections to each host open, to reuse from one request to the next
+    retries  -- retry idempotent requests (GET, HEAD, OPTIONS, PUT, DELETE) that cannot
+                connect, time out, or get a status in TRANSIENT_STATUS_CODES back, waiting
+                BACKOFF, then twice as long each time, up to MAX_BACKOFF seconds, or as long
+                as a Retry-After header asks.  POSTs are never retried, as the server may
+                have acted on them.
+    gzip     -- ask for responses gzipped or deflated
+    timeout  -- give up on a request the server has not answered in DEFAULT_TIMEOUT seconds,
+                unless it is given a timeout of its own.  A timeout of (connect, None) waits
+                connect seconds to connect, then as long as the server takes to answer.
+    timing   -- call each of the session's timing hooks with the time of every attempt; the
+                first records it with metrics, as the http_request stage
+
+Use common.make_session, which only imports this module, and requests, when it is called.
+"""
+
+import logging
+import random
+import time
+from urlparse import urlsplit
+
+import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+from common import TRANSIENT_STATUS_CODES, TokenAuth, retry_after
+import metrics
+
+# seconds to wait for the server to respond, for requests not given a timeout
+DEFAULT_TIMEOUT = 60
+# times to retry an idempotent request, and seconds to wait before the first retry
+RETRIES = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# methods that can be sent again without changing anything more on the server
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class RetryAdapter(HTTPAdapter):
+    """Transport adapter adding retries, a default timeout and timing hooks to its requests."""
+
+    def __init__(self, retries=RETRIES, backoff=BACKOFF, timeout=DEFAULT_TIMEOUT, **kwargs):
+        """Arguments:
+        retries -- times to retry an idempotent request that failed
+        backoff -- seconds to wait before the first retry; doubled for each one after
+        timeout -- seconds to wait for the server, for requests not given a timeout
+        Other keyword arguments, such as pool_maxsize, are passed on to HTTPAdapter.
+        """
+        HTTPAdapter.__init__(self, **kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # functions called as hook(request, response, seconds, attempt) after each attempt;
+        # response is None if it failed without one
+        self.timing_hooks = [_record_timing]
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        # requests 2.2.1 takes one timeout, for connecting and reading, but only connecting is
+        # timed for a streamed response; such a response is read below if it was not to be
+        # streamed, as HTTPAdapter.send reads one
+        send_stream = stream
+        if isinstance(timeout, tuple):
+            timeout, read_timeout = timeout
+            if read_timeout is not None:
+                raise ValueError('Only a timeout of (connect, None) can be given as a pair.')
+            send_stream = True
+        retries = self.retries if request.method in IDEMPOTENT_METHODS else 0
+
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = HTTPAdapter.send(self, request, stream=send_stream,
+                                            timeout=timeout, **kwargs)
+            except requests.exceptions.SSLError:
+                # a certificate that does not verify will not on the next try either
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                self._call_hooks(request, None, time.time() - start, attempt)
+                if attempt >= retries:
+                    raise
+                delay = self._delay(attempt, None)
+                logging.warning('%s %s failed: %s.  Trying again in %.1f seconds.',
+                                request.method, _host(request.url), ex, delay)
+            else:
+                self._call_hooks(request, response, time.time() - start, attempt)
+                if response.status_code not in TRANSIENT_STATUS_CODES or attempt >= retries:
+                    if send_stream and not stream:
+                        response.content  # read it all, and let the connection go
+                    return response
+                delay = self._delay(attempt, retry_after(response))
+                logging.warning('%s %s got status %d.  Trying again in %.1f seconds.',
+                                request.method, _host(request.url), response.status_code,
+                                delay)
+                # let the connection go back to the pool
+                response.close()
+
+            metrics.incr('http_retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def _delay(self, attempt, asked):
+        """Return seconds to wait before retry attempt + 1, or as long as the server asked."""
+        if asked is not None:
+            return min(asked, MAX_BACKOFF)
+        delay = min(self.backoff * 2 ** attempt, MAX_BACKOFF)
+        # random in the upper half, so clients that failed together do not retry together
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def _call_hooks(self, request, response, seconds, attempt):
+        for hook in self.timing_hooks:
+            try:
+                hook(request, response, seconds, attempt)
+            except Exception as ex:
+                logging.debug('HTTP timing hook failed: %s', ex)
+
+
+def _host(url):
+    return urlsplit(url).netloc
+
+
+def _record_timing(request, response, seconds, attempt):
+    """Record the time of one attempt at a request with metrics."""
+    metrics.record('http_request', seconds, method=request.method, host=_host(request.url),
+                   status=response.status_code if response is not None else None,
+                   attempt=attempt)
+
+
+def make_session(token=None, verify=True, pool_connections=DEFAULT_POOLSIZE,
+                 pool_maxsize=DEFAULT_POOLSIZE, retries=RETRIES, timeout=DEFAULT_TIMEOUT,
+                 timing_hooks=()):
+    """Return a requests session set up as described above.
+
+    Arguments:
+    token            -- HunchLab API token to authenticate with, if any
+    verify           -- True to check servers' certificates against the usual certificate
+                        authorities, or the path of a certificate authority bundle
+    pool_connections -- number of hosts to keep connections open to
+    pool_maxsize     -- connections to keep open to each host; at least the number of
+                        threads sending requests with the session at once
+    retries          -- times to retry an idempotent request that failed
+    timeout          -- seconds to wait for the server, for requests not given a timeout
+    timing_hooks     -- functions to call as hook(request, response, seconds, attempt)
+                        after each attempt at a request, besides recording it with metrics
+    """
+    s = requests.Session()
+    adapter = RetryAdapter(retries=retries, timeout=timeout, pool_connections=pool_connections,
+                           pool_maxsize=pool_maxsize)
+    adapter.timing_hooks.extend(timing_hooks)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.headers['Accept-Encoding'] = 'gzip, deflate'
+    if token:
+        s.auth = TokenAuth(token)
+    s.verify = verify
+    return s
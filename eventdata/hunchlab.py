@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""One command for the HunchLab scripts:
+
+    hunchlab upload ...        -- upload events CSV to HunchLab (upload.py)
+    hunchlab fetch-philly ...  -- fetch Philadelphia crime data and upload it
+                                  (../fetchdata/fetch_philly_crime_data.py)
+    hunchlab missions ...      -- convert missions to Shapefile
+                                  (../geojson_to_shp/geojson_to_shp.py)
+
+Each subcommand takes the same options as its script; `hunchlab COMMAND --help` lists them.
+Only the script for the subcommand given is imported, and the scripts load requests, pytz,
+dateutil, tzlocal and NumPy only once they need them, so the help, and errors in the options
+or the configuration file, come back without waiting for them.
+"""
+
+from argparse import ArgumentParser
+import os
+import sys
+
+# subcommand, directory of its script, module of its script, and what it does
+COMMANDS = [
+    ('upload', 'eventdata', 'upload', 'Upload events CSV to HunchLab.'),
+    ('fetch-philly', 'fetchdata', 'fetch_philly_crime_data',
+     'Download crime data for Philadelphia and upload it to HunchLab.'),
+    ('missions', 'geojson_to_shp', 'geojson_to_shp',
+     'Download missions GeoJSON from HunchLab and convert to Shapefile.'),
+]
+
+
+def main(argv=None):
+    """Run the subcommand named by the first of argv; return its exit status.
+
+    Arguments:
+    argv -- command-line arguments; defaults to those the script was run with
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    scripts = dict((name, (directory, module)) for name, directory, module, _ in COMMANDS)
+
+    if not argv or argv[0] not in scripts:
+        parser = ArgumentParser(prog='hunchlab', description='Run one of the HunchLab scripts.')
+        subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+        for name, _, _, desc in COMMANDS:
+            subparsers.add_parser(name, help=desc)
+        # prints the help, or what is wrong with the command, and exits
+        parser.parse_args(argv[:1])
+
+    command = argv[0]
+    directory, module_name = scripts[command]
+    if not getattr(sys, 'frozen', False):
+        # frozen by py2exe, the scripts are bundled in with this one
+        repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+        sys.path.insert(0, os.path.join(repo_dir, directory))
+    module = __import__(module_name)
+    return module.main(argv[1:], prog='hunchlab ' + command)
+
+
+if __name__ == '__main__':
+    """If run from the command line."""
+    sys.exit(main())
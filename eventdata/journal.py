@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Append-only journal of CSV files uploaded to HunchLab and what became of their imports.
+
+Each line is a JSON record of a file's content hash, its path, the import job ID it was given
+and its status: 'Posted' while the import is running, then the final processing status.  The
+last record for a file hash wins.  Records are flushed to disk as they are written, so after
+a crash a later run can skip files that were imported and pick up jobs still in flight.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# status recorded for a file that was posted but whose import has not finished yet
+POSTED = 'Posted'
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadJournal(object):
+    """Journal of uploads, keyed by file content hash."""
+
+    def __init__(self, path):
+        """Open (or create) the journal at path, reading the records already in it."""
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(path):
+            # end of the last whole line; a crash while writing may leave part of a line after it
+            end = 0
+            with open(path, 'rb') as f:
+                for line_no, line in enumerate(f, 1):
+                    if not line.endswith('\n'):
+                        logging.warning('Dropping unfinished last line %d of journal %s.',
+                                        line_no, path)
+                        break
+                    end += len(line)
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['hash']] = entry
+                    except (ValueError, TypeError, KeyError):
+                        logging.warning('Skipping unreadable line %d of journal %s.',
+                                        line_no, path)
+            if end < os.path.getsize(path):
+                # so the next record starts on a line of its own
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+            logging.info('Read %d files from journal %s.', len(self.entries), path)
+
+        self._file = open(path, 'ab')
+
+    def close(self):
+        self._file.close()
+
+    def get(self, file_hash):
+        """Return the latest record for the file with content hash file_hash, or None."""
+        with self._lock:
+            return self.entries.get(file_hash)
+
+    def record(self, file_hash, path, import_job_id, status):
+        """Append a record for a file, and make sure it is on disk before returning."""
+        entry = {'hash': file_hash, 'file': path, 'import_job_id': import_job_id,
+                 'status': status, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with self._lock:
+            self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.entries[file_hash] = entry
+
+
+def file_hash(path):
+    """Return the SHA-1 hex digest of the contents of the file at path."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""Timings and counts of the stages of a run, for the fetch, upload and missions scripts.
+
+Stages are timed with spans, and with timed iterators for stages that run as generators.
+Spans nest: each records its own time and its time less that of the spans inside it, so the
+stages of a pipeline of generators can be told apart.  Counters and gauges hold numbers such as
+rows converted and bytes sent.
+
+Nothing is recorded until configure is called; until then span returns a shared do-nothing
+object and timed_iter returns its iterable as it is, so leaving the calls in costs next to
+nothing.  When the script exits, everything recorded is written to the metrics file: as a
+Prometheus textfile (for the node_exporter textfile collector) if its name ends in .prom,
+otherwise as JSON lines appended to it.  A long-running process calls write after each run as
+well; spans are only written once, and counters and gauges are written as they stand.
+"""
+
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# prefix of Prometheus metric names
+PREFIX = 'hunchlab'
+
+_recorder = None
+
+
+class _NullSpan(object):
+    """Span that records nothing, handed out while metrics are off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Frame(object):
+    """Entry on a thread's stack of running spans, adding up the time of spans within it."""
+
+    __slots__ = ('child_seconds',)
+
+    def __init__(self):
+        self.child_seconds = 0.0
+
+
+class Span(object):
+    """Time one run of a stage, from entering the span to leaving it."""
+
+    def __init__(self, recorder, name, attrs):
+        self.recorder = recorder
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.child_seconds = 0.0
+
+    def __enter__(self):
+        self.recorder.push(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.time() - self.start
+        self.recorder.pop(self, seconds)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.recorder.add_span(self.name, seconds, seconds - self.child_seconds, 1,
+                               self.attrs)
+        return False
+
+    def set(self, **attrs):
+        """Add attributes to record with the span, such as sizes found out while it ran."""
+        self.attrs.update(attrs)
+
+
+class Recorder(object):
+    """Collect spans, counters and gauges for one run, and write them to a metrics file."""
+
+    def __init__(self, path, script):
+        """Arguments:
+        path   -- metrics file; Prometheus textfile if it ends in .prom, else JSON lines
+        script -- name of the script, recorded with every metric
+        """
+        self.path = path
+        self.script = script
+        self.prometheus = path.endswith('.prom')
+        self.run_id = os.urandom(6).encode('hex')
+        self.started = time.time()
+        # stage name to [calls, seconds, self seconds, most seconds, items]
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def push(self, span):
+        stack = self._stack()
+        stack.append(span)
+
+    def pop(self, span, seconds):
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        if stack:
+            stack[-1].child_seconds += seconds
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def add_span(self, name, seconds, self_seconds, calls, attrs, items=None):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0, 0.0, 0])
+            stage[0] += calls
+            stage[1] += seconds
+            stage[2] += self_seconds
+            stage[3] = max(stage[3], seconds / calls if calls else seconds)
+            if items:
+                stage[4] += items
+            if not self.prometheus:
+                event = {'type': 'span', 'name': name, 'seconds': round(seconds, 6),
+                         'self_seconds': round(self_seconds, 6)}
+                if calls != 1:
+                    event['calls'] = calls
+                if items is not None:
+                    event['items'] = items
+                    if seconds:
+                        event['items_per_sec'] = round(items / seconds, 1)
+                event.update(attrs)
+                self.events.append(event)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def write(self):
+        """Write everything recorded to the metrics file."""
+        with self._lock:
+            if self.prometheus:
+                self._write_prometheus()
+            else:
+                self._write_json_lines()
+                # each span is written once, however many times write is called
+                del self.events[:]
+
+    def _write_json_lines(self):
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        common = {'time': now, 'script': self.script, 'run': self.run_id}
+        records = list(self.events)
+        records.extend({'type': 'counter', 'name': name, 'value': value}
+                       for name, value in sorted(self.counters.items()))
+        records.extend({'type': 'gauge', 'name': name, 'value': value}
+                       for name, value in sorted(self.gauges.items()))
+        records.append({'type': 'run', 'seconds': round(time.time() - self.started, 6)})
+        with open(self.path, 'ab') as f:
+            for record in records:
+                record.update(common)
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def prometheus_text(self):
+        """Return everything recorded so far as Prometheus text."""
+        with self._lock:
+            return '\n'.join(self._prometheus_lines()) + '\n'
+
+    def _prometheus_lines(self):
+        label = '{script="%s"}' % self.script
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (PREFIX, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (PREFIX, name, kind))
+            for labels, value in samples:
+                lines.append('%s_%s%s %s' % (PREFIX, name, labels, _format_value(value)))
+
+        def stage_samples(pos):
+            return [('{script="%s",stage="%s"}' % (self.script, name), stage[pos])
+                    for name, stage in sorted(self.stages.items())]
+
+        if self.stages:
+            metric('stage_calls_total', 'counter', 'Times each stage ran.', stage_samples(0))
+            metric('stage_seconds_total', 'counter',
+                   'Seconds spent in each stage, including stages within it.',
+                   stage_samples(1))
+            metric('stage_self_seconds_total', 'counter',
+                   'Seconds spent in each stage, less stages within it.', stage_samples(2))
+            metric('stage_max_seconds', 'gauge', 'Longest single run of each stage.',
+                   stage_samples(3))
+            items = [sample for sample in stage_samples(4) if sample[1]]
+            if items:
+                metric('stage_items_total', 'counter', 'Items each stage handled.', items)
+
+        for name, value in sorted(self.counters.items()):
+            metric(_metric_name(name) + '_total', 'counter', name.replace('_', ' ') + '.',
+                   [(label, value)])
+        for name, value in sorted(self.gauges.items()):
+            metric(_metric_name(name), 'gauge', name.replace('_', ' ') + '.',
+                   [(label, value)])
+        metric('run_seconds', 'gauge', 'Seconds the run took.',
+               [(label, time.time() - self.started)])
+        metric('run_timestamp_seconds', 'gauge', 'Time the run finished.',
+               [(label, time.time())])
+        return lines
+
+    def _write_prometheus(self):
+        lines = self._prometheus_lines()
+        # write to a temporary file first, so the collector never reads half a file
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+        if os.path.exists(self.path) and os.name == 'nt':
+            os.remove(self.path)  # Windows will not rename over it
+        os.rename(tmp_path, self.path)
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def configure(path, script):
+    """Start recording metrics for script, to be written to path when the script exits.
+
+    Arguments:
+    path   -- metrics file; Prometheus textfile if it ends in .prom, else JSON lines
+    script -- name of the script, recorded with every metric
+    """
+    global _recorder
+    _recorder = Recorder(path, script)
+    atexit.register(_write_recorder, _recorder)
+    return _recorder
+
+
+def _write_recorder(recorder):
+    try:
+        recorder.write()
+    except (IOError, OSError) as ex:
+        logging.error('Could not write metrics to %s: %s', recorder.path, ex)
+
+
+def enabled():
+    """Return whether metrics are being recorded."""
+    return _recorder is not None
+
+
+def write():
+    """Write everything recorded so far to the metrics file, if metrics are being recorded."""
+    if _recorder is not None:
+        _write_recorder(_recorder)
+
+
+def prometheus_text():
+    """Return everything recorded so far as Prometheus text, or '' if metrics are off."""
+    if _recorder is None:
+        return ''
+    return _recorder.prometheus_text()
+
+
+def span(name, **attrs):
+    """Return a context manager timing stage name; attrs are recorded with it in JSON lines."""
+    if _recorder is None:
+        return _NULL_SPAN
+    return Span(_recorder, name, attrs)
+
+
+def record(name, seconds, **attrs):
+    """Record stage name as having taken seconds, timed by the caller rather than by a span.
+
+    It counts as within the span open in the thread, if any, as a span would.
+    """
+    if _recorder is None:
+        return
+    stack = _recorder._stack()
+    if stack:
+        stack[-1].child_seconds += seconds
+    _recorder.add_span(name, seconds, seconds, 1, attrs)
+
+
+def timed_iter(name, iterable, size=None):
+    """Time stage name as the time spent getting items from iterable.
+
+    The stage is recorded once, when the iterable runs out (or the loop over it stops), with
+    the number of items it gave.  Returns iterable as it is while metrics are off.
+
+    Arguments:
+    name     -- name of the stage
+    iterable -- items to time getting
+    size     -- if set, function giving the number to count for each item, such as len for
+                blocks of rows; otherwise each item counts as one
+    """
+    if _recorder is None:
+        return iterable
+    return _timed_iter(_recorder, name, iterable, size)
+
+
+def _timed_iter(recorder, name, iterable, size):
+    total = 0.0
+    items = 0
+    it = iter(iterable)
+    # stands in for a span on the stack while each item is got, to collect time in spans within
+    frame = _Frame()
+    try:
+        while True:
+            recorder.push(frame)
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                seconds = time.time() - start
+                recorder.pop(frame, seconds)
+                total += seconds
+            items += size(item) if size else 1
+            yield item
+    finally:
+        recorder.add_span(name, total, total - frame.child_seconds, 1, {}, items)
+
+
+def incr(name, amount=1):
+    """Add amount to counter name."""
+    if _recorder is not None:
+        _recorder.incr(name, amount)
+
+
+def gauge(name, value):
+    """Set gauge name to value."""
+    if _recorder is not None:
+        _recorder.gauge(name, value)
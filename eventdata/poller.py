@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""Watch HunchLab import jobs until they finish, polling each one with adaptive back-off.
+
+Jobs are polled quickly at first, then less and less often, with some random jitter so that
+many jobs do not poll in lock step.  A Retry-After header from the server is respected.
+Any number of jobs can be watched at once from one thread: they wait in a queue ordered by
+when each is next due to be polled, and the poller sleeps only until the earliest one.
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import common
+import metrics
+
+# seconds to wait before the second poll of a job; later waits grow by BACKOFF up to MAX_DELAY
+INITIAL_DELAY = 1.0
+BACKOFF = 2.0
+MAX_DELAY = 60.0
+# failed status requests in a row to put up with before giving up on a job
+MAX_ERRORS = 5
+
+
+class ImportJob(object):
+    """State of one import job being watched."""
+
+    def __init__(self, job_id, delay):
+        self.job_id = job_id
+        self.delay = delay
+        self.status = None
+        self.final_status = None
+        self.log = None
+        self.polls = 0
+        self.errors = 0
+        self.done = False
+        self.started = time.time()
+
+
+class ImportPoller(object):
+    """Poll the status of several import jobs at once until they have all finished."""
+
+    def __init__(self, session, endpoint, statuses, initial_delay=INITIAL_DELAY,
+                 backoff=BACKOFF, max_delay=MAX_DELAY, max_errors=MAX_ERRORS, timeout=None):
+        """Arguments:
+        session       -- requests.Session to poll with
+        endpoint      -- URL that job IDs are appended to, to get their status
+        statuses      -- dictionary of processing status codes to names
+        initial_delay -- seconds to wait before polling a job the second time
+        backoff       -- factor to grow the wait by after each poll
+        max_delay     -- most seconds to wait between polls of a job
+        max_errors    -- failed status requests in a row to put up with for a job
+        timeout       -- seconds to wait for the server to respond; defaults to the
+                         session's
+        """
+        self.session = session
+        self.endpoint = endpoint
+        self.statuses = statuses
+        self.initial_delay = initial_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.max_errors = max_errors
+        self.timeout = timeout
+
+        self.jobs = {}
+        # heap of (time the job is due to be polled, order added, job)
+        self._queue = []
+        self._seq = itertools.count()
+
+    def add(self, job_id):
+        """Start watching import job job_id; it is first polled right away."""
+        job = ImportJob(str(job_id), self.initial_delay)
+        self.jobs[job.job_id] = job
+        heapq.heappush(self._queue, (time.time(), next(self._seq), job))
+        return job
+
+    def run(self):
+        """Poll until every job has finished.
+
+        Returns dictionary of job ID to the name of its final processing status, or None for
+        jobs whose status could not be found out.
+        """
+        while self._queue:
+            due, _, job = self._queue[0]
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            heapq.heappop(self._queue)
+            delay = self._poll(job)
+            if not job.done:
+                heapq.heappush(self._queue, (time.time() + delay, next(self._seq), job))
+
+        return dict((job_id, job.final_status) for job_id, job in self.jobs.items())
+
+    def _poll(self, job):
+        """Get the status of job once; return seconds to wait before polling it again."""
+        # loaded by the time there is a session to poll with
+        import requests
+
+        job.polls += 1
+        try:
+            with metrics.span('poll', job=job.job_id) as span:
+                response = self.session.get(self.endpoint + job.job_id, timeout=self.timeout)
+                span.set(status_code=response.status_code)
+        except requests.exceptions.RequestException as ex:
+            logging.warning('Could not get status of import job %s: %s', job.job_id, ex)
+            return self._error(job)
+
+        retry_after = common.retry_after(response)
+        if response.status_code in common.TRANSIENT_STATUS_CODES:
+            logging.warning('Status request for import job %s returned HTTP status %d.',
+                            job.job_id, response.status_code)
+            return self._error(job, retry_after)
+        elif response.status_code not in (200, 202):
+            logging.error('Status request for import job %s returned HTTP status %d; '
+                          'giving up on it.', job.job_id, response.status_code)
+            job.done = True
+            return None
+
+        job.errors = 0
+        result = response.json()
+        code = str(result['processing_status'])
+        job.status = self.statuses.get(code, code)
+
+        if response.status_code == 202:
+            logging.info('Import job %s status: %s', job.job_id, job.status)
+            return self._next_delay(job, retry_after)
+
+        job.done = True
+        job.final_status = job.status
+        job.log = result.get('log')
+        logging.info('Final status of import job %s: %s (%d polls, %.0f seconds)', job.job_id,
+                     job.final_status, job.polls, time.time() - job.started)
+        logging.info('Log: ')
+        logging.info(job.log)
+        return None
+
+    def _error(self, job, retry_after=None):
+        """Count a failed status request; return seconds to wait, unless giving up on job."""
+        job.errors += 1
+        if job.errors > self.max_errors:
+            logging.error('Giving up on import job %s after %d failed status requests.',
+                          job.job_id, job.errors)
+            job.done = True
+            return None
+        return self._next_delay(job, retry_after)
+
+    def _next_delay(self, job, retry_after=None):
+        """Return seconds to wait before the next poll of job, and grow its wait for later."""
+        # random in the upper half of the wait, so jobs started together spread out
+        delay = job.delay / 2.0 + random.uniform(0, job.delay / 2.0)
+        job.delay = min(job.delay * self.backoff, self.max_delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""Profiling of a whole run, and of its slow stages, for the fetch, upload and missions scripts.
+
+Once configure is called, the run is profiled with cProfile, and the stack of every thread is
+sampled every few milliseconds.  Stages marked with stage get a cProfile profile of their own,
+and a note of the memory they allocated.  When the script exits, these are written to the
+profile directory:
+
+    <script>.pstats            -- profile of the whole run, for pstats or snakeviz
+    <script>.<stage>.pstats    -- profile of each stage, over all the times it ran
+    <script>.collapsed         -- sampled stacks, one line per stack with its count, as read
+                                  by flamegraph.pl and speedscope; stages are the root frames
+    <script>.<stage>.mem.txt   -- top allocations in each run of a stage, by source line
+
+and the functions taking the most time are logged.  Allocations are traced with tracemalloc
+where it is available (it is not in Python 2.7); otherwise peak RSS before and after each run
+of the stage is noted instead.  cProfile only sees the thread it is started in, so a stage run
+in a worker thread gets its own profile but is missing from the whole-run one, and time in a
+stage run within another is counted in the inner stage only.  Worker processes are not
+profiled.
+"""
+
+import atexit
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+try:
+    # standard from Python 3.4; optional back-port before that
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+# functions to log at the end of the run, and allocations to note for each run of a stage
+TOP_FUNCTIONS = 10
+TOP_ALLOCATIONS = 15
+
+_profiler = None
+
+
+class _NullStage(object):
+    """Stage that profiles nothing, handed out while profiling is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def _peak_rss_mb():
+    """Return peak resident set size of this process in megabytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on OS X
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def _frame_label(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class _Sampler(threading.Thread):
+    """Thread counting the stacks of all other threads, sampled every so often."""
+
+    def __init__(self, profiler, interval):
+        threading.Thread.__init__(self, name='profile-sampler')
+        self.daemon = True
+        self.profiler = profiler
+        self.interval = interval
+        self.counts = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.current_thread().ident
+        while not self._stop_event.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                labels.extend('[%s]' % name for name in
+                              reversed(self.profiler.thread_stages.get(thread_id, ())))
+                stack = ';'.join(reversed(labels))
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _Stage(object):
+    """Profile one run of a stage, from entering it to leaving it."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.profile = None
+        self.before = None
+
+    def __enter__(self):
+        profiler = self.profiler
+        stack = profiler.profile_stack()
+        if stack:
+            stack[-1].disable()
+        profiler.thread_stages.setdefault(threading.current_thread().ident, []).append(self.name)
+        self.before = profiler.memory_mark()
+        self.profile = cProfile.Profile()
+        stack.append(self.profile)
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.profile.disable()
+        profiler = self.profiler
+        stack = profiler.profile_stack()
+        stack.pop()
+        names = profiler.thread_stages.get(threading.current_thread().ident)
+        if names:
+            names.pop()
+        profiler.add_stage(self.name, self.profile, self.before, profiler.memory_mark())
+        if stack:
+            stack[-1].enable()
+        return False
+
+
+class Profiler(object):
+    """Profile one run of a script, and the stages within it."""
+
+    def __init__(self, directory, script):
+        """Arguments:
+        directory -- directory to write profiles to; made if it does not exist
+        script    -- name of the script, used to name the profile files
+        """
+        self.directory = directory
+        self.script = script
+        # profiles of each stage, by name
+        self.stages = {}
+        # names of the stages each thread is in, by thread ID, for the sampler
+        self.thread_stages = {}
+        self.memory_notes = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.run_profile = None
+        self.sampler = None
+
+    def start(self):
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.sampler = _Sampler(self, SAMPLE_INTERVAL)
+        self.sampler.start()
+        self.run_profile = cProfile.Profile()
+        self.profile_stack().append(self.run_profile)
+        self.run_profile.enable()
+
+    def profile_stack(self):
+        """Return the stack of profiles running in this thread, the running one last."""
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def memory_mark(self):
+        """Return a tracemalloc snapshot if tracing, or else the peak RSS so far."""
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            return tracemalloc.take_snapshot()
+        return _peak_rss_mb()
+
+    def add_stage(self, name, profile, before, after):
+        with self._lock:
+            self.stages.setdefault(name, []).append(profile)
+            notes = self.memory_notes.setdefault(name, [])
+            notes.append(self._memory_note(len(notes) + 1, before, after))
+
+    def _memory_note(self, num, before, after):
+        lines = ['# run %d, at %s' % (num, time.strftime('%Y-%m-%d %H:%M:%S'))]
+        if tracemalloc is not None and hasattr(after, 'compare_to'):
+            for stat in after.compare_to(before, 'lineno')[:TOP_ALLOCATIONS]:
+                lines.append(str(stat))
+        elif after is None:
+            lines.append('memory use unknown on this platform')
+        else:
+            lines.append('peak RSS %.1f MB before, %.1f MB after' % (before, after))
+        return '\n'.join(lines) + '\n'
+
+    def finish(self):
+        """Stop profiling, write the profiles and log the functions taking the most time."""
+        self.run_profile.disable()
+        self.sampler.stop()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        run_stats = pstats.Stats(self.run_profile)
+        with self._lock:
+            for name, profiles in sorted(self.stages.items()):
+                stats = pstats.Stats(*profiles)
+                stats.dump_stats(self._path('%s.pstats' % name))
+                run_stats.add(stats)
+                with open(self._path('%s.mem.txt' % name), 'wb') as f:
+                    f.write('\n'.join(self.memory_notes[name]))
+        run_stats.dump_stats(self._path('pstats'))
+
+        with open(self._path('collapsed'), 'wb') as f:
+            for stack, count in sorted(self.sampler.counts.items()):
+                f.write('%s %d\n' % (stack, count))
+
+        self._log_hot_functions(run_stats)
+        logging.info('Wrote profiles to %s.', self.directory)
+
+    def _path(self, suffix):
+        return os.path.join(self.directory, '%s.%s' % (self.script, suffix))
+
+    def _log_hot_functions(self, stats):
+        stats.sort_stats('tottime')
+        logging.info('Functions taking the most time (seconds in function, ' +
+                     'including calls, calls):')
+        for func in stats.fcn_list[:TOP_FUNCTIONS]:
+            calls, _, self_seconds, seconds, _ = stats.stats[func]
+            logging.info('%8.3f %8.3f %9d  %s', self_seconds, seconds, calls,
+                         pstats.func_std_string(func))
+
+
+def configure(directory, script):
+    """Start profiling script, with profiles written to directory when the script exits.
+
+    Call from the main thread, as early as possible.
+
+    Arguments:
+    directory -- directory to write profiles to; made if it does not exist
+    script    -- name of the script, used to name the profile files
+    """
+    global _profiler
+    _profiler = Profiler(directory, script)
+    _profiler.start()
+    atexit.register(_finish_at_exit, _profiler)
+    return _profiler
+
+
+def _finish_at_exit(profiler):
+    try:
+        profiler.finish()
+    except (IOError, OSError) as ex:
+        logging.error('Could not write profiles to %s: %s', profiler.directory, ex)
+
+
+def enabled():
+    """Return whether the run is being profiled."""
+    return _profiler is not None
+
+
+def stage(name):
+    """Return a context manager profiling stage name on its own."""
+    if _profiler is None:
+        return _NULL_STAGE
+    return _Stage(_profiler, name)
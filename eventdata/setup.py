@@ -3,13 +3,20 @@
 from distutils.core import setup
 import py2exe
 import glob
+import os
+import sys
+
+# hunchlab.py imports the fetch and missions scripts by name when it runs, so py2exe is told
+# where they are, and to bundle them in
+sys.path[1:1] = [os.path.join(os.pardir, 'fetchdata'), os.path.join(os.pardir, 'geojson_to_shp')]
 
 setup(options={'py2exe': {
     "compressed": 0,
     "bundle_files": 3,
-    "optimize": 2
+    "optimize": 2,
+    "includes": ['fetch_philly_crime_data', 'geojson_to_shp']
     }},
     zipfile = None,
     data_files=[('certificates', glob.glob('certificates/*')),('data', glob.glob('data/*'))],
-    console=['upload.py'],
+    console=['upload.py', 'hunchlab.py'],
 )
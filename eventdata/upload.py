@@ -1,18 +1,32 @@
 #!/usr/bin/env python
 
+from contextlib import contextmanager
+import glob
 import logging
 import os
-import requests
+import Queue
+import shutil
 import sys
+import tempfile
 import time
+import uuid
+import zlib
 
 from argparse import ArgumentParser
 import ConfigParser
+from multiprocessing.pool import ThreadPool
 ## previously was needed to inject support for more recent TLS versions
 # from requests.packages.urllib3.contrib import pyopenssl
 # pyopenssl.inject_into_urllib3
 
-from requests.auth import AuthBase
+# requests is imported where it is used, since it is slow to load; see common.py
+import common
+from dedup import DedupStore
+from journal import POSTED, UploadJournal, file_hash
+import metrics
+import profiling
+from poller import ImportPoller
+from validator import open_csv, validate_file
 
 ### Processing Status Values
 PROCESSING_STATUSES = {
@@ -27,101 +41,217 @@ PROCESSING_STATUSES = {
 
 _START = time.time()
 
-
-class TokenAuth(AuthBase):
-    """Attaches HTTP Token Authentication to the given Request object."""
-    def __init__(self, token):
-        # setup any auth-related data here
-        self.token = token
-
-    def __call__(self, r):
-        # modify and return the request
-        r.headers['Authorization'] = 'Token ' + self.token
-        return r
+# bytes of the CSV file to read and send at a time
+_CHUNK_SIZE = 64 * 1024
+# seconds between upload progress reports
+_PROGRESS_INTERVAL = 10
+# seconds to wait to connect to send a file; the server answers once it has read all of it,
+# which for a big file may take longer than the sessions' usual timeout
+_UPLOAD_TIMEOUT = (60, None)
+# status given to files that are not uploaded because they failed validation
+_INVALID = 'Invalid'
 
 
 def _print_elapsed_time():
     logging.info('Elapsed time: {0:.1f} minutes'.format((time.time() - _START) / 60))
 
 
-def _config_section_map(config, section):
-    result = {}
-    options = config.options(section)
-    for option in options:
-        try:
-            result[option] = config.get(section, option)
-            if result[option] == -1:
-                logging.info('skip: %s', option)
-        except Exception:
-            logging.error('exception on %s!', option)
-            result[option] = None
-    return result
-
-
-def main():
-    desc = 'Upload events CSV to HunchLab.'
-    parser = ArgumentParser(description=desc)
-    parser.add_argument('-c', '--config', default='config.ini', dest='config',
-                        help='Configuration file', metavar='FILE')
-    parser.add_argument('csv', help='CSV file to upload.')
-    parser.add_argument('-l', '--log-level', default='INFO', dest='log_level',
-                        help="Log level for console output.  Defaults to 'info'.",
-                        choices=['debug', 'info', 'warning', 'error', 'critical'])
-
-    args = parser.parse_args()
+class UploadError(Exception):
+    """Upload to HunchLab failed; exit_code is the status for the command-line script."""
+    def __init__(self, message, exit_code):
+        Exception.__init__(self, message)
+        self.exit_code = exit_code
 
-    # set up file logger
-    logging.basicConfig(filename='hunchlab_upload.log', level=logging.DEBUG,
-                        format='%(asctime)s %(levelname)s: %(message)s',
-                        datefmt='%Y-%m-%d %I:%M:%S %p')
 
-    # add logger handler for console output
-    console = logging.StreamHandler()
-    loglvl = getattr(logging, args.log_level.upper())
-    console.setLevel(loglvl)
-    # add the handler to the root logger
-    logging.getLogger('').addHandler(console)
+def read_config(config_path):
+    """Read server and data settings for the upload from config file config_path.
 
-    ### Read Configuration
-    if not os.path.isfile(args.config):
-        logging.error("Couldn't find configuration file %s.", args.config)
-        logging.info('Not uploading CSV to HunchLab.  Exiting.')
-        sys.exit(3)
+    Returns a dictionary with the csvendpoint, certificate, token and srid to use.
+    """
+    if not os.path.isfile(config_path):
+        logging.error("Couldn't find configuration file %s.", config_path)
+        raise UploadError('Configuration file not found.', 3)
 
     config = ConfigParser.ConfigParser()
-    config.read(args.config)
-    server = _config_section_map(config, 'Server')
-
-    baseurl = server['baseurl']
-    csvendpoint = baseurl + '/api/dataservice/'
-    certificate = server['certificateauthority']
-    token = server['token']
-
-    data_attrs = _config_section_map(config, 'Data')
-
-    logging.info('Uploading data to: %s', csvendpoint)
-
-    # setup session to reuse authentication and verify the SSL certificate properly
-    s = requests.Session()
-    s.auth = TokenAuth(token)
-    s.verify = certificate
-
-    form_data = dict(srid=data_attrs['srid'])
-    # post the csv file to HunchLab
-    if not os.path.isfile(args.csv):
-        logging.error("Couldn't find csv file %s.", args.csv)
-        logging.info('Not uploading CSV to HunchLab.  Exiting.')
-        sys.exit(4)
-
-    with open(args.csv, 'rb') as f:
-        csv_response = s.post(csvendpoint, files={'file': f}, data=form_data, )
+    config.read(config_path)
+    server = common.config_section_map(config, 'Server')
+    data_attrs = common.config_section_map(config, 'Data')
+
+    return {
+        'csvendpoint': server['baseurl'] + '/api/dataservice/',
+        'certificate': server['certificateauthority'],
+        'token': server['token'],
+        'srid': data_attrs['srid']
+    }
+
+
+def make_session(settings):
+    """Set up session to reuse authentication and verify the SSL certificate properly."""
+    return common.make_session(settings['token'], settings['certificate'])
+
+
+class MultipartEncoder(object):
+    """Streaming multipart/form-data request body, with a file part read in fixed-size chunks.
+
+    Iterating over the encoder generates the body, so memory use stays the same no matter how
+    large the file is.  The file part can be gzipped on the fly, or sent as it is if the file is
+    gzipped already.  Progress and throughput are logged as the body is sent.
+    """
+
+    def __init__(self, fields, filename, f, chunk_size=_CHUNK_SIZE, compress=False):
+        """Arguments:
+        fields     -- dictionary of other form fields to send
+        filename   -- name to give the uploaded file; if it ends in .gz, the file is taken to
+                      be gzipped already
+        f          -- open file to send, or an iterator of chunks of data
+        chunk_size -- number of bytes to read from the file at a time
+        compress   -- if True, gzip the file part, unless it is gzipped already
+        """
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self.f = f
+        self.chunk_size = chunk_size
+        gzipped = filename.endswith('.gz')
+        self.compress = compress and not gzipped
+
+        head = []
+        for name, value in fields.items():
+            head.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' %
+                        (self.boundary, name, value))
+        if self.compress or gzipped:
+            head.append('--%s\r\nContent-Disposition: form-data; name="file"; ' \
+                        'filename="%s"\r\nContent-Type: application/gzip\r\n\r\n' %
+                        (self.boundary, filename if gzipped else filename + '.gz'))
+        else:
+            head.append('--%s\r\nContent-Disposition: form-data; name="file"; ' \
+                        'filename="%s"\r\n\r\n' % (self.boundary, filename))
+        self.head = ''.join(head)
+        self.tail = '\r\n--%s--\r\n' % self.boundary
+
+        # size of the file, if known; needed to send a Content-Length instead of chunks
+        self.file_size = None
+        if hasattr(f, 'fileno'):
+            self.file_size = os.fstat(f.fileno()).st_size - f.tell()
+            if not self.compress:
+                # requests looks for this to set the Content-Length
+                self.len = len(self.head) + self.file_size + len(self.tail)
+
+        self.bytes_read = 0
+        self.bytes_sent = 0
+        self._body = None
+        self._buf = ''
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body, for senders that want a file-like object."""
+        if self._body is None:
+            self._body = iter(self)
+
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._body, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+
+        if size < 0:
+            data, self._buf = self._buf, ''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def __iter__(self):
+        yield self.head
+        self.bytes_sent += len(self.head)
+
+        gzipper = None
+        if self.compress:
+            # wbits offset of 16 makes zlib write a gzip header and trailer
+            gzipper = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        start = last_report = time.time()
+        for chunk in self._file_chunks():
+            self.bytes_read += len(chunk)
+            if gzipper:
+                chunk = gzipper.compress(chunk)
+            if chunk:
+                self.bytes_sent += len(chunk)
+                yield chunk
+
+            if time.time() - last_report >= _PROGRESS_INTERVAL:
+                last_report = time.time()
+                self._log_progress(start)
+
+        if gzipper:
+            chunk = gzipper.flush()
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+        yield self.tail
+        self.bytes_sent += len(self.tail)
+        self._log_progress(start)
+
+    def _file_chunks(self):
+        """Generate chunks of the file part's data."""
+        if hasattr(self.f, 'read'):
+            while True:
+                chunk = self.f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            for chunk in self.f:
+                yield chunk
+
+    def _log_progress(self, start):
+        """Log how much of the file has been sent, and how fast."""
+        elapsed = max(time.time() - start, 0.001)
+        mb_read = self.bytes_read / (1024.0 * 1024.0)
+        if self.file_size:
+            logging.info('Sent %.1f of %.1f MB of CSV (%.0f%%), %.1f MB/s.', mb_read,
+                         self.file_size / (1024.0 * 1024.0),
+                         100.0 * self.bytes_read / self.file_size, mb_read / elapsed)
+        else:
+            logging.info('Sent %.1f MB of CSV, %.1f MB/s.', mb_read, mb_read / elapsed)
+
+        if self.compress:
+            logging.info('Compressed to %.1f MB.', self.bytes_sent / (1024.0 * 1024.0))
+
+
+def post_csv(s, settings, f, filename=None, compress=False):
+    """Post CSV to HunchLab; return the import job ID.
+
+    Arguments:
+    s        -- session from make_session
+    settings -- settings from read_config
+    f        -- open CSV file, or an iterator of chunks of CSV data to stream in the request body
+    filename -- name to give the uploaded file; defaults to the name of file f.  A name ending
+                in .gz means the CSV is gzipped already, and it is sent as it is.
+    compress -- if True, gzip the CSV as it is sent
+    """
+    form_data = dict(srid=settings['srid'])
+    if not filename:
+        filename = os.path.basename(getattr(f, 'name', 'events.csv'))
+
+    # the body is built as it is sent; if its size is not known up front,
+    # it goes with chunked transfer encoding
+    body = MultipartEncoder(form_data, filename, f, compress=compress)
+    headers = {'Content-Type': body.content_type}
+    # a body of unknown length is sent chunked, which makes requests warn of a full
+    # connection pool for no reason; see common.ignore_pool_full
+    with metrics.span('upload', file=filename) as span, profiling.stage('upload_post'), \
+            common.ignore_pool_full(not hasattr(body, 'len')):
+        csv_response = s.post(settings['csvendpoint'], data=body, headers=headers,
+                              timeout=_UPLOAD_TIMEOUT)
+        span.set(status_code=csv_response.status_code, bytes_sent=body.bytes_sent)
+    metrics.incr('uploads')
+    metrics.incr('upload_bytes_sent', body.bytes_sent)
+    metrics.incr('upload_file_bytes_read', body.bytes_read)
 
     if csv_response.status_code == 401:
         logging.error('Authentication token not accepted.')
-        sys.exit(1)
+        raise UploadError('Authentication token not accepted.', 1)
     elif csv_response.status_code != 202:
         logging.error('Other error. Did not receive a 202 HTTP response to the upload')
-        sys.exit(2)
+        raise UploadError('Upload not accepted.', 2)
 
     _print_elapsed_time()
 
@@ -129,30 +259,462 @@ def main():
     import_job_id = upload_result['import_job_id']
 
     logging.info('Import Job ID: %s', import_job_id)
+    return import_job_id
 
-    # while in progress continue polling
-    upload_status = s.get(csvendpoint + import_job_id)
-    while upload_status.status_code == 202:
-        logging.info("Status of poll: %d", upload_status.status_code)
-        logging.info('Upload Status: %s',
-            PROCESSING_STATUSES[str(upload_status.json()['processing_status'])])
 
-        _print_elapsed_time()
-        time.sleep(15)
-        upload_status = s.get(csvendpoint + import_job_id)
-
-    final_status = PROCESSING_STATUSES[str(upload_status.json()['processing_status'])]
-    logging.info("HTTP status of poll: %d", upload_status.status_code)
-    logging.info('Final Upload Status: %s', final_status)
-
-    logging.info('Log: ')
-    logging.info(upload_status.json()['log'])
+def watch_imports(s, settings, import_job_ids):
+    """Poll status of import jobs until they have all finished.
 
+    Returns dictionary of job ID to the name of its final processing status, or None if it
+    could not be found out.
+    """
+    poller = ImportPoller(s, settings['csvendpoint'], PROCESSING_STATUSES)
+    for import_job_id in import_job_ids:
+        poller.add(import_job_id)
+    final_statuses = poller.run()
+    for final_status in final_statuses.values():
+        metrics.incr('imports_completed' if final_status == 'Completed' else 'imports_failed')
     _print_elapsed_time()
+    return final_statuses
+
 
+def poll_import(s, settings, import_job_id):
+    """Poll status of import job until it finishes; raise UploadError if it did not complete."""
+    final_status = watch_imports(s, settings, [import_job_id])[str(import_job_id)]
     if final_status != 'Completed':
         logging.error('File failed to upload successfully.')
-        sys.exit(5)
+        raise UploadError('Import did not complete.', 5)
+
+
+def upload(settings, f, filename=None, compress=False, s=None):
+    """Upload CSV to HunchLab and wait for the import to finish.
+
+    Arguments are as for post_csv; a session is made if s is not given.  Raises UploadError if
+    the upload or import failed.
+    """
+    logging.info('Uploading data to: %s', settings['csvendpoint'])
+    if s is None:
+        s = make_session(settings)
+    import_job_id = post_csv(s, settings, f, filename, compress)
+    poll_import(s, settings, import_job_id)
+
+
+def _iter_records(f):
+    """Generate the raw text of each CSV record in file f, line ends included.
+
+    A record ends at a line end outside of any quoted field, so quoted fields that span lines
+    stay in one piece.
+    """
+    record = []
+    quotes = 0
+    for line in f:
+        record.append(line)
+        quotes += line.count('"')
+        if quotes % 2 == 0:
+            yield ''.join(record)
+            record = []
+            quotes = 0
+    if record:
+        yield ''.join(record)
+
+
+def split_csv(path, rows_per_part, out_dir):
+    """Split CSV file into parts of at most rows_per_part rows, each starting with the header.
+
+    Records are copied as they are, except that line ends become newlines.  Returns list of
+    paths to the parts, in order.
+
+    Arguments:
+    path          -- CSV file to split
+    rows_per_part -- most rows to put in each part, not counting the header
+    out_dir       -- directory to write the parts to
+    """
+    base = os.path.splitext(_csv_name(path))[0]
+    parts = []
+    part_file = None
+    with metrics.span('split', file=path), open_csv(path) as f:
+        records = _iter_records(f)
+        header = next(records, '')
+        row_ct = 0
+        try:
+            for record in records:
+                if row_ct % rows_per_part == 0:
+                    if part_file:
+                        part_file.close()
+                    parts.append(os.path.join(out_dir, '%s.part%03d.csv' % (base, len(parts) + 1)))
+                    part_file = open(parts[-1], 'wb')
+                    part_file.write(header)
+                part_file.write(record)
+                row_ct += 1
+        finally:
+            if part_file:
+                part_file.close()
+
+    logging.info('Split %d rows of %s into %d parts.', row_ct, path, len(parts))
+    return parts
+
+
+class SessionPool(object):
+    """Fixed set of sessions shared by the threads uploading several files.
+
+    Each thread takes a session while it uploads a file, so connections are reused from one
+    file to the next, but no session is used by two threads at once.
+    """
+
+    def __init__(self, settings, size):
+        """Arguments:
+        settings -- settings from read_config
+        size     -- number of sessions; one for each thread
+        """
+        self._sessions = Queue.Queue()
+        for _ in range(size):
+            self._sessions.put(make_session(settings))
+
+    @contextmanager
+    def session(self):
+        """Borrow a session for the duration of a with block."""
+        s = self._sessions.get()
+        try:
+            yield s
+        finally:
+            self._sessions.put(s)
+
+
+def _post_file(task):
+    """Post one of several CSV files; return a job status dictionary.
+
+    With a journal, files already imported are not posted again, and files whose import was
+    still running are not posted again but get their job ID back from the journal.  Files are
+    checked first, if asked to, and not posted if they have problems.
+
+    Failures are recorded in the returned status rather than raised, so that the file can be
+    retried, except for a rejected token, which will not get better by trying again.
+    """
+    import requests
+
+    pool, settings, path, compress, journal, validate = task
+    job = {'file': path, 'hash': None, 'import_job_id': None, 'status': None}
+    name = os.path.basename(path)
+
+    if journal:
+        job['hash'] = file_hash(path)
+        entry = journal.get(job['hash'])
+        if entry and entry['status'] == 'Completed':
+            logging.info('%s was already imported by job %s; skipping it.', name,
+                         entry['import_job_id'])
+            job.update(import_job_id=entry['import_job_id'], status=entry['status'])
+            return job
+        elif entry and entry['status'] == POSTED:
+            logging.info('%s was already posted as import job %s; resuming it.', name,
+                         entry['import_job_id'])
+            job['import_job_id'] = entry['import_job_id']
+            return job
+
+    if validate and not validate_file(path).ok:
+        logging.error('Not uploading %s, as it has problems.', name)
+        job['status'] = _INVALID
+        return job
+
+    with pool.session() as s:
+        try:
+            with open(path, 'rb') as f:
+                job['import_job_id'] = post_csv(s, settings, f, compress=compress)
+            logging.info('%s has import job ID %s.', name, job['import_job_id'])
+        except UploadError as ex:
+            if ex.exit_code == 1:
+                raise
+            job['status'] = str(ex)
+        except requests.exceptions.RequestException as ex:
+            logging.error('Upload of %s failed: %s', name, ex)
+            job['status'] = 'Request failed'
+
+    if journal:
+        journal.record(job['hash'], path, job['import_job_id'], job['status'] or POSTED)
+    return job
+
+
+def upload_files(settings, paths, parallel=1, retries=2, compress=False, journal=None,
+                 validate=False, on_complete=None):
+    """Upload several CSV files, a few at a time, retrying those that fail.
+
+    Files are posted by a pool of threads, then all of their import jobs are watched together.
+    Returns dictionary of file path to job status dictionary, with the file's import_job_id
+    and final status.  Raises UploadError if any file did not complete.
+
+    Arguments:
+    settings    -- settings from read_config
+    paths       -- paths of the CSV files to upload
+    parallel    -- most files to upload at once
+    retries     -- number of times to retry files that did not complete
+    compress    -- if True, gzip each file as it is sent
+    journal     -- UploadJournal to record the uploads in and to resume from, if any
+    validate    -- if True, check each file before posting it, and skip those with problems
+    on_complete -- function to call with the path of each file whose import completes
+    """
+    logging.info('Uploading %d files to: %s', len(paths), settings['csvendpoint'])
+    parallel = max(1, min(parallel, len(paths)))
+    pool = SessionPool(settings, parallel)
+    workers = ThreadPool(parallel)
+    jobs = {}
+    pending = list(paths)
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                logging.warning('Retrying %d failed files (attempt %d of %d).', len(pending),
+                                attempt, retries)
+            tasks = [(pool, settings, path, compress, journal, validate) for path in pending]
+            running = []
+            for job in workers.imap_unordered(_post_file, tasks):
+                jobs[job['file']] = job
+                if job['status'] is None:
+                    running.append(job)
+
+            if running:
+                with pool.session() as s:
+                    final_statuses = watch_imports(s, settings,
+                                                   [job['import_job_id'] for job in running])
+                for job in running:
+                    job['status'] = final_statuses[str(job['import_job_id'])]
+                    if journal:
+                        journal.record(job['hash'], job['file'], job['import_job_id'],
+                                       job['status'])
+
+            if on_complete:
+                for path in pending:
+                    if jobs[path]['status'] == 'Completed':
+                        on_complete(path)
+
+            # files with problems will not do any better the next time
+            pending = [path for path in paths
+                       if jobs[path]['status'] not in ('Completed', _INVALID)]
+            if not pending:
+                break
+    finally:
+        workers.close()
+        workers.join()
+
+    for path in paths:
+        logging.info('%s: import job %s, %s', os.path.basename(path),
+                     jobs[path]['import_job_id'], jobs[path]['status'])
+    _print_elapsed_time()
+
+    failed = [path for path in paths if jobs[path]['status'] != 'Completed']
+    if failed:
+        logging.error('%d of %d files failed to upload successfully.', len(failed), len(paths))
+        raise UploadError('Import of some files did not complete.', 5)
+
+    return jobs
+
+
+def _csv_name(path):
+    """Return the file name of CSV file path, less .gz if it is gzipped."""
+    name = os.path.basename(path)
+    if name.endswith('.gz'):
+        return name[:-3]
+    return name
+
+
+def find_csv_files(path):
+    """Return sorted list of the CSV files in directory path, or matching glob pattern path.
+
+    Gzipped CSV files, ending in .csv.gz, are included.
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if name.lower().endswith(('.csv', '.csv.gz')) and
+                      os.path.isfile(os.path.join(path, name)))
+    return sorted(name for name in glob.glob(path) if os.path.isfile(name))
+
+
+def _dedup_files(store, paths, work_dir):
+    """Cut CSV files down to the rows not imported before, using DedupStore store.
+
+    Files already imported whole are left out.  Returns list of paths of the cut down files
+    left to upload, which are written under work_dir, and a function to call with each of
+    them once its import has completed, to record its rows as imported.
+    """
+    file_hashes = {}
+    out_paths = []
+    for num, path in enumerate(paths):
+        content_hash = file_hash(path)
+        if store.file_imported(content_hash):
+            logging.info('%s was already imported; skipping it.', path)
+            continue
+
+        # keep the file name, which is what HunchLab shows for the import
+        out_dir = os.path.join(work_dir, str(num))
+        os.mkdir(out_dir)
+        out_path = os.path.join(out_dir, _csv_name(path))
+        try:
+            row_ct = store.filter_csv(path, out_path, content_hash)
+        except ValueError as ex:
+            logging.error('Could not check %s for rows already imported: %s', path, ex)
+            raise UploadError('CSV file has problems.', 6)
+
+        if row_ct:
+            file_hashes[out_path] = content_hash
+            out_paths.append(out_path)
+        else:
+            logging.info('Every row of %s was already imported; skipping it.', path)
+            store.commit_file(content_hash)
+
+    def on_complete(out_path):
+        store.commit_file(file_hashes[out_path])
+
+    return out_paths, on_complete
+
+
+def _csv_paths(path, batch):
+    """Return list of the CSV files to upload; raise UploadError if there are none."""
+    if batch:
+        paths = find_csv_files(path)
+        if not paths:
+            logging.error('No csv files found in %s.', path)
+            raise UploadError('CSV file not found.', 4)
+        return paths
+
+    if not os.path.isfile(path):
+        logging.error("Couldn't find csv file %s.", path)
+        raise UploadError('CSV file not found.', 4)
+    return [path]
+
+
+def main(argv=None, prog=None):
+    """Upload events CSV to HunchLab.
+
+    Arguments:
+    argv -- command-line arguments; defaults to those the script was run with
+    prog -- name of the command, for the help; defaults to the script's name
+    """
+    desc = 'Upload events CSV to HunchLab.'
+    parser = ArgumentParser(prog=prog, description=desc)
+    parser.add_argument('-c', '--config', default='config.ini', dest='config',
+                        help='Configuration file', metavar='FILE')
+    parser.add_argument('csv', nargs='?',
+                        help='CSV file to upload, or a directory or glob pattern of CSV files.  ' +
+                             'Files ending in .gz are taken to be gzipped already.')
+    parser.add_argument('-z', '--compress', default=False, dest='compress',
+                        action='store_true', help='Gzip the CSV file as it is uploaded')
+    parser.add_argument('--split-rows', default=0, type=int, dest='split_rows', metavar='N',
+                        help='Split the CSV file into parts of N rows and upload them separately')
+    parser.add_argument('--parallel', default=1, type=int, dest='parallel', metavar='K',
+                        help='Upload up to K parts or files at once.  Defaults to 1.')
+    parser.add_argument('--retries', default=2, type=int, dest='retries',
+                        help='Times to retry parts or files that fail to upload.  Defaults to 2.')
+    parser.add_argument('--journal', default='hunchlab_journal.jsonl', dest='journal',
+                        metavar='FILE', help='Journal of files uploaded from a directory or '
+                        "glob pattern.  Defaults to 'hunchlab_journal.jsonl'.")
+    parser.add_argument('--validate-only', default=False, dest='validate_only',
+                        action='store_true', help='Check the CSV file, but do not upload it')
+    parser.add_argument('--no-validate', default=False, dest='no_validate',
+                        action='store_true', help='Upload without checking the CSV file first')
+    parser.add_argument('--rejects', dest='rejects', metavar='FILE',
+                        help='Write rows of the CSV file that have problems to FILE')
+    parser.add_argument('--dedup', dest='dedup', metavar='DB',
+                        help='Only upload rows not already imported, keeping track of them in '
+                        'SQLite database DB')
+    parser.add_argument('--watch', nargs='+', dest='watch', metavar='JOB_ID',
+                        help='Watch import jobs already uploaded, instead of uploading a file')
+    parser.add_argument('--metrics', dest='metrics', metavar='FILE',
+                        help='Write timings and counts to FILE: a Prometheus textfile if it '
+                        'ends in .prom, otherwise JSON lines appended to it')
+    parser.add_argument('--profile', dest='profile', metavar='DIR',
+                        help='Profile the run, writing pstats files, collapsed stacks for '
+                             'flame graphs and memory notes to DIR')
+    parser.add_argument('-l', '--log-level', default='INFO', dest='log_level',
+                        help="Log level for console output.  Defaults to 'info'.",
+                        choices=['debug', 'info', 'warning', 'error', 'critical'])
+
+    args = parser.parse_args(argv)
+    if not args.csv and not args.watch:
+        parser.error('a CSV file to upload, or --watch, is needed')
+    batch = args.csv and (os.path.isdir(args.csv) or glob.has_magic(args.csv))
+    if batch and args.split_rows:
+        parser.error('--split-rows cannot be used with a directory or glob pattern')
+    if batch and args.rejects:
+        parser.error('--rejects cannot be used with a directory or glob pattern')
+    if args.validate_only and args.no_validate:
+        parser.error('--validate-only cannot be used with --no-validate')
+    if args.parallel > 1 and not (args.split_rows or batch):
+        parser.error('--parallel needs --split-rows, or a directory or glob pattern')
+
+    common.setup_logging('hunchlab_upload.log', args.log_level)
+
+    if args.metrics:
+        metrics.configure(args.metrics, 'upload')
+        metrics.gauge('exit_code', 0)
+    if args.profile:
+        profiling.configure(args.profile, 'upload')
+
+    try:
+        if args.validate_only:
+            reports = [validate_file(path, args.rejects) for path in _csv_paths(args.csv, batch)]
+            if not all(report.ok for report in reports):
+                raise UploadError('CSV file has problems.', 6)
+            return
+
+        ### Read Configuration
+        settings = read_config(args.config)
+
+        if args.watch:
+            logging.info('Watching %d import jobs at: %s', len(args.watch),
+                         settings['csvendpoint'])
+            final_statuses = watch_imports(make_session(settings), settings, args.watch)
+            failed = [job_id for job_id in args.watch if final_statuses[job_id] != 'Completed']
+            if failed:
+                logging.error('Import jobs did not complete: %s', ', '.join(failed))
+                raise UploadError('Import did not complete.', 5)
+            return
+
+        paths = _csv_paths(args.csv, batch)
+
+        # check the csv file before sending it anywhere
+        if not batch and not args.no_validate and not validate_file(args.csv, args.rejects).ok:
+            raise UploadError('CSV file has problems.', 6)
+
+        work_dir = tempfile.mkdtemp(prefix='hunchlab_')
+        store = DedupStore(args.dedup) if args.dedup else None
+        try:
+            on_complete = None
+            if store:
+                paths, on_complete = _dedup_files(store, paths, work_dir)
+                if not paths:
+                    logging.info('Nothing new to upload.')
+                    return
+
+            if batch:
+                journal = UploadJournal(args.journal)
+                try:
+                    upload_files(settings, paths, args.parallel, args.retries, args.compress,
+                                 journal, validate=not args.no_validate,
+                                 on_complete=on_complete)
+                finally:
+                    journal.close()
+                return
+
+            if args.split_rows:
+                parts = split_csv(paths[0], args.split_rows, work_dir)
+                upload_files(settings, parts, args.parallel, args.retries, args.compress)
+            else:
+                # post the csv file to HunchLab
+                with open(paths[0], 'rb') as f:
+                    logging.info('Uploading data to: %s', settings['csvendpoint'])
+                    s = make_session(settings)
+                    import_job_id = post_csv(s, settings, f, compress=args.compress)
+
+                poll_import(s, settings, import_job_id)
+
+            if on_complete:
+                on_complete(paths[0])
+        finally:
+            if store:
+                store.close()
+            shutil.rmtree(work_dir)
+    except UploadError as ex:
+        if ex.exit_code in (3, 4, 6):
+            logging.info('Not uploading CSV to HunchLab.  Exiting.')
+        metrics.gauge('exit_code', ex.exit_code)
+        sys.exit(ex.exit_code)
 
 
 if __name__ == "__main__":
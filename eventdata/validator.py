@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""Check an event CSV against the HunchLab upload schema before sending it.
+
+The file is read once, in blocks of rows, and each column of a block is checked in one pass.
+Problems are counted by type, with a few example rows of each, and rows with problems can be
+written out to a rejects file.
+"""
+
+import csv
+import gc
+import gzip
+from itertools import islice, izip
+import logging
+from operator import itemgetter
+import re
+import string
+
+import metrics
+
+# columns every event CSV needs, as described in README.md
+COLUMNS = ['datasource', 'id', 'class', 'datetimefrom', 'datetimeto', 'report_time',
+           'pointx', 'pointy', 'address', 'last_updated']
+# columns that need a value in every row
+REQUIRED_VALUES = ['datasource', 'id', 'class', 'datetimefrom', 'pointx', 'pointy']
+DATETIME_COLUMNS = ['datetimefrom', 'datetimeto', 'report_time', 'last_updated']
+NUMERIC_COLUMNS = ['pointx', 'pointy']
+
+# number of rows to check at a time
+DEFAULT_BLOCK_SIZE = 10000
+# example rows to keep for each type of problem
+_MAX_EXAMPLES = 5
+
+# ISO 8601 date and time, with either 'T' or a space between them, optional fractional
+# seconds and an optional UTC offset; offsets need two-digit hours, as in -05:00
+_DATETIME = (r'\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01])'
+             r'[T ](?:[01]\d|2[0-3]):[0-5]\d(?::(?:[0-5]\d|60)(?:\.\d+)?)?'
+             r'(?:Z|[+-](?:[01]\d|2[0-3])(?::?[0-5]\d)?)?')
+_NUMBER = r'[ \t]*[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?[ \t]*'
+# one or more classes separated by pipes, none of them empty
+_CLASS = r'[^|\n]+(?:\|[^|\n]+)*'
+
+
+def _value_patterns(pattern):
+    """Compile pattern, which a value must match in full, if it is not empty.
+
+    Returns a pattern for checking a single value, and one for checking many values at once,
+    one per line.
+    """
+    return (re.compile(r'(?:%s)?\Z' % pattern),
+            re.compile(r'^(?:%s)?$' % pattern, re.M))
+
+
+_DATETIME_RES = _value_patterns(_DATETIME)
+_NUMBER_RES = _value_patterns(_NUMBER)
+_CLASS_RES = _value_patterns(_CLASS)
+
+# replaces every digit with a 9, leaving the shape of a number
+_NINES = string.maketrans(string.digits, '9' * len(string.digits))
+
+
+class ValidationReport(object):
+    """Counts and examples of the problems found in an event CSV."""
+
+    def __init__(self):
+        self.row_ct = 0
+        self.bad_row_ct = 0
+        self.missing_columns = []
+        self.error_cts = {}
+        # error type to list of (row number, value) examples
+        self.examples = {}
+
+    @property
+    def ok(self):
+        return not self.missing_columns and not self.bad_row_ct
+
+    def add(self, error, row_num, value):
+        """Count one problem of type error, in data row row_num of the file."""
+        self.error_cts[error] = self.error_cts.get(error, 0) + 1
+        examples = self.examples.setdefault(error, [])
+        if len(examples) < _MAX_EXAMPLES:
+            examples.append((row_num, value))
+
+    def log_summary(self, name):
+        """Log the number of each type of problem in file name, with examples."""
+        if self.missing_columns:
+            logging.error('%s is missing columns: %s', name, ', '.join(self.missing_columns))
+            return
+
+        logging.info('Checked %d rows of %s; %d have problems.', self.row_ct, name,
+                     self.bad_row_ct)
+        for error in sorted(self.error_cts):
+            logging.error('%s: %d rows', error, self.error_cts[error])
+            for row_num, value in self.examples[error]:
+                logging.error('    row %d: %r', row_num, value)
+
+
+class CsvValidator(object):
+    """Stream an event CSV, checking each row against the upload schema."""
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
+        """Arguments:
+        block_size -- number of rows to check at a time
+        """
+        self.block_size = block_size
+
+    def validate(self, f, rejects=None):
+        """Check the CSV in open file f; return a ValidationReport.
+
+        Arguments:
+        f       -- open CSV file
+        rejects -- open file to write rows with problems to, with an added column listing the
+                   problems, if any
+        """
+        report = ValidationReport()
+        rdr = csv.reader(f)
+        try:
+            header = next(rdr)
+        except StopIteration:
+            header = []
+
+        report.missing_columns = [col for col in COLUMNS if col not in header]
+        if report.missing_columns:
+            return report
+
+        idx = dict((col, header.index(col)) for col in COLUMNS)
+        reject_writer = None
+        if rejects:
+            reject_writer = csv.writer(rejects)
+            reject_writer.writerow(header + ['errors'])
+
+        # (datasource, id) keys seen so far, joined into one string to save memory
+        seen = set()
+        # nothing made here is garbage, so do not let the collector keep scanning it all
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            while True:
+                block = list(islice(rdr, self.block_size))
+                if not block:
+                    break
+                if [] in block:
+                    block = [ln for ln in block if ln]  # blank lines are skipped on import
+
+                problems = self._check_block(block, report.row_ct + 1, len(header), idx,
+                                             seen, report)
+                report.row_ct += len(block)
+                report.bad_row_ct += len(problems)
+                if reject_writer:
+                    for pos in sorted(problems):
+                        reject_writer.writerow(block[pos] + ['; '.join(problems[pos])])
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        return report
+
+    def _check_block(self, block, first_row, ncols, idx, seen, report):
+        """Check one block of rows; return dictionary of row position to list of problems.
+
+        The block is checked a column at a time, and each column is only looked at value by
+        value if a check of the whole column finds a problem.
+        """
+        problems = {}
+
+        def flag(positions, error, col):
+            if positions and rows is not block:
+                positions = [row_positions[pos] for pos in positions]
+            for pos in positions:
+                problems.setdefault(pos, []).append(error)
+                report.add(error, first_row + pos, block[pos][idx[col]] if col else block[pos])
+
+        rows = block
+        if set(map(len, block)) != set([ncols]):
+            uneven = [pos for pos, ln in enumerate(block) if len(ln) != ncols]
+            flag(uneven, 'wrong number of fields', None)
+            skip = set(uneven)
+            row_positions = [pos for pos in range(len(block)) if pos not in skip]
+            rows = [block[pos] for pos in row_positions]
+            if not rows:
+                return problems
+
+        # transpose the rows into columns
+        columns = dict(zip(COLUMNS, zip(*map(itemgetter(*[idx[col] for col in COLUMNS]),
+                                             rows))))
+
+        for col in REQUIRED_VALUES:
+            values = columns[col]
+            # a blank value sorts before anything but control characters
+            lowest = min(values)
+            if not lowest or lowest[0] <= ' ':
+                flag([pos for pos, v in enumerate(values) if not v.strip()],
+                     'missing ' + col, col)
+
+        for col in DATETIME_COLUMNS:
+            flag(_bad_values(columns[col], _DATETIME_RES), 'bad ISO 8601 datetime in ' + col,
+                 col)
+        for col in NUMERIC_COLUMNS:
+            flag(_bad_numbers(columns[col]), 'non-numeric ' + col, col)
+        flag(_bad_values(columns['class'], _CLASS_RES), 'bad class list', 'class')
+
+        keys = map('\x1f'.join, izip(columns['datasource'], columns['id']))
+        new_keys = set(keys)
+        if len(new_keys) == len(keys) and seen.isdisjoint(new_keys):
+            seen.update(new_keys)
+        else:
+            dups = []
+            for pos, key in enumerate(keys):
+                if key in seen:
+                    dups.append(pos)
+                else:
+                    seen.add(key)
+            flag(dups, 'duplicate id within datasource', 'id')
+
+        return problems
+
+
+def _bad_values(values, patterns):
+    """Return positions of the values that do not match; patterns are from _value_patterns.
+
+    The distinct values are checked all at once, by counting the matches over a string of
+    them, one per line.  Only if that comes up short is each value matched on its own.
+    """
+    value_re, lines_re = patterns
+    distinct = set(values)
+    lines = '\n'.join(distinct)
+    # a value with a line break in it would throw off the count
+    if lines.count('\n') == len(distinct) - 1 and len(lines_re.findall(lines)) == len(distinct):
+        return []
+
+    match = value_re.match
+    bad = set(v for v in distinct if not match(v))
+    return [pos for pos, v in enumerate(values) if v in bad]
+
+
+def _bad_numbers(values):
+    """Return positions of the values that are not numbers.
+
+    Only the arrangement of digits and other characters matters, so the values are first
+    checked with their digits replaced by 9s, which leaves far fewer distinct values to check.
+    """
+    value_re, lines_re = _NUMBER_RES
+    lines = '\n'.join(values)
+    if lines.count('\n') == len(values) - 1:
+        shapes = set(lines.translate(_NINES).split('\n'))
+        if len(lines_re.findall('\n'.join(shapes))) == len(shapes):
+            return []
+
+    match = value_re.match
+    return [pos for pos, v in enumerate(values) if not match(v)]
+
+
+def open_csv(path):
+    """Open CSV file path for reading; a file whose name ends in .gz is decompressed as read."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    # universal newlines, as some exports end lines with a bare carriage return
+    return open(path, 'rU')
+
+
+def validate_file(path, rejects_path=None):
+    """Check the event CSV at path, logging a summary; return a ValidationReport.
+
+    Rows with problems are written to rejects_path, if given.
+    """
+    logging.info('Checking %s...', path)
+    with metrics.span('validate', file=path) as span, open_csv(path) as f:
+        if rejects_path:
+            with open(rejects_path, 'wb') as rejects:
+                report = CsvValidator().validate(f, rejects)
+        else:
+            report = CsvValidator().validate(f)
+        span.set(rows=report.row_ct, bad_rows=report.bad_row_ct)
+    metrics.incr('rows_checked', report.row_ct)
+    metrics.incr('rows_with_problems', report.bad_row_ct)
+
+    report.log_summary(path)
+    if rejects_path and report.bad_row_ct:
+        logging.info('Wrote %d rows with problems to %s.', report.bad_row_ct, rejects_path)
+    return report
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+"""Columnar batch transform of incidents, using NumPy.
+
+Produces exactly the same output as IncidentUploader.process_row, but works on blocks of rows
+at a time.  Rows in the common, well-formed case are converted with array operations;
+anything the fast path cannot vouch for is handed back to process_row, so the output and the
+bad row counts always match the row-at-a-time conversion.
+"""
+
+from datetime import datetime
+import csv
+from itertools import islice
+import logging
+
+import numpy as np
+
+# number of input rows to convert at a time
+DEFAULT_BLOCK_SIZE = 50000
+
+# date/time format the fast path reads
+_DT_FORMAT = '%Y-%m-%d %H:%M:%S'
+# byte positions of the digits, and of the separators, in a 'YYYY-mm-dd HH:MM:SS' string
+_DIGIT_POS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_SEPARATORS = [(4, '-'), (7, '-'), (10, ' '), (13, ':'), (16, ':')]
+_DT_LEN = 19
+
+_DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+class BatchTransformer(object):
+    """Convert blocks of incident rows for an IncidentUploader.
+
+    Bad row counters are kept on the uploader, just as process_row does.
+    """
+
+    def __init__(self, uploader, block_size=DEFAULT_BLOCK_SIZE):
+        """Arguments:
+        uploader   -- IncidentUploader whose settings and counters to use
+        block_size -- number of input rows to convert at a time
+        """
+        self.uploader = uploader
+        self.block_size = block_size
+        # input column of each of the values the output needs
+        self.fields = uploader.source.fields
+        # whether CSV date/times are in the format the fast path reads
+        self.fast_csv_dts = uploader.source.csv_datetime_format == _DT_FORMAT
+        # UTC offset strings for the data timezone, by local hour
+        self._offsets = {}
+
+    def iter_csv_blocks(self, inf):
+        """Convert incidents CSV from file object inf; generate blocks of output rows."""
+        rdr = csv.reader(inf)
+        try:
+            header = next(rdr)
+        except StopIteration:
+            return
+
+        fields = self.uploader.input_fields
+        try:
+            idx = [header.index(col) for col in fields]
+        except ValueError:
+            # a needed column is missing; let process_row report it the same way it always has
+            idx = None
+
+        while True:
+            block = list(islice(rdr, self.block_size))
+            if not block:
+                break
+
+            if idx is None:
+                yield self._convert_dict_rows([self._as_dict(header, ln) for ln in block if ln],
+                                              False)
+                continue
+
+            # rows the same length as the header can be sliced into columns directly;
+            # DictReader skips blank rows, and pads or overflows uneven ones
+            ncols = len(header)
+            if all(len(ln) == ncols for ln in block):
+                columns = dict((col, [ln[i] for ln in block]) for col, i in zip(fields, idx))
+                self.uploader.row_ct += len(block)
+                yield self.transform_block(columns, from_arcgis=False)
+            else:
+                yield self._convert_dict_rows([self._as_dict(header, ln) for ln in block if ln],
+                                              False)
+
+    def iter_reader_blocks(self, reader):
+        """Convert incidents read by an MmapCsvReader; generate blocks of output rows."""
+        fields = reader.fields
+        rows = iter(reader)
+        while True:
+            short_ct = reader.short_ct
+            block = list(islice(rows, self.block_size))
+            if not block:
+                break
+
+            if reader.short_ct != short_ct:
+                # rows missing some fields have None for them, which only process_row expects
+                yield self._convert_dict_rows([dict(zip(fields, ln)) for ln in block], False)
+            else:
+                columns = dict(zip(fields, [list(col) for col in zip(*block)]))
+                self.uploader.row_ct += len(block)
+                yield self.transform_block(columns, from_arcgis=False)
+
+    def iter_feature_blocks(self, features):
+        """Convert ArcGIS json features; generate blocks of output rows."""
+        fields = self.uploader.input_fields
+        for start in xrange(0, len(features), self.block_size):
+            block = features[start:start + self.block_size]
+            attrs = [f.get('attributes') for f in block]
+            columns = dict((col, [a.get(col) for a in attrs]) for col in fields)
+            self.uploader.row_ct += len(block)
+            yield self.transform_block(columns, from_arcgis=True)
+
+    def transform_block(self, columns, from_arcgis):
+        """Transform one block of input columns; return list of output rows, in input order.
+
+        Arguments:
+        columns     -- dictionary of input field name to list of values, one per row
+        from_arcgis -- whether the input came from ArcGIS json or not
+                       (determines date/time formatting)
+        """
+        up = self.uploader
+        fields = self.fields
+        nrows = len(columns[fields['id']])
+        if not nrows:
+            return []
+
+        if from_arcgis:
+            dts, fast = self._arcgis_dt_strings(columns[fields['datetime']])
+        else:
+            dts = columns[fields['datetime']]
+            # date/times in any other format are left to process_row
+            fast = np.ones(nrows, dtype=bool) if self.fast_csv_dts else \
+                np.zeros(nrows, dtype=bool)
+
+        loc_dts, fast, bad_dt = self._localize(dts, fast)
+
+        # rows the fast path cannot vouch for go through process_row, one at a time
+        slow = ~fast & ~bad_dt
+        slow_rows = {}
+        for i in np.flatnonzero(slow):
+            row = dict((col, vals[i]) for col, vals in columns.items())
+            slow_rows[i] = up.process_row(row, from_arcgis)
+
+        xs = columns[fields['pointx']]
+        ys = columns[fields['pointy']]
+        good = fast & ~bad_dt
+        # process_row strips the class before checking co-ordinates
+        classes = [c.strip() if ok else None
+                   for c, ok in zip(columns[fields['class']], good.tolist())]
+        missing, non_numeric = self._coord_masks(xs, ys, good)
+        good &= ~(missing | non_numeric)
+
+        bad_dt_ct = int(bad_dt.sum())
+        missing_ct = int(missing.sum())
+        non_numeric_ct = int(non_numeric.sum())
+        up.bad_dt_ct += bad_dt_ct
+        up.missing_coords_ct += missing_ct
+        up.non_numeric_ct += non_numeric_ct
+        up.bad_row_ct += bad_dt_ct + missing_ct + non_numeric_ct
+
+        last_updated = str(up.last_updated)
+        ids = columns[fields['id']]
+        addresses = columns[fields['address']]
+        datasource = up.source.datasource
+        out_fields = up._OUT_FIELDS
+
+        outrows = []
+        for i in np.flatnonzero(good | slow):
+            if slow[i]:
+                outln = slow_rows[i]
+                if outln:
+                    outrows.append([outln.get(col, '') for col in out_fields])
+                continue
+
+            dt = loc_dts[i]
+            outrows.append([ids[i], dt, dt, classes[i], xs[i], ys[i], dt,
+                            addresses[i], last_updated, datasource])
+
+        return outrows
+
+    def _convert_dict_rows(self, rows, from_arcgis):
+        """Fall back to converting a block of dictionary rows one at a time."""
+        up = self.uploader
+        out_fields = up._OUT_FIELDS
+        outrows = []
+        for row in rows:
+            up.row_ct += 1
+            outln = up.process_row(row, from_arcgis)
+            if outln:
+                outrows.append([outln.get(col, '') for col in out_fields])
+
+        return outrows
+
+    def _as_dict(self, header, ln):
+        """Build a row dictionary the way csv.DictReader does."""
+        row = dict(zip(header, ln))
+        if len(ln) < len(header):
+            for col in header[len(ln):]:
+                row[col] = None
+        elif len(ln) > len(header):
+            row[None] = ln[len(header):]
+        return row
+
+    def _arcgis_dt_strings(self, stamps):
+        """Format ArcGIS millisecond timestamps as 'YYYY-mm-dd HH:MM:SS' strings.
+
+        Returns the strings and a mask of the rows that were formatted; rows with timestamps
+        that are not plain integers are left for process_row.
+        """
+        nrows = len(stamps)
+        fast = np.fromiter((type(s) in (int, long) for s in stamps), dtype=bool, count=nrows)
+        dts = [''] * nrows
+        if fast.any():
+            idx = np.flatnonzero(fast)
+            ms = np.array([stamps[i] for i in idx], dtype=np.int64)
+            # same integer division as process_row does under Python 2
+            secs = (ms // 1000).astype('datetime64[s]')
+            formatted = np.char.replace(np.datetime_as_string(secs), 'T', ' ').tolist()
+            for i, s in zip(idx, formatted):
+                dts[i] = s
+
+        return dts, fast
+
+    def _localize(self, dts, fast):
+        """Add the data timezone's UTC offset to well-formed date/time strings.
+
+        Arguments:
+        dts  -- list of date/time strings
+        fast -- mask of rows that may be handled here
+
+        Returns the localized strings, the mask of rows actually handled, and the mask of rows
+        whose date/time is well-formed but not a valid date.
+        """
+        nrows = len(dts)
+        lens = np.fromiter((len(s) if isinstance(s, str) else -1 for s in dts),
+                           dtype=np.int64, count=nrows)
+        fast = fast & (lens == _DT_LEN)
+        bad_dt = np.zeros(nrows, dtype=bool)
+        loc_dts = [None] * nrows
+        if not fast.any():
+            return loc_dts, fast, bad_dt
+
+        chars = np.array(dts, dtype='S%d' % _DT_LEN)
+        chars = np.frombuffer(chars.tobytes(), dtype=np.uint8).reshape(nrows, _DT_LEN)
+
+        for pos, sep in _SEPARATORS:
+            fast &= chars[:, pos] == ord(sep)
+
+        digits = chars[:, _DIGIT_POS].astype(np.int64) - ord('0')
+        fast &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+
+        year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+        month = digits[:, 4] * 10 + digits[:, 5]
+        day = digits[:, 6] * 10 + digits[:, 7]
+        hour = digits[:, 8] * 10 + digits[:, 9]
+        minute = digits[:, 10] * 10 + digits[:, 11]
+        second = digits[:, 12] * 10 + digits[:, 13]
+
+        # strptime rejects these outright; leave them to process_row
+        fast &= (month >= 1) & (month <= 12) & (hour <= 23) & (minute <= 59) & \
+            (second <= 61) & (day >= 1) & (day <= 31)
+
+        # these parse, but are not valid date/times
+        leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+        month_days = _DAYS_IN_MONTH[np.clip(month, 0, 12)] + ((month == 2) & leap)
+        invalid = (year < 1) | (day > month_days) | (second > 59)
+        bad_dt = fast & invalid
+        fast &= ~invalid
+
+        idx = np.flatnonzero(fast)
+        if not len(idx):
+            return loc_dts, fast, bad_dt
+
+        # UTC offsets only change on the hour, so look them up once per distinct local hour
+        hours = (((year[idx] * 100 + month[idx]) * 100 + day[idx]) * 100 + hour[idx])
+        uniq, inverse = np.unique(hours, return_inverse=True)
+        offsets = np.array([self._offset(int(h)) for h in uniq])
+        raw = np.array([dts[i] for i in idx], dtype='S%d' % _DT_LEN)
+        for i, s in zip(idx, np.char.add(raw, offsets[inverse]).tolist()):
+            loc_dts[i] = s
+
+        return loc_dts, fast, bad_dt
+
+    def _offset(self, hour_key):
+        """Return the UTC offset string (like '-05:00') for a local hour key YYYYmmddHH."""
+        offset = self._offsets.get(hour_key)
+        if offset is None:
+            dt = datetime(hour_key // 1000000, hour_key // 10000 % 100, hour_key // 100 % 100,
+                          hour_key % 100)
+            offset = str(self.uploader.tz.localize(dt))[_DT_LEN:]
+            self._offsets[hour_key] = offset
+        return offset
+
+    def _coord_masks(self, xs, ys, rows):
+        """Return masks of rows with missing, and with non-numeric, co-ordinates.
+
+        Only rows set in the rows mask are checked.  Co-ordinates are probed with the same
+        float() conversion that process_row uses.
+        """
+        nrows = len(xs)
+        missing = np.zeros(nrows, dtype=bool)
+        non_numeric = np.zeros(nrows, dtype=bool)
+        idx = np.flatnonzero(rows)
+        if not len(idx):
+            return missing, non_numeric
+
+        xa = np.array([xs[i] for i in idx], dtype=object)
+        ya = np.array([ys[i] for i in idx], dtype=object)
+        bad = idx[~(_numeric_mask(xa) & _numeric_mask(ya))]
+
+        # few rows are bad; sort them out with the same test process_row uses
+        for i in bad:
+            x, y = xs[i], ys[i]
+            if not x or not y or len(x) == 0 or len(y) == 0:
+                missing[i] = True
+            else:
+                non_numeric[i] = True
+
+        return missing, non_numeric
+
+
+def _numeric_mask(values):
+    """Return mask of the values in object array values that float() accepts."""
+    # NumPy turns None into nan, where float() refuses it
+    if not (values == None).any():  # noqa: E711
+        try:
+            values.astype(np.float64)
+            return np.ones(len(values), dtype=bool)
+        except (TypeError, ValueError):
+            pass
+
+    # at least one bad value in the block; find which
+    ok = np.ones(len(values), dtype=bool)
+    for i, v in enumerate(values):
+        try:
+            float(v)
+        except Exception:
+            ok[i] = False
+    logging.debug('Found %d non-numeric co-ordinate values in block.', (~ok).sum())
+    return ok
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""Resumable, conditional download of a single large file over HTTP."""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+
+# requests is imported where it is used, since it is slow to load
+
+# status values returned by Downloader.fetch
+DOWNLOADED = 'downloaded'
+NOT_MODIFIED = 'not modified'
+FAILED = 'failed'
+
+
+class Downloader(object):
+    """Download a file in large chunks, resuming partial downloads and skipping unchanged ones.
+
+    The ETag and Last-Modified validators of the last download are kept in a small JSON file
+    next to the download.  They are only saved when save_validators is called, so that a file
+    which was downloaded but never processed is fetched again on the next run.
+    """
+
+    def __init__(self, url, filename, chunk_size=1024 * 1024, timeout=None, retries=3,
+                 session=None):
+        """Arguments:
+        url        -- URL to download
+        filename   -- where to save the file
+        chunk_size -- number of bytes to read and write at a time
+        timeout    -- seconds to wait for the server to respond; defaults to the session's
+        retries    -- number of times to resume after the connection drops
+        session    -- requests.Session to use, such as one from common.make_session; a plain
+                      one is made if not given
+        """
+        self.url = url
+        self.filename = filename
+        self.part_filename = filename + '.part'
+        self.meta_filename = filename + '.meta'
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+
+        # validators of the file most recently downloaded
+        self.etag = None
+        self.last_modified = None
+
+    def fetch(self, conditional=True):
+        """Download the file, unless the server copy has not changed since it was last saved.
+
+        Arguments:
+        conditional -- if False, download even if the file has not changed
+
+        Returns DOWNLOADED, NOT_MODIFIED or FAILED.
+        """
+        import requests
+
+        meta = self._load_meta()
+        # byte ranges are of the file as stored, so it is not to be compressed on the way
+        headers = {'Accept-Encoding': 'identity'}
+        if conditional:
+            saved = meta.get('saved', {})
+            if saved.get('etag'):
+                headers['If-None-Match'] = saved['etag']
+            if saved.get('last_modified'):
+                headers['If-Modified-Since'] = saved['last_modified']
+
+        for attempt in range(self.retries + 1):
+            try:
+                status = self._fetch_once(headers, meta)
+            except (requests.exceptions.RequestException, IOError) as ex:
+                logging.warning('Download of %s interrupted: %s', self.url, ex)
+                if attempt < self.retries:
+                    logging.info('Resuming download...')
+                continue
+
+            return status
+
+        logging.error('Giving up on download of %s.', self.url)
+        return FAILED
+
+    def save_validators(self):
+        """Remember the validators of the last download, for the next conditional fetch."""
+        meta = self._load_meta()
+        meta['saved'] = {'etag': self.etag, 'last_modified': self.last_modified}
+        self._save_meta(meta)
+
+    def _fetch_once(self, request_headers, meta):
+        """Make one request for the file, resuming a partial download if there is one."""
+        headers = dict(request_headers)
+        partial = meta.get('partial', {})
+        have = 0
+        if os.path.isfile(self.part_filename) and (partial.get('etag') or
+                                                   partial.get('last_modified')):
+            have = os.path.getsize(self.part_filename)
+            headers['Range'] = 'bytes=%d-' % have
+            # only resume if the file has not changed underneath the partial download
+            headers['If-Range'] = partial.get('etag') or partial.get('last_modified')
+
+        stream = self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout)
+        if stream.status_code == 304:
+            logging.info('%s has not changed since it was last downloaded.', self.url)
+            return NOT_MODIFIED
+        elif stream.status_code == 416 and have:
+            # the partial download is complete but was never renamed, or the file has shrunk
+            # and the server ignored If-Range; asking for the same range would fail every time
+            stream.close()
+            logging.warning('Server cannot resume download of %s at byte %d; starting over.',
+                            self.url, have)
+            os.remove(self.part_filename)
+            del meta['partial']
+            self._save_meta(meta)
+            return self._fetch_once(request_headers, meta)
+        elif stream.status_code == 206:
+            logging.info('Resuming download at byte %d.', have)
+            mode = 'ab'
+            total = stream.headers.get('content-range', '').rpartition('/')[2]
+            expected = int(total) if total.isdigit() else None
+        elif stream.ok:
+            mode = 'wb'
+            length = stream.headers.get('content-length')
+            expected = int(length) if length and length.isdigit() else None
+        else:
+            logging.error('Download of %s failed with status code %d.', self.url,
+                          stream.status_code)
+            return FAILED
+
+        self.etag = stream.headers.get('etag')
+        self.last_modified = stream.headers.get('last-modified')
+        meta['partial'] = {'etag': self.etag, 'last_modified': self.last_modified}
+        self._save_meta(meta)
+
+        md5 = hashlib.md5() if mode == 'wb' and stream.headers.get('content-md5') else None
+        with open(self.part_filename, mode) as part_file:
+            for chunk in stream.iter_content(chunk_size=self.chunk_size):
+                part_file.write(chunk)
+                if md5:
+                    md5.update(chunk)
+
+        size = os.path.getsize(self.part_filename)
+        if expected is not None and size != expected:
+            if size > expected:
+                os.remove(self.part_filename)  # cannot resume from this; start over
+            raise IOError('got %d bytes of %d' % (size, expected))
+
+        if md5 and base64.b64encode(md5.digest()) != stream.headers['content-md5']:
+            logging.error('Download of %s failed checksum.', self.url)
+            os.remove(self.part_filename)
+            return FAILED
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)  # Windows will not rename over it
+        os.rename(self.part_filename, self.filename)
+        del meta['partial']
+        self._save_meta(meta)
+
+        logging.info('Downloaded %d bytes.', size)
+        return DOWNLOADED
+
+    def _load_meta(self):
+        """Load the saved validators, if any."""
+        if os.path.isfile(self.meta_filename):
+            try:
+                with open(self.meta_filename, 'rb') as meta_file:
+                    return json.load(meta_file)
+            except ValueError:
+                logging.warning('Could not read %s; ignoring it.', self.meta_filename)
+        return {}
+
+    def _save_meta(self, meta):
+        """Save the validators."""
+        with open(self.meta_filename, 'wb') as meta_file:
+            json.dump(meta, meta_file)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""Fetch incidents from many sources at once, and upload each to its own HunchLab account.
+
+Sources to fetch are listed in a configuration file, one section for each, named for its
+adapter in sources.py unless it gives another (see sources.ini.template).  Sources are fetched
+in a pool of threads, sharing one pool of HTTP connections and, for converting full CSVs, one
+pool of worker processes.  Requests to each source are spaced out to its rate limit, however
+many threads are fetching from it.
+"""
+
+from argparse import ArgumentParser
+import ConfigParser
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import threading
+import time
+# datetime.strptime imports this on first use, which fails if two threads do it at once
+import _strptime  # noqa: F401
+
+from incident_uploader import IncidentUploader, log_run_stats, make_stream_upload
+import output_formats
+import sources
+
+# logging, timings, counts and uploading are shared with the upload script, in ../eventdata
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                'eventdata'))
+import common
+import metrics
+import upload as hunchlab_upload
+
+# sources to fetch at once
+DEFAULT_CONCURRENCY = 4
+
+
+class RateLimiter(object):
+    """Space out requests so no more than a given number are started each second."""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self._lock = threading.Lock()
+        # time the next request may start
+        self._next = 0.0
+
+    def wait(self):
+        """Wait until the next request may start."""
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def read_sources_config(config_path):
+    """Read the sources to fetch from config file config_path.
+
+    Returns a list of dictionaries of settings, one for each source, in the order listed.
+    Raises ValueError if the file cannot be read, or names a source there is no adapter for.
+    """
+    config = ConfigParser.ConfigParser()
+    if not config.read(config_path):
+        raise ValueError("Couldn't read configuration file %s." % config_path)
+
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    jobs = []
+    for name in config.sections():
+        def get(option, default=None):
+            if config.has_option(name, option) and config.get(name, option).strip():
+                return config.get(name, option).strip()
+            return default
+
+        source = get('adapter', name)
+        if source not in sources.SOURCES:
+            raise ValueError('No adapter %s for source %s; known adapters are: %s.' %
+                             (source, name, ', '.join(sorted(sources.SOURCES))))
+
+        directory = os.path.join(config_dir, get('directory', name))
+        upload_config = get('uploadconfig')
+        if upload_config:
+            upload_config = os.path.join(config_dir, upload_config)
+        formats = get('formats')
+        formats = formats.split() if formats else ([] if upload_config else ['csv'])
+        for fmt in formats:
+            if fmt not in output_formats.FORMATS:
+                raise ValueError('Unknown output format %s for source %s.' % (fmt, name))
+        rate = get('requestspersecond')
+        jobs.append({'name': name,
+                     'source': source,
+                     'directory': directory,
+                     'upload_config': upload_config,
+                     'formats': formats,
+                     'batch_size': int(get('batchsize', 0)),
+                     'requests_per_second': float(rate) if rate else None})
+    return jobs
+
+
+class Scheduler(object):
+    """Fetch incidents for many sources at once, and upload each to HunchLab."""
+
+    def __init__(self, jobs, concurrency=DEFAULT_CONCURRENCY, workers=1, full_csv=False):
+        """Arguments:
+        jobs        -- settings of each source, from read_sources_config
+        concurrency -- number of sources to fetch at once
+        workers     -- number of processes, shared by all sources, to convert full CSVs with
+        full_csv    -- if True, fetch the full CSV of every source
+        """
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.workers = workers
+        self.full_csv = full_csv
+        # a rate limiter for each adapter's servers that have a limit, by adapter name;
+        # sources fetched with the same adapter share it, at the lowest rate given
+        rates = {}
+        for job in jobs:
+            rate = job['requests_per_second'] or \
+                sources.SOURCES[job['source']].requests_per_second
+            if rate:
+                rates[job['source']] = min(rate, rates.get(job['source'], rate))
+        self.rate_limiters = dict((name, RateLimiter(rate)) for name, rate in rates.items())
+        self.session = self._make_session()
+        # settings and session for each HunchLab upload configuration, by path, made when
+        # first needed; sources uploading with the same configuration share them
+        self.uploads = {}
+        self._uploads_lock = threading.Lock()
+        self.process_pool = None
+
+    def _make_session(self):
+        """Return a session with enough pooled connections for every source fetching at once."""
+        # each source may have its ArcGIS pages in flight at once
+        return common.make_session(
+            pool_connections=max(2 * len(self.jobs), 1),
+            pool_maxsize=self.concurrency * IncidentUploader._ARCGIS_CONCURRENCY)
+
+    def upload_settings(self, config_path):
+        """Return the settings and session for the HunchLab upload configuration config_path.
+
+        Raises hunchlab_upload.UploadError if the configuration cannot be read.
+        """
+        with self._uploads_lock:
+            if config_path not in self.uploads:
+                settings = hunchlab_upload.read_config(config_path)
+                self.uploads[config_path] = (settings, hunchlab_upload.make_session(settings))
+            return self.uploads[config_path]
+
+    def make_uploader(self, job):
+        """Return an IncidentUploader for the source with settings job, sharing the pools."""
+        if not os.path.isdir(job['directory']):
+            os.makedirs(job['directory'])
+        p = IncidentUploader(sources.get_source(job['source']), batch_size=job['batch_size'],
+                             workers=self.workers, output_formats=job['formats'],
+                             directory=job['directory'], session=self.session,
+                             rate_limiter=self.rate_limiters.get(job['source']),
+                             process_pool=self.process_pool)
+        p.metrics_prefix = job['name'] + '_'
+        return p
+
+    def run(self):
+        """Fetch and upload every source; return dictionary of source name to success."""
+        if self.workers > 1:
+            self.process_pool = multiprocessing.Pool(self.workers)
+        pool = ThreadPool(self.concurrency)
+        try:
+            results = pool.map(self._run_job, self.jobs)
+        finally:
+            pool.close()
+            pool.join()
+            if self.process_pool:
+                self.process_pool.close()
+                self.process_pool.join()
+                self.process_pool = None
+        return dict(zip([job['name'] for job in self.jobs], results))
+
+    def _run_job(self, job):
+        """Fetch one source, and upload it if it has an upload configuration."""
+        # log lines are labelled with the thread name
+        threading.current_thread().name = job['name']
+        start = time.time()
+        try:
+            p = self.make_uploader(job)
+            upload = None
+            if job['upload_config']:
+                settings, upload_session = self.upload_settings(job['upload_config'])
+                upload = make_stream_upload(hunchlab_upload, settings, p.OUTPUT_FILENAME,
+                                            upload_session)
+            with metrics.span('source', source=job['name']):
+                ok = p.fetch_latest(self.full_csv, upload=upload)
+        except Exception as ex:
+            logging.error('Fetching %s failed.', job['name'])
+            logging.exception(ex)
+            ok = False
+
+        metrics.gauge(job['name'] + '_succeeded', int(bool(ok)))
+        log_run_stats('Fetching %s' % job['name'], start)
+        return bool(ok)
+
+
+def main():
+    """Fetch incidents from many sources at once and upload them to HunchLab."""
+    desc = 'Fetch incidents from many sources at once and upload them to HunchLab.'
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('-c', '--config', default='sources.ini', dest='config',
+                        help='Configuration file listing the sources to fetch', metavar='FILE')
+    parser.add_argument('-j', '--concurrency', default=DEFAULT_CONCURRENCY, dest='concurrency',
+                        type=int, metavar='N', help='Fetch N sources at once')
+    parser.add_argument('-w', '--workers', default=1, dest='workers', type=int, metavar='N',
+                        help='Convert full CSVs with N worker processes, shared by all sources')
+    parser.add_argument('-f', '--full-csv', default=False, dest='full_csv',
+                        action="store_true", help='Get full CSV of all incidents of every source')
+    parser.add_argument('-m', '--metrics', dest='metrics', metavar='FILE',
+                        help='Write timings and counts to FILE: a Prometheus textfile if it ' + \
+                             'ends in .prom, otherwise JSON lines appended to it')
+    parser.add_argument('-l', '--log-level', default='info', dest='log_level',
+                        help="Log level for console output.  Defaults to 'info'.",
+                        choices=['debug', 'info', 'warning', 'error', 'critical'])
+    parser.add_argument('names', nargs='*', metavar='SOURCE',
+                        help='Sources to fetch, from those in the configuration file; ' + \
+                             'defaults to all of them')
+
+    args = parser.parse_args()
+
+    # log lines are labelled with the source they are about
+    common.setup_logging('fetch_sources.log', args.log_level, threads=True)
+
+    if args.metrics:
+        metrics.configure(args.metrics, 'fetch_sources')
+
+    try:
+        jobs = read_sources_config(args.config)
+    except ValueError as ex:
+        logging.error(ex)
+        return 3
+    if args.names:
+        unknown = set(args.names) - set(job['name'] for job in jobs)
+        if unknown:
+            logging.error('Sources not in %s: %s', args.config, ', '.join(sorted(unknown)))
+            return 3
+        jobs = [job for job in jobs if job['name'] in args.names]
+
+    start = time.time()
+    results = Scheduler(jobs, concurrency=args.concurrency, workers=args.workers,
+                        full_csv=args.full_csv).run()
+    failed = sorted(name for name, ok in results.items() if not ok)
+    log_run_stats('Fetching %d sources' % len(jobs), start)
+    if failed:
+        logging.error('No new data uploaded for: %s', ', '.join(failed))
+        return 1
+    logging.info('All done!')
+    return 0
+
+
+if __name__ == '__main__':
+    """If run from the command line."""
+    sys.exit(main())
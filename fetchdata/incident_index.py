@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""On-disk index of incidents already processed, kept in a SQLite database.
+
+Holds a hash of each output row, keyed by incident id, so that later runs can write out only
+the incidents that are new or have changed.  Also holds the time of the last check, which is
+used to decide how much data needs to be fetched.
+"""
+
+from datetime import datetime
+import hashlib
+import logging
+import sqlite3
+
+# rows of output to look up at a time; SQLite allows at most 999 parameters per statement
+_LOOKUP_BATCH = 900
+_DT_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class IncidentIndex(object):
+    """Index of incident ids to hashes of their output rows."""
+
+    def __init__(self, path):
+        """Open (or create) the index database at path."""
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS incidents '
+                          '(id TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                          '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.conn.commit()
+
+        self.inserted_ct = 0
+        self.modified_ct = 0
+        self.unchanged_ct = 0
+
+    def close(self):
+        """Close the database, discarding any uncommitted changes."""
+        self.conn.close()
+
+    def commit(self):
+        """Save the changes made by filter_blocks and set_last_check."""
+        self.conn.commit()
+
+    def rollback(self):
+        """Discard the changes made since the last commit, keeping the database open."""
+        self.conn.rollback()
+
+    def last_check(self):
+        """Return the time of the last check, or None if there has not been one."""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'last_check'").fetchone()
+        if row:
+            return datetime.strptime(row[0], _DT_FORMAT)
+        return None
+
+    def set_last_check(self, when):
+        """Record the time of the last check."""
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_check', ?)",
+                          (when.strftime(_DT_FORMAT),))
+
+    def filter_blocks(self, blocks, id_col, skip_cols=(), keep_all=False):
+        """Generate blocks of rows for incidents that are new or changed since last indexed.
+
+        The index is updated with the new hashes, but the changes are not saved until commit
+        is called.
+
+        Arguments:
+        blocks    -- iterator of lists of rows
+        id_col    -- position of the incident id in each row
+        skip_cols -- positions of columns to leave out of the hash, because they change on
+                     every run
+        keep_all  -- if True, generate all rows, while still updating the index
+        """
+        self.inserted_ct = 0
+        self.modified_ct = 0
+        self.unchanged_ct = 0
+
+        for block in blocks:
+            if not block:
+                continue
+
+            hash_cols = [i for i in range(len(block[0])) if i not in skip_cols]
+            hashes = [hashlib.sha1('\x1f'.join(_as_text(ln[i]) for i in hash_cols)).hexdigest()
+                      for ln in block]
+            known = self._lookup([ln[id_col] for ln in block])
+
+            changed = []
+            keep = []
+            for ln, row_hash in zip(block, hashes):
+                key = ln[id_col]
+                old_hash = known.get(key)
+                if old_hash == row_hash:
+                    self.unchanged_ct += 1
+                    if keep_all:
+                        keep.append(ln)
+                    continue
+                elif old_hash is None:
+                    self.inserted_ct += 1
+                else:
+                    self.modified_ct += 1
+
+                # same id may show up twice in one run; keep the last one
+                known[key] = row_hash
+                changed.append((key, row_hash))
+                keep.append(ln)
+
+            self.conn.executemany('INSERT OR REPLACE INTO incidents (id, hash) VALUES (?, ?)',
+                                  changed)
+            if keep:
+                yield keep
+
+        logging.debug('Index has %d new, %d modified and %d unchanged incidents.',
+                      self.inserted_ct, self.modified_ct, self.unchanged_ct)
+
+    def _lookup(self, keys):
+        """Return dictionary of the hashes stored for any of the given incident ids."""
+        found = {}
+        keys = list(set(keys))
+        for start in xrange(0, len(keys), _LOOKUP_BATCH):
+            batch = keys[start:start + _LOOKUP_BATCH]
+            query = 'SELECT id, hash FROM incidents WHERE id IN (%s)' % ','.join('?' * len(batch))
+            found.update(self.conn.execute(query, batch))
+        return found
+
+
+def _as_text(value):
+    """Return value as it would be written out to CSV."""
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, float):
+        return repr(value)
+    return str(value)
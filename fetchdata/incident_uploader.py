@@ -0,0 +1,993 @@
+#!/usr/bin/env python
+
+"""Fetch incidents from any source, and transform them for upload to HunchLab.
+
+What is particular to each source, such as its URLs, columns and timezone, is described by
+an adapter in sources.py.
+"""
+
+from collections import deque
+from cStringIO import StringIO
+import csv
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import chain, islice
+import locale
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import time
+import zipfile
+
+# pytz, requests and NumPy are imported where they are used, since they are slow to load;
+# printing the help or finding a bad option does not need them
+
+import downloader
+from incident_index import IncidentIndex
+from mmap_reader import MmapCsvReader
+import output_formats
+import sources
+
+# HTTP sessions, timings, counts and profiling are shared with the upload script, in
+# ../eventdata
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                'eventdata'))
+import common
+import metrics
+import profiling
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def batch_transformer():
+    """Return the BatchTransformer class for the batch conversion, or None without NumPy."""
+    try:
+        from batch_transform import BatchTransformer
+    except ImportError:
+        return None
+    return BatchTransformer
+
+
+def _peak_rss_mb():
+    """Return peak resident set size of this process in megabytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on OS X
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def log_run_stats(label, start):
+    """Log wall time since start and peak memory use, for comparing fetch modes."""
+    peak = _peak_rss_mb()
+    if peak is None:
+        logging.info('%s took %.1f seconds.', label, time.time() - start)
+    else:
+        logging.info('%s took %.1f seconds; peak RSS %.1f MB.', label, time.time() - start, peak)
+
+
+def make_stream_upload(hunchlab_upload, settings, filename, s=None):
+    """Return function uploading chunks of CSV data to HunchLab, for fetch_latest's upload.
+
+    Arguments:
+    hunchlab_upload -- the upload module, from ../eventdata
+    settings        -- upload settings, from hunchlab_upload.read_config
+    filename        -- name to give the uploaded file
+    s               -- session to upload with, from hunchlab_upload.make_session; one is made
+                       for each upload if not given
+    """
+    def stream_upload(chunks):
+        """Upload chunks of CSV data to HunchLab; return true if the import completed."""
+        try:
+            hunchlab_upload.upload(settings, chunks, os.path.basename(filename), s=s)
+        except hunchlab_upload.UploadError as ex:
+            logging.error(ex)
+            return False
+        return True
+    return stream_upload
+
+
+class FetchError(Exception):
+    """Fetching or converting incident data failed.  The cause has already been logged."""
+    pass
+
+
+class IncidentUploader(object):
+    """Download crime data from a source and transform it for upload to HunchLab."""
+
+    # constants
+
+    # incidents to fetch from ArcGIS per request, and requests to have in flight at once
+    _ARCGIS_PAGE_SIZE = 1000
+    _ARCGIS_CONCURRENCY = 4
+    # bytes to read and write at a time when downloading zipfile
+    _DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    _INDEX_FILENAME = 'incident_index.db'
+    # number of output rows to pass along at a time
+    _BLOCK_SIZE = 10000
+    _OUT_FIELDS = ['id', 'datetimeto', 'datetimefrom', 'class', 'pointx',
+            'pointy', 'report_time', 'address', 'last_updated', 'datasource']
+
+    def __init__(self, source, stream_zip=False, batch_size=0, workers=1, emit_all=False,
+                 output_formats=('csv',), use_mmap=True, directory=None, session=None,
+                 rate_limiter=None, process_pool=None):
+        """Set some variables for the data fetch.
+
+        Arguments:
+        source     -- sources.Source to fetch from
+        stream_zip -- if True, read the incident CSV straight out of the downloaded zipfile
+                      instead of extracting it to disk first
+        batch_size -- if set, convert incidents in blocks of this many rows with NumPy,
+                      instead of one row at a time
+        workers    -- number of processes to convert the full incident CSV with
+        emit_all   -- if True, write out all incidents fetched, not only new or changed ones
+        output_formats -- formats to write the output in, from output_formats.FORMATS;
+                          all are written in the same pass
+        use_mmap   -- if True, read only the needed columns of an extracted incident CSV,
+                      through a memory map of it, instead of with csv.DictReader
+        directory  -- directory to download to and write output in; defaults to the current
+                      directory
+        session    -- requests.Session to fetch with, shared with other uploaders; one from
+                      common.make_session is made if not given
+        rate_limiter -- if given, its wait method is called before each request to the source
+        process_pool -- multiprocessing.Pool to convert the full incident CSV with, shared
+                        with other uploaders; one of workers processes is made if not given
+        """
+        self.source = source
+        self.input_fields = source.input_fields()
+        # input columns process_row reads
+        self._id_col = source.fields['id']
+        self._dt_col = source.fields['datetime']
+        self._class_col = source.fields['class']
+        self._x_col = source.fields['pointx']
+        self._y_col = source.fields['pointy']
+        self._address_col = source.fields['address']
+        self.directory = directory
+        self.session = session
+        self.rate_limiter = rate_limiter
+        self.process_pool = process_pool
+        # prefix of the names of the metrics recorded, to tell sources apart
+        self.metrics_prefix = ''
+        self.OUTPUT_FILENAME = self._path(source.output_filename)
+        self.use_mmap = use_mmap
+        self.stream_zip = stream_zip
+        self.output_formats = list(output_formats)
+        self.arcgis_url = source.arcgis_url
+        self.arcgis_page_size = self._ARCGIS_PAGE_SIZE
+        self.arcgis_concurrency = self._ARCGIS_CONCURRENCY
+        if self.session is None:
+            # kept for the download and every ArcGIS query; one connection for each page in
+            # flight at once
+            self.session = common.make_session(pool_maxsize=self.arcgis_concurrency)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.emit_all = emit_all
+        if workers > 1 and stream_zip:
+            # shards are read by byte offset, so the CSV has to be on disk
+            logging.warning('Cannot stream zipfile with multiple workers.  Extracting it instead.')
+            self.stream_zip = False
+        self.batch = None
+        if batch_size:
+            BatchTransformer = batch_transformer()
+            if BatchTransformer:
+                self.batch = BatchTransformer(self, batch_size)
+            else:
+                logging.warning('NumPy is not installed.  Converting one row at a time.')
+        import pytz
+        self.tz = pytz.timezone(source.timezone)  # timezone of the fetched data
+        
+        # use the default locale
+        locale.setlocale(locale.LC_ALL, '')
+
+        self.last_updated = self.tz.localize(datetime.today())
+
+        self.row_ct = 0
+        self.bad_row_ct = 0
+        self.missing_coords_ct = 0
+        self.non_numeric_ct = 0
+        self.bad_dt_ct = 0
+
+        # files will be downloaded to the given directory, or else the current directory
+        self.ddir = directory or os.getcwd()
+
+        # index of incidents already processed, and time of the last check,
+        # used to decide how much data needs to be fetched and written out
+        self.index_path = os.path.join(self.ddir, self._INDEX_FILENAME)
+
+        # zipfile download; skipped if the server copy has not changed since the last run,
+        # unless forced
+        self.zip_path = self._path(source.zip_filename)
+        self.downloader = downloader.Downloader(source.zip_url, self.zip_path,
+                                                chunk_size=self._DOWNLOAD_CHUNK_SIZE,
+                                                session=self.session)
+        self.force_download = False
+        self.download_not_modified = False
+        # whether the last fetch failed, as opposed to finding nothing new
+        self.failed = False
+        self.index = None
+        # if True, the incident index is kept open from one fetch to the next, as a
+        # long-running process does
+        self.keep_index_open = False
+        # saves the index and zipfile validators of a fetch whose output is not uploaded yet;
+        # see fetch_latest
+        self._pending_commit = None
+        self.inserted_ct = 0
+        self.modified_ct = 0
+
+    def _path(self, filename):
+        """Return path of filename in the directory given, if any."""
+        if self.directory:
+            return os.path.join(self.directory, filename)
+        return filename
+
+    def _wait_for_rate_limit(self):
+        if self.rate_limiter:
+            self.rate_limiter.wait()
+
+    def need_to_get_csv(self):
+        """Check if can fetch data from ArcGIS; return True if need full CSV instead"""
+        get_csv = True  # set back to False if can actually use ArcGIS data
+        if not self.arcgis_url:
+            logging.info('No ArcGIS layer of recent incidents for %s.  Fetching full CSV.',
+                         self.source.name)
+            return get_csv
+
+        try:
+            self.last_check = self.index.last_check()
+        except:
+            logging.warning("Couldn't read time of last check.  Fetching full CSV.")
+            return get_csv
+
+        if self.last_check:
+            self.since_last_check = datetime.now() - self.last_check
+            logging.info("Loaded last time check: ")
+            logging.info(self.last_check)
+            logging.info(str(self.since_last_check.days) + " days since last check.")
+            if self.since_last_check < timedelta(days=self.source.arcgis_days):
+                logging.info('Last check was less than %d days ago.  ' + \
+                    'Fetching from ArcGIS.', self.source.arcgis_days)
+                get_csv = False
+            else:
+                logging.info('Last check was more than %d days ago.  ' + \
+                    'Fetching full CSV.', self.source.arcgis_days)
+        else:
+            logging.info("Couldn't find time of last check in %s.", self._INDEX_FILENAME)
+            logging.info('(This may be the first time this script has been run.)')
+            logging.info('Fetching full CSV.')
+
+        return get_csv
+
+    def fetch_latest(self, get_csv=False, upload=None, commit=True):
+        """Fetch the latest crime incident data from the source.
+
+        Check if last fetch was within the days the source's ArcGIS layer covers; fetch from
+        ArcGIS if so.  Fetch zipped CSV of all incidents if not, or if get_csv argument is True.
+
+        Arguments:
+        get_csv -- if True, fetch the zipped CSV of all incidents
+        upload  -- if given, a function to stream the output to instead of writing the output
+                   CSV file; it is called with an iterator of chunks of CSV data, and should
+                   return True if the upload succeeded
+        commit  -- if False, and the output is written to file rather than streamed, the
+                   incident index and the zipfile's validators are not saved until commit is
+                   called, once the output has been uploaded; rollback discards them instead,
+                   so the incidents are written out again next time
+
+        Returns true if successful, and there was new data.
+        """
+        if self._pending_commit is not None:
+            logging.warning('Output of the last fetch was neither committed nor rolled back.  '
+                            'Rolling it back.')
+            self.rollback()
+        self.since_last_check = 0  # time since last check
+        self.failed = False
+        self.download_not_modified = False
+        self.last_updated = self.tz.localize(datetime.today())
+        if self.index is None:
+            self.index = IncidentIndex(self.index_path)
+        start = time.time()
+        try:
+            return self._fetch_latest(get_csv, upload, commit or upload is not None)
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            self._record_metrics(time.time() - start)
+            if self._pending_commit is None:
+                self._release_index()
+
+    def commit(self):
+        """Save the incident index and zipfile validators held back by fetch_latest.
+
+        Call once the output of fetch_latest, called with commit False, has been uploaded.
+        """
+        if self._pending_commit is None:
+            return
+        try:
+            self._pending_commit()
+        finally:
+            self._pending_commit = None
+            self._release_index()
+
+    def rollback(self):
+        """Discard the incident index changes held back by fetch_latest.
+
+        Call if the output of fetch_latest, called with commit False, could not be uploaded.
+        """
+        if self._pending_commit is None:
+            return
+        self._pending_commit = None
+        self._release_index()
+        logging.info('Incident index left as it was, so these incidents are sent next time.')
+
+    def _release_index(self):
+        """Discard uncommitted changes to the incident index, and close it unless kept open."""
+        if self.keep_index_open:
+            # only what was committed is kept, as when the index is closed
+            self.index.rollback()
+        else:
+            self.index.close()
+            self.index = None
+
+    def _save_state(self, get_csv):
+        """Save the incident index, with the time of this check, and the zipfile validators."""
+        self.index.set_last_check(datetime.now())
+        self.index.commit()
+        logging.info('Wrote last check time to %s.', self._INDEX_FILENAME)
+        if get_csv:
+            self.downloader.save_validators()
+
+    def _record_metrics(self, seconds):
+        """Record the row counts of the fetch, and how fast rows were converted."""
+        prefix = self.metrics_prefix
+        metrics.gauge(prefix + 'rows', self.row_ct)
+        metrics.gauge(prefix + 'bad_rows', self.bad_row_ct)
+        metrics.gauge(prefix + 'missing_coords_rows', self.missing_coords_ct)
+        metrics.gauge(prefix + 'non_numeric_coords_rows', self.non_numeric_ct)
+        metrics.gauge(prefix + 'bad_datetime_rows', self.bad_dt_ct)
+        metrics.gauge(prefix + 'new_incidents', self.index.inserted_ct)
+        metrics.gauge(prefix + 'changed_incidents', self.index.modified_ct)
+        if seconds > 0:
+            metrics.gauge(prefix + 'rows_per_second', self.row_ct / seconds)
+
+    def _fetch_latest(self, get_csv, upload, commit):
+        """Fetch the latest data with the incident index open; see fetch_latest."""
+        self.force_download = get_csv
+        if not get_csv:
+            get_csv = self.need_to_get_csv()
+
+        if get_csv:
+            # get zipped CSV file of all incidents reported since 2005
+            blocks = self.iter_csv_rows()
+        else:
+            # fetch json from ArcGIS for the days since the last check
+            get_days = self.since_last_check.days + self.source.overlap_days
+            logging.info('Fetching incident data for the last %d days.', get_days)
+            blocks = self.iter_arcgis_rows(get_days)
+
+        # keep only incidents that are new or changed since they were last written out;
+        # last_updated changes on every run, so leave it out when comparing rows
+        blocks = self.index.filter_blocks(blocks, self._OUT_FIELDS.index('id'),
+                                          skip_cols=[self._OUT_FIELDS.index('last_updated')],
+                                          keep_all=self.emit_all)
+
+        uploaded = None  # if upload successful or not, if there was one
+        # the blocks are fetched and converted as they are written out or uploaded
+        with profiling.stage('get_csv' if get_csv else 'fetch_arcgis'):
+            if upload:
+                got_new_data, uploaded = self._upload_output(blocks, upload)
+            else:
+                got_new_data = self.write_output(blocks)  # if data fetch successful or not
+
+        if got_new_data:
+            if self.row_ct > 0:
+                logging.info('All done making CSV for HunchLab!')
+                logging.info('Converted %s rows.', locale.format("%d",
+                             self.row_ct - self.bad_row_ct, grouping=True))
+                logging.info('Encountered %s rows that cannot be used.',
+                              locale.format("%d", self.bad_row_ct, grouping=True))
+
+                if self.bad_row_ct > 0:
+                    logging.info('Of those, %s are missing co-ordinates,',
+                                 locale.format("%d", self.missing_coords_ct, grouping=True))
+                    logging.info('%s have non-numeric values for co-ordinates,',
+                                 locale.format("%d", self.non_numeric_ct, grouping=True))
+                    logging.info('and %s have unrecognized values for the dispatch date/time.',
+                                 locale.format("%d", self.bad_dt_ct, grouping=True))
+
+                self.inserted_ct = self.index.inserted_ct
+                self.modified_ct = self.index.modified_ct
+                logging.info('Found %s new incidents, %s changed incidents, ' + \
+                             'and %s unchanged incidents.',
+                             locale.format("%d", self.index.inserted_ct, grouping=True),
+                             locale.format("%d", self.index.modified_ct, grouping=True),
+                             locale.format("%d", self.index.unchanged_ct, grouping=True))
+
+                if uploaded is False:
+                    # leave the index as it was, so these incidents are sent again next time
+                    logging.error('Upload to HunchLab failed.')
+                    self.failed = True
+                    return False
+
+                if self.inserted_ct + self.modified_ct == 0 and not self.emit_all:
+                    self._save_state(get_csv)
+                    logging.warning('All done fetching data.  No new or changed incidents found.')
+                    return False  # nothing to upload
+
+                if commit:
+                    # save the index, with the new time check
+                    self._save_state(get_csv)
+                else:
+                    # saved by commit once the output is uploaded, or discarded by rollback
+                    self._pending_commit = partial(self._save_state, get_csv)
+
+                if upload:
+                    logging.info('Output streamed to HunchLab.')
+                else:
+                    logging.info('Output written to %s.', ', '.join(
+                        output_formats.output_path(self.OUTPUT_FILENAME, fmt)
+                        for fmt in self.output_formats))
+                return True  # success!
+            else:
+                logging.warning('All done fetching data.  No new data found.')
+                return False  # nothing to upload
+        elif self.download_not_modified:
+            logging.warning('Incident zipfile has not changed since the last run.  ' + \
+                'No new data found.')
+            self.index.set_last_check(datetime.now())
+            self.index.commit()
+            return False  # nothing to upload
+        else:
+            logging.error('Encountered error fetching data.  Data fetch failed.')
+            self.failed = True
+            return False
+
+    def write_output(self, blocks):
+        """Write blocks of output rows to the output file in each of the output formats.
+
+        Returns true if successful.
+        """
+        writers = self._open_writers()
+        try:
+            for block in self._tee_blocks(blocks, writers):
+                pass
+        except FetchError:
+            return False
+        finally:
+            self._close_writers(writers)
+
+        return True
+
+    def _open_writers(self):
+        """Return a writer for each of the output formats."""
+        return [output_formats.open_writer(fmt,
+                                           output_formats.output_path(self.OUTPUT_FILENAME, fmt),
+                                           self._OUT_FIELDS)
+                for fmt in self.output_formats]
+
+    def _tee_blocks(self, blocks, writers):
+        """Write each block of output rows with all of writers, then pass it on."""
+        for block in blocks:
+            with metrics.span('write'):
+                for writer in writers:
+                    writer.write_block(block)
+            yield block
+
+    def _close_writers(self, writers):
+        """Finish writing the output files, and report their sizes and times."""
+        for writer in writers:
+            writer.close()
+        if writers:
+            sizes = output_formats.log_sizes(writers)
+            prefix = self.metrics_prefix
+            for writer in writers:
+                name = writer.fmt.replace('.', '_')
+                metrics.gauge(prefix + 'output_bytes_' + name, sizes[writer.fmt])
+                metrics.gauge(prefix + 'output_seconds_' + name, writer.seconds)
+
+    def csv_chunks(self, blocks, chunk_size=64 * 1024):
+        """Generate the output CSV, header first, as chunks of about chunk_size bytes."""
+        buf = StringIO()
+        wtr = csv.writer(buf)
+        wtr.writerow(self._OUT_FIELDS)
+        for block in blocks:
+            wtr.writerows(block)
+            if buf.tell() >= chunk_size:
+                yield buf.getvalue()
+                buf = StringIO()
+                wtr = csv.writer(buf)
+
+        if buf.tell():
+            yield buf.getvalue()
+
+    def _upload_output(self, blocks, upload):
+        """Stream blocks of output rows to the upload function, if there are any.
+
+        The output formats, if any, are written from the same blocks as they are streamed.
+        Returns whether the data fetch succeeded, and whether the upload succeeded
+        (None if there was nothing to upload).
+        """
+        try:
+            # don't start an upload unless there is something to send
+            first = next(blocks, None)
+            if first is None:
+                return True, None
+
+            logging.info('Streaming data to HunchLab now.')
+            writers = self._open_writers()
+            try:
+                return True, upload(self.csv_chunks(
+                    self._tee_blocks(chain([first], blocks), writers)))
+            finally:
+                self._close_writers(writers)
+        except FetchError:
+            return False, None
+
+    def fetch_from_arcgis(self, num_days):
+        """Fetch the most recent incidents from the ArcGIS server.
+
+        params: num_days -- the number of days to fetch (must be within the ArcGIS layer)
+        Returns true if successful.
+        """
+        return self.write_output(self.iter_arcgis_rows(num_days))
+
+    def iter_arcgis_rows(self, num_days):
+        """Fetch the most recent incidents from the ArcGIS server; generate blocks of output rows.
+
+        params: num_days -- the number of days to fetch (must be within the ArcGIS layer)
+        Raises FetchError if the fetch failed.
+        """
+        # verify got valid argument
+        try:
+            num_days = float(num_days)
+            if num_days > self.source.arcgis_days:
+                raise Exception('Number of days to fetch from ArcGIS must be <= %d.' %
+                                self.source.arcgis_days)
+        except:
+            logging.error('Got invalid value %d for number of days to fetch.', num_days)
+            raise FetchError('Invalid number of days.')  # bail
+
+        where_clause = self.source.arcgis_where(num_days)
+
+        session = self.session
+
+        # find out how many incidents there are, to know how many pages to fetch
+        logging.info('Counting recent incidents...')
+        count = self._arcgis_query(session, {'where': where_clause, 'returnCountOnly': 'true'})
+        if count is None or 'count' not in count:
+            raise FetchError('Could not count recent incidents.')
+        count = count['count']
+
+        offsets = range(0, count, self.arcgis_page_size)
+        logging.info('Fetching %d recent incidents in %d pages...', count, len(offsets))
+        logging.info('Using date last updated: %s', str(self.last_updated))
+
+        # count rows, and rows with unusable data
+        self.row_ct = 0
+        self.bad_row_ct = 0
+        self.missing_coords_ct = 0
+        self.non_numeric_ct = 0
+        self.bad_dt_ct = 0
+
+        # fetch pages in threads, keeping a bounded number in flight;
+        # convert each page, in order, as soon as it arrives
+        pool = ThreadPool(self.arcgis_concurrency)
+        pending = deque()
+        offsets = iter(offsets)
+        try:
+            while True:
+                while len(pending) < self.arcgis_concurrency:
+                    offset = next(offsets, None)
+                    if offset is None:
+                        break
+                    params = {'where': where_clause,
+                              'outFields': ','.join(self.input_fields),
+                              'orderByFields': self.source.arcgis_order_field,
+                              'resultOffset': offset,
+                              'resultRecordCount': self.arcgis_page_size}
+                    pending.append(pool.apply_async(self._arcgis_query, (session, params)))
+
+                if not pending:
+                    break
+
+                with metrics.span('download'):
+                    page = pending.popleft().get()
+                if page is None:
+                    raise FetchError('Could not fetch page of recent incidents.')
+
+                features = page.get('features', [])
+                if page.get('exceededTransferLimit') and \
+                    len(features) < self.arcgis_page_size:
+
+                    logging.error('ArcGIS server returns fewer than %d incidents per page.',
+                                  self.arcgis_page_size)
+                    raise FetchError('ArcGIS page size too large.')
+
+                for block in self._iter_features(features):
+                    yield block
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _arcgis_query(self, session, params):
+        """Send a query to the ArcGIS server; return the decoded response, or None on error."""
+        params = dict(params, f='json')
+        self._wait_for_rate_limit()
+        with metrics.span('arcgis_request'):
+            r = session.get(self.arcgis_url, params=params)
+        if not r.ok:
+            logging.error('ArcGIS server returned status code: %d', r.status_code)
+            logging.debug('ArcGIS response:  %s', r.text)
+            return None
+
+        with metrics.span('parse'):
+            result = r.json()
+        if 'error' in result:
+            # ArcGIS reports query errors with a 200 status
+            logging.error('ArcGIS server returned error: %s', result['error'])
+            return None
+        return result
+
+    def _iter_features(self, features):
+        """Convert a page of ArcGIS json features; generate blocks of output rows."""
+        if self.batch:
+            blocks = self.batch.iter_feature_blocks(features)
+        else:
+            rows = (dict((col, f.get('attributes').get(col)) for col in self.input_fields)
+                    for f in features)
+            blocks = self._iter_process_rows(rows, from_arcgis=True)
+        blocks = metrics.timed_iter('transform', blocks, size=len)
+
+        try:
+            for block in blocks:
+                yield block
+        except Exception:
+            logging.error('Could not process ArcGIS data.')
+            raise FetchError('Could not process ArcGIS data.')
+
+    def download_latest_csv_zipfile(self, extract=True):
+        """Download latest incident zipfile; return true if successful.
+
+        Arguments:
+        extract -- if True, extract the zipfile contents to the download directory;
+                   otherwise only check that the archive holds the expected files
+        """
+        bad_download = True
+        logging.info('Downloading file...')
+        self._wait_for_rate_limit()
+        with metrics.span('download'):
+            status = self.downloader.fetch(conditional=not self.force_download)
+        if status == downloader.NOT_MODIFIED:
+            self.download_not_modified = True
+            return False
+        elif status == downloader.DOWNLOADED:
+            # check the archive holds the expected files before extracting anything;
+            # member checksums are verified as the members are read
+            if zipfile.is_zipfile(self.zip_path):
+                with zipfile.ZipFile(self.zip_path) as z:
+                    names = z.namelist()
+                    updated_filename = self.source.updated_filename
+                    if self.source.csv_filename in names and \
+                        (not updated_filename or updated_filename in names):
+
+                        if extract:
+                            with metrics.span('decompress'):
+                                z.extractall(path=self.ddir)
+                        bad_download = False
+
+        if bad_download:
+            logging.error('Failed to download %s.', self.downloader.url)
+            return False
+        else:
+            logging.info('Download complete.')
+            return True
+
+    def set_last_updated(self, updated_str):
+        """Set date last updated from the contents of the source's last updated file."""
+        logging.info('Last updated file contents: %s', updated_str)
+
+        try:
+            updated_dt = self.source.parse_last_updated(updated_str)
+            self.last_updated = self.tz.localize(updated_dt)
+        except:
+            logging.info('Failed to extract date last updated.  Using today.')
+            self.last_updated = self.tz.localize(datetime.today())
+
+        logging.info('Using date last updated: %s', self.last_updated)
+
+    def get_csv(self):
+        """Fetch and process the contents of the zipped CSV file of incidents."""
+        return self.write_output(self.iter_csv_rows())
+
+    def iter_csv_rows(self):
+        """Fetch the zipped CSV file of incidents; generate blocks of output rows.
+
+        Raises FetchError if the fetch failed.
+        """
+        start = time.time()
+        if not self.download_latest_csv_zipfile(extract=not self.stream_zip):
+            raise FetchError('Could not download incidents zipfile.')
+
+        source = self.source
+        if source.updated_filename:
+            logging.info('Checking last date updated...')
+        if self.stream_zip:
+            # read both files straight out of the archive; nothing is extracted to disk
+            with zipfile.ZipFile(self.zip_path) as z:
+                if source.updated_filename:
+                    self.set_last_updated(z.read(source.updated_filename).strip())
+                with z.open(source.csv_filename) as inf:
+                    for block in self.iter_converted_rows(inf):
+                        yield block
+        else:
+            if source.updated_filename:
+                with open(self._path(source.updated_filename), 'rb') as inf_update:
+                    self.set_last_updated(inf_update.read().strip())
+
+            input_path = self._path(source.csv_filename)
+            if self.workers > 1:
+                for block in self.iter_sharded_rows(input_path):
+                    yield block
+            else:
+                with open(input_path, 'rb') as inf:
+                    for block in self.iter_converted_rows(inf):
+                        yield block
+
+        log_run_stats('Streamed zipfile fetch' if self.stream_zip else 'Extracted zipfile fetch',
+                       start)
+
+    def convert_csv(self, inf):
+        """Convert incidents CSV read from file object inf to the HunchLab output CSV.
+
+        Returns true if successful.
+        """
+        return self.write_output(self.iter_converted_rows(inf))
+
+    def iter_converted_rows(self, inf):
+        """Convert incidents CSV read from file object inf; generate blocks of output rows.
+
+        Raises FetchError if the conversion failed.
+        """
+        logging.info('Converting CSV file contents...')
+
+        # count rows, and rows with unusable data
+        self.row_ct = 0
+        self.bad_row_ct = 0
+        self.missing_coords_ct = 0
+        self.non_numeric_ct = 0
+        self.bad_dt_ct = 0
+
+        reader = self._open_mmap_reader(inf)
+        if self.batch:
+            # reading and converting are one step here
+            if reader:
+                blocks = self.batch.iter_reader_blocks(reader)
+            else:
+                blocks = self.batch.iter_csv_blocks(inf)
+        else:
+            rows = reader.iter_dicts() if reader else csv.DictReader(inf)
+            rows = metrics.timed_iter('parse', rows)
+            blocks = self._iter_process_rows(rows, from_arcgis=False)
+        blocks = metrics.timed_iter('transform', blocks, size=len)
+
+        try:
+            for block in blocks:
+                yield block
+        except Exception:
+            logging.error('Could not process CSV data.')
+            raise FetchError('Could not process CSV data.')
+        finally:
+            if reader:
+                reader.close()
+
+    def _open_mmap_reader(self, inf):
+        """Return an MmapCsvReader of the input fields of inf, or None if it cannot have one.
+
+        Only a file on disk can be memory-mapped, so not a file streamed from the zipfile.
+        """
+        if not self.use_mmap or not isinstance(inf, file):
+            return None
+        try:
+            return MmapCsvReader(inf, self.input_fields)
+        except ValueError:
+            # no header, or columns missing; DictReader reports those the way it always has
+            inf.seek(0)
+            return None
+
+    def _iter_process_rows(self, rows, from_arcgis):
+        """Run input rows through process_row; generate blocks of output rows."""
+        block = []
+        for ln in rows:
+            self.row_ct += 1
+            outln = self.process_row(ln, from_arcgis)
+            if outln:
+                block.append([outln[col] for col in self._OUT_FIELDS])
+                if len(block) >= self._BLOCK_SIZE:
+                    yield block
+                    block = []
+
+        if block:
+            yield block
+
+    def iter_sharded_rows(self, input_filename):
+        """Convert incidents CSV file in parallel, with one shard per worker process.
+
+        The file is split into byte ranges on record boundaries, so quoted fields with
+        embedded newlines stay in one shard.  Generates blocks of output rows from the shards
+        in their original order.  Raises FetchError if the conversion failed.
+        """
+        shards = _shard_offsets(input_filename, self.workers)
+        logging.info('Converting CSV file contents in %d shards...', len(shards))
+
+        tasks = []
+        for num, (start, end) in enumerate(shards):
+            tasks.append({'source': self.source.name,
+                          'input_filename': input_filename,
+                          'output_filename': '%s.part%d' % (self.OUTPUT_FILENAME, num),
+                          'start': start,
+                          'end': end,
+                          'last_updated': self.last_updated,
+                          'batch_size': self.batch_size})
+
+        pool = self.process_pool or multiprocessing.Pool(self.workers)
+        try:
+            with metrics.span('transform', shards=len(tasks)):
+                results = pool.map(_convert_shard, tasks)
+        finally:
+            if pool is not self.process_pool:
+                pool.close()
+                pool.join()
+
+        self.row_ct = 0
+        self.bad_row_ct = 0
+        self.missing_coords_ct = 0
+        self.non_numeric_ct = 0
+        self.bad_dt_ct = 0
+
+        for result in results:
+            self.row_ct += result['row_ct']
+            self.bad_row_ct += result['bad_row_ct']
+            self.missing_coords_ct += result['missing_coords_ct']
+            self.non_numeric_ct += result['non_numeric_ct']
+            self.bad_dt_ct += result['bad_dt_ct']
+
+        try:
+            if not all(result['converted'] for result in results):
+                raise FetchError('Could not process CSV data.')
+
+            for task in tasks:
+                with open(task['output_filename'], 'rb') as partf:
+                    rdr = csv.reader(partf)
+                    next(rdr)  # each shard has its own header
+                    while True:
+                        block = list(islice(rdr, self._BLOCK_SIZE))
+                        if not block:
+                            break
+                        yield block
+        finally:
+            for task in tasks:
+                if os.path.exists(task['output_filename']):
+                    os.remove(task['output_filename'])
+
+    def process_row(self, row, from_arcgis):
+        """Take row of input and return row of output for CSV.
+
+        Arguments:
+        row         -- row of input data, as a dictionary
+        from_arcgis -- whether the input came from ArcGIS json or not
+                       (determines date/time formatting)
+        """
+        outln = {}
+        try:
+            report_dt = row[self._dt_col]
+            if from_arcgis:
+                # ArcGIS returns timestamp
+                loc_report_dt = str(self.tz.localize(
+                    datetime.utcfromtimestamp(float(report_dt / 1000))))
+            else:
+                # CSV has formatted date/time strings
+                loc_report_dt = str(self.tz.localize(
+                    self.source.parse_csv_datetime(report_dt)))
+        except:
+            self.bad_dt_ct += 1
+            self.bad_row_ct += 1
+            return False      # skip this row
+
+        outln['id'] = row[self._id_col]
+        outln['datetimeto'] = loc_report_dt
+        outln['datetimefrom'] = loc_report_dt
+        outln['class'] = row[self._class_col].strip()
+
+        pointx = row[self._x_col]
+        pointy = row[self._y_col]
+        try:
+            float(pointx)
+            float(pointy)
+        except:
+            if not pointx or not pointy or len(pointx) == 0 or len(pointy) == 0:
+
+                # missing co-ordinates for this row; skip it
+                self.missing_coords_ct += 1
+            else:
+                # co-ordinate(s) for this row look non-numeric; skip it
+                self.non_numeric_ct += 1
+
+            self.bad_row_ct += 1
+            return False  # skip this row
+
+        outln['pointx'] = pointx
+        outln['pointy'] = pointy
+        outln['report_time'] = loc_report_dt
+        outln['address'] = row[self._address_col]
+        outln['last_updated'] = str(self.last_updated)
+        outln['datasource'] = self.source.datasource
+
+        return outln
+
+
+def _shard_offsets(filename, num_shards):
+    """Split CSV file into num_shards byte ranges that start and end on record boundaries.
+
+    A record ends at a line end outside of any quoted field, as in upload._iter_records, so
+    a quoted field with embedded newlines is never split between shards.  Telling which line
+    ends those are means counting quotes from the start of the file, so the whole file is
+    read once.  Returns a list of (start, end) offsets; the header record is not included in
+    any range.
+    """
+    size = os.path.getsize(filename)
+    bounds = []
+    pos = 0
+    quotes = 0
+    with open(filename, 'rb') as inf:
+        for line in inf:
+            pos += len(line)
+            quotes += line.count('"')
+            if quotes % 2:
+                continue  # inside a quoted field
+            if not bounds:
+                # end of the header record
+                bounds.append(pos)
+                shard_size = max((size - pos) // num_shards, 1)
+            elif len(bounds) < num_shards and pos >= bounds[0] + len(bounds) * shard_size:
+                bounds.append(pos)
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _read_shard(inf, start, end):
+    """Generate the header line of CSV file inf, then its lines within byte range start-end."""
+    inf.seek(0)
+    yield inf.readline()
+    inf.seek(start)
+    pos = start
+    while pos < end:
+        line = inf.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def _convert_shard(task):
+    """Convert one shard of the incidents CSV in a worker process; return its counters."""
+    p = IncidentUploader(sources.get_source(task['source']), batch_size=task['batch_size'])
+    p.last_updated = task['last_updated']
+    p.OUTPUT_FILENAME = task['output_filename']
+    with open(task['input_filename'], 'rb') as inf:
+        converted = p.convert_csv(_read_shard(inf, task['start'], task['end']))
+
+    return {'converted': converted,
+            'row_ct': p.row_ct,
+            'bad_row_ct': p.bad_row_ct,
+            'missing_coords_ct': p.missing_coords_ct,
+            'non_numeric_ct': p.non_numeric_ct,
+            'bad_dt_ct': p.bad_dt_ct}
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""Reader of only some columns of a CSV file on disk, through a memory map of the file.
+
+csv.DictReader builds a dictionary of every column for every row, though IncidentUploader only
+uses six of the incident CSV's columns.  This reader finds the columns it needs in the header
+once, and picks just those out of each row with operator.itemgetter, so the rest of the
+fields are dropped as soon as the row is split.  Lines come straight out of the memory map,
+without going through a file buffer.
+
+Rows are split by csv's own C parser, so quoted fields, with commas or line ends in them,
+come out just as csv.DictReader would give them.  So do odd rows: blank lines are skipped,
+and a row too short to have a column gives None for it.
+
+(Matching the needed fields out of the map with a regular expression, to copy only them,
+was tried first; csv's parser splitting the whole row is faster than that.)
+"""
+
+import csv
+import mmap
+from operator import itemgetter
+
+
+class MmapCsvReader(object):
+    """Read the values of some columns of each row of a CSV file."""
+
+    def __init__(self, f, fields):
+        """Arguments:
+        f      -- CSV file, open for reading in binary mode; it must be a file on disk
+        fields -- names of the columns to read
+
+        Raises ValueError if the header is missing one of the columns.
+        """
+        self.fields = list(fields)
+        # rows too short to have all of the columns, read so far
+        self.short_ct = 0
+        self._mm = None
+        f.seek(0, 2)
+        if f.tell():
+            # an empty file cannot be mapped
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._rdr = csv.reader(iter(self._mm.readline, ''))
+        else:
+            self._rdr = iter([])
+
+        header = next(self._rdr, None)
+        if not header:
+            raise ValueError('CSV file has no header')
+        # DictReader keeps the last of columns with the same name
+        positions = dict((name, num) for num, name in enumerate(header))
+        missing = [name for name in self.fields if name not in positions]
+        if missing:
+            raise ValueError('CSV file has no column %s' % ', '.join(missing))
+        self.indexes = [positions[name] for name in self.fields]
+
+    def __iter__(self):
+        """Generate a tuple of the values of the columns, in the order given, for each row."""
+        indexes = self.indexes
+        getter = itemgetter(*indexes)
+        if len(indexes) == 1:
+            single = getter
+            getter = lambda row: (single(row),)
+        min_len = max(indexes) + 1
+        for row in self._rdr:
+            if len(row) >= min_len:
+                yield getter(row)
+            elif row:
+                self.short_ct += 1
+                yield tuple([row[num] if num < len(row) else None for num in indexes])
+
+    def iter_dicts(self):
+        """Generate a dictionary of column name to value for each row, as DictReader does."""
+        fields = self.fields
+        for values in self:
+            yield dict(zip(fields, values))
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""Writers for the converted incidents, in each of the output formats IncidentUploader offers.
+
+Each writer takes the same blocks of output rows, so all formats are written in one pass:
+
+    csv     -- plain CSV, as HunchLab takes it
+    csv.gz  -- gzipped CSV; upload.py sends it as it is, without compressing it again
+    csv.zst -- Zstandard-compressed CSV, for keeping (needs the zstandard package)
+    npz     -- NumPy arrays of typed columns, for local analysis (needs numpy)
+
+In the npz file, pointx and pointy are floats, the date/time columns are datetime64 in UTC,
+and the other columns are byte strings.  Columns with the same value on every row, such as
+last_updated and datasource, are stored once, as an array of no dimensions.
+"""
+
+import csv
+from datetime import timedelta
+import gzip
+import imp
+import logging
+import os
+import time
+
+# NumPy is imported when .npz output is first written, since it is slow to load
+np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = ['csv', 'csv.gz', 'csv.zst', 'npz']
+# gzip level; 6 is zlib's default, and a good trade of size for speed
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_DATETIME_COLUMNS = ('datetimeto', 'datetimefrom', 'report_time', 'last_updated')
+_FLOAT_COLUMNS = ('pointx', 'pointy')
+# length of the 'YYYY-mm-dd HH:MM:SS' part of a date/time string, before its UTC offset
+_DT_LEN = 19
+# length of a UTC offset, like '-05:00'
+_OFFSET_LEN = 6
+
+
+def missing_dependency(fmt):
+    """Return the name of the package output format fmt needs that is not installed, if any."""
+    if fmt == 'csv.zst' and zstandard is None:
+        return 'zstandard'
+    if fmt == 'npz' and not _installed('numpy'):
+        return 'numpy'
+    return None
+
+
+def _installed(module):
+    """Return whether module can be imported, without importing it."""
+    try:
+        imp.find_module(module)
+    except ImportError:
+        return False
+    return True
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def output_path(csv_path, fmt):
+    """Return the path to write format fmt to, given the path of the plain CSV output."""
+    if fmt == 'npz':
+        return os.path.splitext(csv_path)[0] + '.npz'
+    if fmt == 'csv':
+        return csv_path
+    return csv_path + fmt[len('csv'):]
+
+
+def open_writer(fmt, path, fields):
+    """Return a writer of format fmt to path, for rows with the columns in list fields."""
+    if fmt == 'npz':
+        return NpzWriter(path, fields)
+    return CsvWriter(path, fields, fmt)
+
+
+class _CountingFile(object):
+    """Count bytes passing through to file-like object f."""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.f.write(data)
+
+
+class CsvWriter(object):
+    """Write output rows to a CSV file, compressed or not."""
+
+    def __init__(self, path, fields, fmt='csv'):
+        """Arguments:
+        path   -- file to write
+        fields -- names of the output columns, written as the header
+        fmt    -- 'csv', 'csv.gz' or 'csv.zst'
+        """
+        self.fmt = fmt
+        self.path = path
+        self.seconds = 0.0
+        self._raw = open(path, 'wb')
+        self._compressed = None
+        if fmt == 'csv.gz':
+            self._compressed = gzip.GzipFile(os.path.basename(path)[:-3], 'wb', GZIP_LEVEL,
+                                             self._raw)
+        elif fmt == 'csv.zst':
+            self._compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(self._raw)
+        self._counter = _CountingFile(self._compressed or self._raw)
+        self._wtr = csv.writer(self._counter)
+        self._wtr.writerow(fields)
+
+    @property
+    def csv_bytes(self):
+        """Bytes of CSV written so far, before compression."""
+        return self._counter.bytes_written
+
+    def write_block(self, block):
+        start = time.time()
+        self._wtr.writerows(block)
+        self.seconds += time.time() - start
+
+    def close(self):
+        start = time.time()
+        if self._compressed is not None:
+            self._compressed.close()
+        if not self._raw.closed:
+            self._raw.close()
+        self.seconds += time.time() - start
+
+
+class NpzWriter(object):
+    """Write output rows to a NumPy .npz file of typed column arrays.
+
+    Each block is turned into arrays as it arrives, and the arrays are joined and written,
+    compressed, when the writer is closed.
+    """
+
+    fmt = 'npz'
+
+    def __init__(self, path, fields):
+        """Arguments:
+        path   -- file to write
+        fields -- names of the output columns
+        """
+        _import_numpy()
+        self.path = path
+        self.fields = list(fields)
+        self.seconds = 0.0
+        self.csv_bytes = None
+        # column name to list of arrays, one per block
+        self._columns = dict((name, []) for name in self.fields)
+        # column name to the value it has had on every row so far, if only one
+        self._constant = {}
+
+    def write_block(self, block):
+        if not block:
+            return
+        start = time.time()
+        for pos, name in enumerate(self.fields):
+            values = [row[pos] for row in block]
+            if name in _FLOAT_COLUMNS:
+                self._columns[name].append(np.array(values, dtype=np.float64))
+            elif name in _DATETIME_COLUMNS:
+                self._columns[name].append(_utc_datetimes(values))
+            else:
+                self._columns[name].append(np.array(values, dtype=np.string_))
+            self._note_constant(name, values)
+        self.seconds += time.time() - start
+
+    def _note_constant(self, name, values):
+        """Keep track of whether column name has had the same value on every row."""
+        if name in self._constant and self._constant[name] is None:
+            return
+        first = values[0]
+        if self._constant.setdefault(name, first) != first or \
+                values.count(first) != len(values):
+            self._constant[name] = None
+
+    def close(self):
+        start = time.time()
+        arrays = {}
+        for name in self.fields:
+            blocks = self._columns[name]
+            if not blocks:
+                arrays[name] = np.array([], dtype=np.string_)
+            elif self._constant.get(name) is not None:
+                arrays[name] = blocks[0][:1].reshape(())
+            else:
+                arrays[name] = np.concatenate(blocks)
+        self._columns = None
+        with open(self.path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        self.seconds += time.time() - start
+
+
+def _utc_datetimes(values):
+    """Return array of datetime64 in UTC, from strings with UTC offsets like the output CSV's.
+
+    Fractions of a second, as in last_updated when it is the time of the run, are dropped.
+    """
+    local = np.array([value[:_DT_LEN] for value in values], dtype='datetime64[s]')
+    offsets = np.array([value[-_OFFSET_LEN:] if len(value) > _DT_LEN and
+                        value[-_OFFSET_LEN] in '+-' else '' for value in values])
+    # few distinct offsets, so parse each of them once
+    uniq, inverse = np.unique(offsets, return_inverse=True)
+    seconds = np.array([_offset_seconds(offset) for offset in uniq], dtype=np.int64)
+    return local - seconds[inverse].astype('timedelta64[s]')
+
+
+def _offset_seconds(offset):
+    """Return seconds east of UTC of an offset string like '-05:00', or 0 if there is none."""
+    if not offset:
+        return 0
+    sign = -1 if offset[0] == '-' else 1
+    hours, minutes = offset[1:].split(':')
+    return sign * int(timedelta(hours=int(hours), minutes=int(minutes)).total_seconds())
+
+
+def log_sizes(writers):
+    """Log the size of each file written, its time and its size compared to the plain CSV."""
+    csv_bytes = None
+    for writer in writers:
+        if writer.csv_bytes is not None:
+            csv_bytes = writer.csv_bytes
+            break
+
+    sizes = {}
+    for writer in writers:
+        size = os.path.getsize(writer.path)
+        sizes[writer.fmt] = size
+        if csv_bytes:
+            logging.info('Wrote %s: %.1f MB, %.0f%% of the CSV size, in %.1f seconds.',
+                         writer.path, size / (1024.0 * 1024.0), 100.0 * size / csv_bytes,
+                         writer.seconds)
+        else:
+            logging.info('Wrote %s: %.1f MB in %.1f seconds.', writer.path,
+                         size / (1024.0 * 1024.0), writer.seconds)
+    return sizes
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""Adapters for the places incident data is fetched from, one for each jurisdiction.
+
+IncidentUploader does the fetching, converting, indexing and writing out the same way for
+every jurisdiction.  A Source only describes what differs from one to the next:
+
+    fetch strategy  -- the zipfile with a CSV of all incidents, and the ArcGIS layer of recent
+                       incidents, if there is one, to fetch instead when the last check was
+                       recent enough
+    field map       -- which input column holds each value the HunchLab CSV needs
+    timezone        -- of the date/times in the data
+    date/time parser -- for the CSV's date/time strings and the date the data were last
+                        updated; ArcGIS layers give date/times as milliseconds since the epoch
+
+To add a jurisdiction, subclass Source, fill in its attributes, and add it to SOURCES.
+"""
+
+from datetime import datetime
+
+# keys of Source.fields: the values the output needs from each input row
+FIELD_KEYS = ['id', 'datetime', 'class', 'pointx', 'pointy', 'address']
+
+
+class Source(object):
+    """Where one jurisdiction's incident data comes from, and how to read it."""
+
+    # short name, for looking the source up in SOURCES, and in log lines and metrics
+    name = None
+    # name of the output CSV
+    output_filename = None
+    # timezone of the date/times in the data
+    timezone = None
+
+    # zipfile of the CSV of all incidents, the file to save it to, and the names of the CSV
+    # and of the file giving the date the data were last updated within it (None if there
+    # is no such file)
+    zip_url = None
+    zip_filename = None
+    csv_filename = None
+    updated_filename = None
+
+    # ArcGIS query URL for recent incidents, or None to always fetch the zipfile
+    arcgis_url = None
+    # days back the ArcGIS layer goes
+    arcgis_days = 30
+    # days before the last check to fetch from ArcGIS again, for incidents entered late
+    overlap_days = 15
+    # field to order pages of ArcGIS results by, so none are skipped or repeated
+    arcgis_order_field = 'OBJECTID'
+
+    # input column for each of FIELD_KEYS
+    fields = {}
+    # date/time format of the CSV; the NumPy batch conversion only reads the default one
+    # itself, and leaves date/times in any other format to parse_csv_datetime
+    csv_datetime_format = '%Y-%m-%d %H:%M:%S'
+    # value of the datasource output column
+    datasource = 'public_csv'
+    # most requests a second to send to the source's servers, or None for no limit
+    requests_per_second = None
+
+    def input_fields(self):
+        """Return the names of the input columns to read."""
+        return [self.fields[key] for key in FIELD_KEYS]
+
+    def parse_csv_datetime(self, value):
+        """Return naive local datetime of a date/time string from the CSV.
+
+        Raises ValueError, or TypeError, if value is not a date/time.
+        """
+        return datetime.strptime(value, self.csv_datetime_format)
+
+    def parse_last_updated(self, text):
+        """Return naive local datetime the data were last updated, from updated_filename.
+
+        Raises ValueError if it cannot be found.
+        """
+        raise ValueError('No date last updated for %s.' % self.name)
+
+    def arcgis_where(self, num_days):
+        """Return ArcGIS where clause selecting incidents from the last num_days days."""
+        return '%s > SYSDATE - %s' % (self.fields['datetime'], num_days)
+
+
+class PhillySource(Source):
+    """Crime incidents published by the City of Philadelphia."""
+
+    name = 'philly'
+    output_filename = 'philly_processed_crime.csv'
+    timezone = 'US/Eastern'
+
+    zip_url = 'http://gis.phila.gov/gisdata/police_inct.zip'
+    zip_filename = 'police_inct.zip'
+    csv_filename = 'police_inct.csv'
+    updated_filename = 'UPDATE_DATE.txt'
+
+    arcgis_url = 'http://gis.phila.gov/arcgis/rest/services/PhilaGov/' + \
+            'Police_Incidents_Last30/MapServer/0/query'
+
+    fields = {'id': 'DC_KEY',
+              'datetime': 'DISPATCH_DATE_TIME',
+              'class': 'TEXT_GENERAL_CODE',
+              'pointx': 'POINT_X',
+              'pointy': 'POINT_Y',
+              'address': 'LOCATION_BLOCK'}
+
+    # date/time string format used in UPDATE_DATE.txt in zipfile with csv
+    _LAST_UPDATED_DT_FORMAT = '%A %m/%d/%y at %H:%M %p %Z'
+
+    def parse_last_updated(self, text):
+        # date is at end of single line in UPDATE_DATE.txt
+        # preceded by 'This dataset is up to date as of '
+        return datetime.strptime(text[33:], self._LAST_UPDATED_DT_FORMAT)
+
+
+# sources by name
+SOURCES = dict((source.name, source) for source in [PhillySource])
+
+
+def get_source(name):
+    """Return a new Source for the source called name; raise KeyError if there is none."""
+    return SOURCES[name]()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""Read and write GeoJSON FeatureCollections one feature at a time.
+
+json.load holds the whole document in memory, and json.dump builds it all again as it writes;
+for a month of missions that is hundreds of megabytes, twice over.  FeatureReader reads the
+"features" array a feature at a time, keeping only the feature being decoded and part of the
+file in memory, and FeatureWriter writes each feature as it is given one.  The other members
+of the collection, such as "type", are kept and written around the features.
+"""
+
+from collections import OrderedDict
+import json
+import re
+
+# bytes of the file to read at a time
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class FeatureReader(object):
+    """Iterate over the features of a GeoJSON FeatureCollection, decoded one at a time.
+
+    Raises ValueError if the file is not a JSON object.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        """Arguments:
+        f          -- file to read the FeatureCollection from
+        chunk_size -- bytes to read at a time
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        # members of the collection other than "features", in the order read so far
+        self.members = OrderedDict()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        # position in the file of the start of the buffer
+        self._buf_offset = 0
+        self._eof = False
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            key = self._decode()
+            if not isinstance(key, basestring):
+                raise ValueError('Expected member name at byte %d' % self._offset())
+            self._expect(':')
+            if key == 'features':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.members[key] = self._decode()
+            if self._expect(',}') == '}':
+                return
+
+    def _read_more(self, size=None):
+        """Add up to size bytes to the buffer; return False at the end of the file."""
+        if self._eof:
+            return False
+        # drop what has been decoded already
+        if self._pos:
+            self._buf_offset = self._offset()
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        data = self.f.read(max(size or 0, self.chunk_size))
+        if not data:
+            self._eof = True
+            return False
+        self._buf += data
+        return True
+
+    def _offset(self):
+        """Return position in the file of the next byte to decode, for error messages."""
+        return self._buf_offset + self._pos
+
+    def _peek(self):
+        """Skip whitespace; return the next character, or '' at the end of the file."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._read_more():
+                return self._buf[self._pos:self._pos + 1]
+
+    def _expect(self, chars):
+        """Skip whitespace and the next character, which must be one of chars; return it."""
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError('Expected %s at byte %d' % (' or '.join(repr(ch) for ch in chars),
+                                                         self._offset()))
+        self._pos += 1
+        return c
+
+    def _decode(self):
+        """Decode the JSON value starting at the next character, reading more as needed."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # only part of the value has been read; read at least as much again, so a long
+                # value is not decoded from the start too many times over
+                if not self._read_more(len(self._buf) - self._pos):
+                    raise ValueError('Could not decode JSON value at byte %d' % self._offset())
+                continue
+            # a number at the end of the buffer may go on in the next chunk
+            if end < len(self._buf) or not self._read_more():
+                self._pos = end
+                return value
+
+
+class FeatureWriter(object):
+    """Write a GeoJSON FeatureCollection one feature at a time.
+
+    The members other than "features" are taken from a FeatureReader: those it has read by the
+    first feature are written before the features, and any it reads after them by close.
+    """
+
+    def __init__(self, f, reader):
+        """Arguments:
+        f      -- file to write the FeatureCollection to
+        reader -- FeatureReader whose members to write along with the features
+        """
+        self.f = f
+        self.reader = reader
+        self.count = 0
+        self._written = set()
+        self._started = False
+
+    def write(self, feature):
+        """Write GeoJSON feature feature, a dictionary."""
+        if not self._started:
+            self._start()
+        if self.count:
+            self.f.write(', ')
+        # json.dumps encodes in C; json.dump would encode in Python, piece by piece
+        self.f.write(json.dumps(feature))
+        self.count += 1
+
+    def close(self):
+        """Finish the FeatureCollection; the file itself is left open."""
+        if not self._started:
+            self._start()
+        self.f.write(']')
+        self._write_members()
+        self.f.write('}')
+
+    def _start(self):
+        self.f.write('{')
+        self._write_members()
+        self.f.write('"features": [')
+        self._started = True
+
+    def _write_members(self):
+        for key, value in self.reader.members.items():
+            if key in self._written:
+                continue
+            # members before the features are followed by them; members after them follow ']'
+            if self._started:
+                self.f.write(', ')
+            self.f.write('%s: %s' % (json.dumps(key), json.dumps(value)))
+            if not self._started:
+                self.f.write(', ')
+            self._written.add(key)
@@ -1,18 +1,41 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-import ConfigParser
 from datetime import datetime
-import json
 import logging
 import os
+import re
 import shutil
 from subprocess import Popen, PIPE
 import sys
 
-from dateutil import parser
-import tzlocal
-import requests
+# dateutil, tzlocal and requests are imported where they are used, since they are slow to
+# load; printing the help or finding a bad configuration file does not need them
+
+# configuration, sessions, timings, counts, profiling and daemon mode are shared with the
+# other scripts, in ../eventdata; daemon is imported by _run_daemon, so the HTTP server it
+# needs is only loaded in daemon mode
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                'eventdata'))
+import common
+import metrics
+import profiling
+
+from geojson_stream import FeatureReader, FeatureWriter
+from shp_writer import ShapefileWriter
+
+# port of the health endpoint in daemon mode
+DEFAULT_HEALTH_PORT = 8702
+# ways to write the Shapefile: directly, or by converting the parsed GeoJSON with GDAL
+BACKENDS = ('native', 'ogr2ogr')
+# names GeoJSON gives WGS 84 longitude/latitude, the co-ordinates the .prj file is written for
+WGS84_CRS_NAMES = ('urn:ogc:def:crs:OGC:1.3:CRS84', 'urn:ogc:def:crs:OGC::CRS84',
+                   'urn:ogc:def:crs:EPSG::4326', 'EPSG:4326')
+# columns flatten_mission adds, in the order it adds them, after the mission's own properties;
+# N stands for the number of the resource type or event model
+MISSION_COLUMNS = ('rec_dose', 'risk_pct', 'risk_z', 'missionid', 'shift', 'start', 'end',
+                   'res_typeN', 'res_ctN', 'res_timeN', 'returnsN', 'eventN', 'evntN_wt',
+                   'evnt_dom', 'evnt_domwt')
 
 
 def which(program):
@@ -43,21 +66,39 @@ def which(program):
 class MissionsConverter(object):
     """Download missions GeoJSON from HunchLab and convert to Shapefile.
     """
-    def __init__(self, server, auth_token, base_filename='missions'):
+
+    # bytes of the missions GeoJSON to read and write at a time
+    _DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, server, auth_token, base_filename='missions', backend='native'):
         """Set some variables for the missions fetch/conversion.
         
         Arguments:
             server -> URL to HunchLab server; should be in accompanying config.ini file
             auth_token -> user's HunchLab authentication token
             base_filename -> string to use in naming output JSON files and Shapefile directory
+            backend -> 'native' to write the Shapefile as the missions are parsed, or 'ogr2ogr'
+                       to write parsed missions GeoJSON and convert it with GDAL's ogr2ogr
         """
         self.base_filename = base_filename
         self.json_filename = self.base_filename + '.json'
         self.parsed_json = self.base_filename + '_parsed.json'
+        self.backend = backend
+        # the Shapefile in the output directory, without an extension; named for the parsed
+        # GeoJSON, as ogr2ogr names it
+        self.shapefile = os.path.join(self.base_filename,
+                                      os.path.splitext(os.path.basename(self.parsed_json))[0])
+        # ShapefileWriter of the last Shapefile written by parseMissions, for convertMissions
+        self._written = None
         self.auth_token = auth_token
         self.server = server
         # get system timezone
+        import tzlocal
         self.sys_tz = tzlocal.get_localzone()
+        # kept for later fetches, so the connection to the server is reused; it sends the
+        # token, asks for gzip, and retries on timeouts and server errors.  If using this
+        # module on a local installation, set self.session.verify to False.
+        self.session = common.make_session(auth_token)
 
     def getMissions(self, from_dt, to_dt):
         """Fetch missions from HunchLab.
@@ -74,6 +115,8 @@ class MissionsConverter(object):
             logging.error('HunchLab server and authentication token not set.  Exiting')
             return 1
 
+        from dateutil import parser
+
         try:
             from_dt = parser.parse(from_dt)
             to_dt = parser.parse(to_dt)
@@ -96,11 +139,6 @@ class MissionsConverter(object):
 
         logging.debug('Fetching missions...')
 
-        headers = {'Authorization': 'Token ' + self.auth_token,
-                   'Accept-Encoding': 'gzip,deflate,sdch',
-                   'Connection': 'keep-alive'
-                   }
-
         url = '%s/api/missions/' % self.server
 
         params = {'effective_from': from_dt,
@@ -108,14 +146,17 @@ class MissionsConverter(object):
                   'valid_from': from_dt,
                   'valid_to': to_dt
                  }
-        # if using this module on a local installation, change 'verify' to 'False'
-        stream = requests.get(url, headers=headers, params=params, stream=True, timeout=20,
-                 verify=True)
+        with metrics.span('download') as span:
+            stream = self.session.get(url, params=params, stream=True)
+            span.set(status_code=stream.status_code)
+
+            if stream.ok:
+                with open(self.json_filename, 'wb') as stream_file:
+                        for chunk in stream.iter_content(self._DOWNLOAD_CHUNK_SIZE):
+                            stream_file.write(chunk)
 
         if stream.ok:
-            with open(self.json_filename, 'wb') as stream_file:
-                    for chunk in stream.iter_content():
-                        stream_file.write(chunk)
+            metrics.incr('download_bytes', os.path.getsize(self.json_filename))
 
         else:
             logging.error('Failed to download missions.')
@@ -127,7 +168,11 @@ class MissionsConverter(object):
         """Translate downloaded missions GeoJSON into something usable for shapefile features.
 
         Shapefiles support a maximum column name length of 10 characters, and a maximum text field
-        length of 254 characters.
+        length of 254 characters.  Missions are read, translated and written one at a time, so
+        memory use does not grow with the number of them.  With the native backend they are
+        written straight to the Shapefile; it is made in a new directory, which only replaces
+        the last one once it is complete.  Otherwise they are written to the parsed GeoJSON
+        file, for convertMissions.
         """
 
         logging.debug('Parsing missions GeoJSON...')
@@ -135,75 +180,71 @@ class MissionsConverter(object):
             logging.error('Downloaded missions GeoJSON not found.  Exiting.')
             return 1
 
-        with open(self.json_filename, 'rb') as missions_json:
-            geojson = json.load(missions_json)
+        self._written = None
+        new_dir = self.base_filename + '.new'
+        if self.backend == 'native':
+            if not _remove(new_dir):
+                return 4
+            os.mkdir(new_dir)
 
-        # modify properties of features
-        features = geojson['features']
-        if not features:
+        with open(self.json_filename, 'rb') as missions_json:
+            reader = FeatureReader(missions_json)
+            features = metrics.timed_iter('parse', reader)
+            features = metrics.timed_iter('transform', (flatten_mission(feature)
+                                                        for feature in features))
+            if self.backend == 'native':
+                writer = ShapefileWriter(os.path.join(new_dir, os.path.basename(self.shapefile)),
+                                         order=mission_column_order)
+            else:
+                writer = FeatureWriter(open(self.parsed_json, 'wb'), reader)
+            try:
+                with metrics.span('write'):
+                    for feature in features:
+                        writer.write(feature)
+                    if self.backend == 'native' and not _is_wgs84(reader.members.get('crs')):
+                        logging.warning('Missions are not in WGS 84 longitude/latitude: %s.  '
+                                        'Writing no .prj file.', reader.members['crs'])
+                        writer.prj = None
+                    writer.close()
+            except ValueError as ex:
+                logging.error('Could not parse missions GeoJSON: %s', ex)
+                failed = 3
+            else:
+                failed = 0
+            finally:
+                if self.backend != 'native':
+                    writer.f.close()
+
+        if not failed and not writer.count:
             logging.warning('No missions found for date range.  Exiting.')
-            return 2
-
-        # add features back to modified list when done modifying their properties
-        geojson['features'] = []
-        for feature in features:
-            props = feature['properties']
-            # extract/flatten info from event_models and mission_set collections
-            ms = props['mission_set']
-            ev = props['event_models']
-            # delete some collections
-            del(props['_links'])
-            del(props['bbox_leaflet'])
-            del(props['related_info'])
-            del(props['mission_set'])
-            del(props['event_models'])
-            # rename properties with long names
-            props['rec_dose'] = props['recommended_dose']
-            del(props['recommended_dose'])
-            props['risk_pct'] = props['risk_percentile']
-            del(props['risk_percentile'])
-            props['risk_z'] = props['risk_z_score']
-            del(props['risk_z_score'])
-            # add back properties from mission sets and event models
-            props['missionid'] = ms['id']
-            props['shift'] = ms['shift_label']
-            props['start'] = ms['period']['start']
-            props['end'] = ms['period']['end']
-
-            # add four columns for each resource type
-            res_ct = 0
-            for res in ms['resources']:
-                res_ct += 1
-                props['res_type%d' % res_ct] = res['resource_type']
-                props['res_ct%d' % res_ct] = res['number_of_resources']
-                props['res_time%d' % res_ct] = res['time_percent']
-                props['returns%d' % res_ct] = res['times_returning']
-
-            # add two columns for each event model, for label and weight;
-            # number the event models by weight, descending (like they appear in map labels)
-            ev = sorted(ev, key=lambda e: e['label'])
-            ev_ct = 0
-            for evnt in ev:
-                ev_ct += 1
-                props['event%d' % ev_ct] = evnt['label']
-                props['evnt%d_wt' % ev_ct] = evnt['weight']
-
-            # add columns for dominant model
-            ev = sorted(ev, key=lambda e: e['weight'], reverse=True)
-            props['evnt_dom'] = ev[0]['label']
-            props['evnt_domwt'] = ev[0]['weight']
-            
-            # set modified properties
-            feature['properties'] = props
-
-        # add back modified features
-        geojson['features'] = features
-        # write out modified file
-        with open(self.parsed_json, 'wb') as parsed_file:
-            json.dump(geojson, parsed_file)
+            failed = 2
+        if failed:
+            if self.backend == 'native':
+                shutil.rmtree(new_dir, ignore_errors=True)
+            else:
+                os.remove(self.parsed_json)
+            return failed
+
+        if self.backend == 'native':
+            if not _remove(self.base_filename):
+                return 4
+            os.rename(new_dir, self.base_filename)
+            self._written = writer
+
+        metrics.gauge('missions', writer.count)
 
     def convertMissions(self):
-        """Convert parsed missions GeoJSON to a shapefile, using ogr2ogr"""
+        """Convert parsed missions GeoJSON to a shapefile, using ogr2ogr.
+
+        With the native backend, parseMissions has written the shapefile already; describe it.
+        """
+
+        if self.backend == 'native':
+            if self._written is None:
+                logging.error('Missions shapefile not written.  Exiting.')
+                return 2
+            _log_shapefile(self._written, self.shapefile)
+            return
 
         logging.debug('Converting missions...')
         # first check if ogr2ogr is installed
@@ -222,24 +263,17 @@ class MissionsConverter(object):
 
         # create directory for exported shapefiles, named by the base file name;
         # delete directory/file of the same name first, if it exists
-        if os.path.exists(self.base_filename):
-            logging.debug('%s exists; deleting it' % self.base_filename)
-            try:
-                if os.path.isdir(self.base_filename):
-                    shutil.rmtree(self.base_filename)
-                else:
-                    os.remove(self.base_filename)
-            except Exception as ex:
-                logging.error('Error deleting base filename contents: %s' % ex)
-                return 3
+        if not _remove(self.base_filename):
+            return 3
 
         os.mkdir(self.base_filename)
 
         logging.debug('Converting missions...')
-        p = Popen(['ogr2ogr', '-f', 'ESRI Shapefile', self.base_filename,
-                               self.parsed_json], stdout=PIPE, stderr=PIPE)
+        with metrics.span('ogr2ogr'):
+            p = Popen(['ogr2ogr', '-f', 'ESRI Shapefile', self.base_filename,
+                                   self.parsed_json], stdout=PIPE, stderr=PIPE)
 
-        stdout, stderr = p.communicate()
+            stdout, stderr = p.communicate()
         logging.info(stdout)
         if stderr:
             logging.error(stderr)
@@ -249,8 +283,9 @@ class MissionsConverter(object):
         # run ogrinfo on shapefile
         logging.info('Missons converted successfully.')
         logging.info('ogrinfo for mission shapefile:')
-        p = Popen(['ogrinfo', self.base_filename], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
+        with metrics.span('ogrinfo'):
+            p = Popen(['ogrinfo', self.base_filename], stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate()
         logging.info(stdout)
         if stderr:
             logging.error(stderr)
@@ -258,32 +293,171 @@ class MissionsConverter(object):
             return 4
 
 
-def _config_section_map(config, section):
-    """Helper function to extract data from config.ini file (from eventdata's importer)"""
-    result = {}
-    options = config.options(section)
-    for option in options:
+def _remove(path):
+    """Delete directory or file path, if it exists; return False if it could not be deleted."""
+    if os.path.exists(path):
+        logging.debug('%s exists; deleting it' % path)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except Exception as ex:
+            logging.error('Error deleting base filename contents: %s' % ex)
+            return False
+    return True
+
+
+def _is_wgs84(crs):
+    """Return True if GeoJSON crs member crs is WGS 84 longitude/latitude, or there is none."""
+    if crs is None:
+        return True
+    try:
+        return crs['properties']['name'] in WGS84_CRS_NAMES
+    except (KeyError, TypeError):
+        return False
+
+
+def mission_column_order(name):
+    """Return sort key putting the columns flatten_mission adds in the order it adds them."""
+    template = re.sub(r'\d+', 'N', name)
+    if template not in MISSION_COLUMNS:
+        return (0, 0, 0, 0)
+    pos = MISSION_COLUMNS.index(template)
+    if 'N' not in template:
+        return (1, pos, 0, 0)
+    # each resource type's four columns go together, as do each event model's two
+    group = MISSION_COLUMNS.index('eventN' if template in ('eventN', 'evntN_wt')
+                                  else 'res_typeN')
+    return (1, group, int(re.search(r'\d+', name).group()), pos)
+
+
+def _log_shapefile(writer, path):
+    """Log what is in shapefile path, written by ShapefileWriter writer, as ogrinfo would."""
+    logging.info('Missions converted successfully.')
+    logging.info('Shapefile %s.shp: %d missions, extent (%.6f, %.6f) - (%.6f, %.6f)',
+                 path, writer.count, *(writer.bbox or (0, 0, 0, 0)))
+    for field in writer.fields:
+        logging.info('    %s: %s (%d.%d)', field.dbf_name,
+                     {'C': 'String', 'N': 'Integer', 'F': 'Real', 'L': 'Logical'}.get(
+                         field.kind, 'String'), field.width, field.decimals)
+
+
+def flatten_mission(feature):
+    """Return missions GeoJSON feature, with its properties flattened for a shapefile.
+
+    The feature is changed in place.  Collections are dropped or spread over columns of their
+    own, and long names are shortened to fit the 10 characters of a DBF column name.
+    """
+    props = feature['properties']
+    # extract/flatten info from event_models and mission_set collections
+    ms = props['mission_set']
+    ev = props['event_models']
+    # delete some collections
+    del(props['_links'])
+    del(props['bbox_leaflet'])
+    del(props['related_info'])
+    del(props['mission_set'])
+    del(props['event_models'])
+    # rename properties with long names
+    props['rec_dose'] = props['recommended_dose']
+    del(props['recommended_dose'])
+    props['risk_pct'] = props['risk_percentile']
+    del(props['risk_percentile'])
+    props['risk_z'] = props['risk_z_score']
+    del(props['risk_z_score'])
+    # add back properties from mission sets and event models
+    props['missionid'] = ms['id']
+    props['shift'] = ms['shift_label']
+    props['start'] = ms['period']['start']
+    props['end'] = ms['period']['end']
+
+    # add four columns for each resource type
+    res_ct = 0
+    for res in ms['resources']:
+        res_ct += 1
+        props['res_type%d' % res_ct] = res['resource_type']
+        props['res_ct%d' % res_ct] = res['number_of_resources']
+        props['res_time%d' % res_ct] = res['time_percent']
+        props['returns%d' % res_ct] = res['times_returning']
+
+    # add two columns for each event model, for label and weight;
+    # number the event models by weight, descending (like they appear in map labels)
+    ev = sorted(ev, key=lambda e: e['label'])
+    ev_ct = 0
+    for evnt in ev:
+        ev_ct += 1
+        props['event%d' % ev_ct] = evnt['label']
+        props['evnt%d_wt' % ev_ct] = evnt['weight']
+
+    # add columns for dominant model
+    ev = sorted(ev, key=lambda e: e['weight'], reverse=True)
+    props['evnt_dom'] = ev[0]['label']
+    props['evnt_domwt'] = ev[0]['weight']
+    return feature
+
+
+def _export_missions(mc, fromdt, todt):
+    """Download missions from fromdt to todt with MissionsConverter mc, and convert them.
+
+    Raises Exception if any step failed.
+    """
+    with profiling.stage('getMissions'):
+        status = mc.getMissions(fromdt, todt)
+    if status:
+        # got non-zero status
+        raise Exception('Could not download missions.  Exiting.')
+
+    with profiling.stage('parseMissions'):
+        status = mc.parseMissions()
+    if status:
+        raise Exception('Could not parse missions GeoJSON. Exiting.')
+
+    with profiling.stage('convertMissions'):
+        status = mc.convertMissions()
+    if status:
+        raise Exception('Could not convert GeoJSON to Shapefile. Exiting.')
+
+
+def _run_daemon(mc, args):
+    """Keep running, converting the missions in effect every args.daemon minutes.
+
+    MissionsConverter mc, with its timezone and HTTP session, is kept from one run to the next.
+    """
+    def export():
+        """Convert the missions in effect now; return true if successful."""
+        now = datetime.now().isoformat()
         try:
-            result[option] = config.get(section, option)
-            if result[option] == -1:
-                logging.info('skip: %s' % option)
-        except Exception:
-            logging.error('exception on %s!' % option)
-            result[option] = None
-    return result
+            _export_missions(mc, now, now)
+        except Exception as ex:
+            logging.error(ex)
+            return False
+        logging.info('Missions conversion to shapefile complete.')
+        return True
+
+    import daemon
+
+    d = daemon.Daemon('missions', health_port=args.health_port or None)
+    d.add_job('missions', export, args.daemon * 60)
+    d.run()
+
 
+def main(argv=None, prog=None):
+    """Download missions GeoJSON from HunchLab and convert to Shapefile.
 
-def main():
-    """Download missions GeoJSON from HunchLab and convert to Shapefile."""
+    Arguments:
+    argv -- command-line arguments; defaults to those the script was run with
+    prog -- name of the command, for the help; defaults to the script's name
+    """
     desc = 'Download missions GeoJSON from HunchLab and convert to Shapefile.'
-    parser = ArgumentParser(description=desc)
+    parser = ArgumentParser(prog=prog, description=desc)
     default_config = os.path.join(os.getcwd(), 'config.ini')
     parser.add_argument('-c', '--config', default=default_config, dest='config',
                         help='Configuration file with credentials', metavar='FILE')
     parser.add_argument('-d', '--dest', default='missions', dest='dest_dir',
                         help="Base name for output files.  Defaults to 'missions'",
                         metavar='FILENAME')
-    parser.add_argument('-f', '--fromdt', default=datetime.now().isoformat(), dest='from_dt',
+    parser.add_argument('-f', '--fromdt', default='', dest='from_dt',
                         help='Date/time string in ISO format for start range of missions to ' + \
                               'fetch. Defaults to now. If no timezone offset supplied, ' + \
                               'defaults to system timezone.', metavar='DATETIMESTRING')
@@ -291,53 +465,72 @@ def main():
                         help='Date/time string in ISO format for end range of missions to ' + \
                               'fetch. Defaults to from date/time. If no timezone offset ' + \
                               'supplied, defaults to system timezone.', metavar='DATETIMESTRING')
+    parser.add_argument('-b', '--backend', default='native', dest='backend', choices=BACKENDS,
+                        help="How to write the Shapefile: 'native' writes it as the missions " + \
+                             "are parsed; 'ogr2ogr' converts the parsed missions GeoJSON " + \
+                             "with GDAL's ogr2ogr, which must be installed.  Defaults to " + \
+                             "'native'.")
+    parser.add_argument('-m', '--metrics', dest='metrics', metavar='FILE',
+                        help='Write timings and counts to FILE: a Prometheus textfile if it ' + \
+                             'ends in .prom, otherwise JSON lines appended to it')
+    parser.add_argument('--profile', dest='profile', metavar='DIR',
+                        help='Profile the run, writing pstats files, collapsed stacks for ' + \
+                             'flame graphs and memory notes to DIR')
+    parser.add_argument('--daemon', type=float, dest='daemon', metavar='MINUTES',
+                        help='Keep running, converting the missions in effect every ' + \
+                             'MINUTES minutes; --fromdt and --todt cannot be given with it')
+    parser.add_argument('--health-port', type=int, default=DEFAULT_HEALTH_PORT,
+                        dest='health_port', metavar='PORT',
+                        help='Port on localhost for the health endpoint in daemon mode, or 0 ' + \
+                             'for none.  Defaults to %d.' % DEFAULT_HEALTH_PORT)
     parser.add_argument('-l', '--log-level', default='info', dest='log_level',
                         help="Log level for console output.  Defaults to 'info'.",
                         choices=['debug', 'info', 'warning', 'error', 'critical'])
-    args = parser.parse_args()
-
-    # set up file logger
-    logging.basicConfig(filename='geojson_to_shp.log', level=logging.DEBUG,
-                        format='%(asctime)s %(levelname)s: %(message)s',
-                        datefmt='%Y-%m-%d %I:%M:%S %p')
-
-    # add logger handler for console output
-    console = logging.StreamHandler()
-    loglvl = getattr(logging, args.log_level.upper())
-    console.setLevel(loglvl)
-    # add the handler to the root logger
-    logging.getLogger('').addHandler(console)
-
-    config = ConfigParser.ConfigParser()
-    config.read(args.config)
-    server = _config_section_map(config, 'Server')
+    args = parser.parse_args(argv)
+    if args.daemon is not None:
+        if args.daemon <= 0:
+            parser.error('--daemon needs a number of minutes greater than 0')
+        if args.from_dt or args.to_dt:
+            parser.error('--fromdt and --todt cannot be given with --daemon')
+
+    common.setup_logging('geojson_to_shp.log', args.log_level)
+
+    if args.metrics:
+        metrics.configure(args.metrics, 'missions')
+    if args.profile:
+        profiling.configure(args.profile, 'missions')
+
+    try:
+        server = common.read_server_config(args.config)
+    except ValueError as ex:
+        logging.error(ex)
+        logging.error('Missions conversion failed.  Exiting.')
+        metrics.gauge('exit_code', 1)
+        sys.exit(1)
     token = server['token']
     baseurl = server['baseurl']
 
-    fromdt = args.from_dt
+    fromdt = args.from_dt or datetime.now().isoformat()
     # default to use 'from' date/time for 'to' date/time, if 'to' not supplied
     if args.to_dt:
         todt = args.to_dt
     else:
         todt = fromdt
 
+    mc = MissionsConverter(baseurl, token, args.dest_dir, args.backend)
+    if args.daemon:
+        return _run_daemon(mc, args)
+
     try:
-        mc = MissionsConverter(baseurl, token, args.dest_dir)
-
-        if mc.getMissions(fromdt, todt):
-            # got non-zero status
-            raise Exception('Could not download missions.  Exiting.')
-        elif mc.parseMissions():
-            raise Exception('Could not parse missions GeoJSON. Exiting.')
-        elif mc.convertMissions():
-            raise Exception('Could not convert GeoJSON to Shapefile. Exiting.')
-        else:
-            logging.info('Missions conversion to shapefile complete.  All done!')
+        _export_missions(mc, fromdt, todt)
+        logging.info('Missions conversion to shapefile complete.  All done!')
 
     except Exception as ex:
         logging.error(ex)
         logging.error('Missions conversion failed.  Exiting.')
+        metrics.gauge('exit_code', 1)
         sys.exit(1)
+    metrics.gauge('exit_code', 0)
 
 if __name__ == '__main__':
     """If run from the command line."""
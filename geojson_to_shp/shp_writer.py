@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+"""Write GeoJSON features to an ESRI Shapefile (.shp, .shx, .dbf, .prj and .cpg), without GDAL.
+
+ShapefileWriter takes features one at a time, as parseMissions flattens them.  Geometries go
+straight to the .shp and .shx files; the headers, which hold the file lengths and the extent,
+are filled in by close.  A .dbf file has to list its columns, with their widths, before the
+first record, so each feature's properties are kept in a temporary file until close, when the
+columns are known; only the columns themselves are held in memory.
+
+Columns follow the limits of the DBF format:
+
+    names  -- at most 10 characters; longer names are cut short, and numbered if that makes
+              two the same
+    text   -- at most 254 bytes of UTF-8; longer values are cut short, and the .cpg file tells
+              GIS software the encoding
+    types  -- whole numbers and decimals are numeric (N) columns, true and false logical (L)
+              columns, and anything else, or a mix of types, text (C) columns.  Lists and
+              objects are written as JSON text.
+"""
+
+from datetime import date
+import json
+import logging
+import marshal
+import math
+import os
+import struct
+import tempfile
+
+# WGS 84 longitude/latitude, the co-ordinate system of GeoJSON, as a .prj file gives it
+WGS84_PRJ = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,'
+             '298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+# limits of the DBF format
+MAX_NAME_LENGTH = 10
+MAX_TEXT_LENGTH = 254
+# most decimal places to keep in numeric columns
+MAX_DECIMALS = 15
+# offsets in the .shx file are signed 32-bit counts of 16-bit words, but most software stops
+# at 2 GB
+MAX_FILE_SIZE = 2 ** 31 - 1
+
+# shape types for the GeoJSON geometry types
+NULL_SHAPE, POINT, POLYLINE, POLYGON, MULTIPOINT = 0, 1, 3, 5, 8
+SHAPE_TYPES = {'Point': POINT,
+               'MultiPoint': MULTIPOINT,
+               'LineString': POLYLINE,
+               'MultiLineString': POLYLINE,
+               'Polygon': POLYGON,
+               'MultiPolygon': POLYGON}
+
+_HEADER_SIZE = 100
+# column types for the types of property values: N for whole numbers, F for decimals, L for
+# true/false and C for text
+_KINDS = {int: 'N', long: 'N', float: 'F', bool: 'L', str: 'C', unicode: 'C'}
+
+
+class ShapefileWriter(object):
+    """Write GeoJSON features to a shapefile, one at a time.
+
+    Raises ValueError for a geometry that is not valid GeoJSON, or whose type does not go in
+    the same shapefile as the first (points, lines and polygons each need one of their own).
+    """
+
+    def __init__(self, path, prj=WGS84_PRJ, order=None):
+        """Arguments:
+        path  -- path of the shapefile to write, without an extension; each file adds its own
+        prj   -- co-ordinate system to write to the .prj file, or None to not write one
+        order -- function giving a sort key for a property name, to order the columns by;
+                 by default they are in the order first seen
+        """
+        self.path = path
+        self.prj = prj
+        self.order = order
+        self.count = 0
+        self.shape_type = None
+        # columns, in the order first seen, and by property name
+        self.fields = []
+        self._fields = {}
+        # extent of all the geometries written
+        self.bbox = None
+        self._shp = open(path + '.shp', 'wb')
+        self._shx = open(path + '.shx', 'wb')
+        # leave room for the headers, written by close
+        self._shp.write('\0' * _HEADER_SIZE)
+        self._shx.write('\0' * _HEADER_SIZE)
+        self._shp_size = _HEADER_SIZE
+        # properties of the features written, to make the .dbf from
+        self._spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+
+    def write(self, feature):
+        """Write GeoJSON feature feature, a dictionary."""
+        shape_type, content = self._encode_geometry(feature.get('geometry'))
+        if len(content) + 8 > MAX_FILE_SIZE - self._shp_size:
+            raise ValueError('Shapefile %s.shp would be larger than 2 GB' % self.path)
+
+        self.count += 1
+        self._shx.write(struct.pack('>2i', self._shp_size // 2, len(content) // 2))
+        self._shp.write(struct.pack('>2i', self.count, len(content) // 2))
+        self._shp.write(content)
+        self._shp_size += 8 + len(content)
+
+        record = {}
+        for name, value in (feature.get('properties') or {}).iteritems():
+            field = self._fields.get(name)
+            if field is None:
+                field = self._fields[name] = _Field(name, self.fields)
+                self.fields.append(field)
+            record[name] = field.add(value)
+        # marshal is the quickest to write and read back
+        marshal.dump(record, self._spool)
+
+    def close(self):
+        """Finish the shapefile: write the headers, the .dbf, .prj and .cpg files."""
+        if self.shape_type is None:
+            self.shape_type = NULL_SHAPE
+        for f, size in ((self._shp, self._shp_size),
+                        (self._shx, _HEADER_SIZE + 8 * self.count)):
+            f.seek(0)
+            f.write(self._header(size))
+            f.close()
+
+        if self.order:
+            self.fields.sort(key=lambda field: self.order(field.name))
+        for field in self.fields:
+            # numbers too long for a numeric column, such as 1e300, are written as text
+            if field.kind in ('N', 'F') and field.width > MAX_TEXT_LENGTH:
+                field.kind = 'C'
+        self._write_dbf()
+        self._spool.close()
+
+        with open(self.path + '.cpg', 'wb') as cpg:
+            cpg.write('UTF-8')
+        if self.prj:
+            with open(self.path + '.prj', 'wb') as prj:
+                prj.write(self.prj)
+
+    def _header(self, size):
+        """Return the header of the .shp or .shx file, of size bytes."""
+        bbox = self.bbox or (0.0, 0.0, 0.0, 0.0)
+        return (struct.pack('>7i', 9994, 0, 0, 0, 0, 0, size // 2) +
+                struct.pack('<2i4d4d', 1000, self.shape_type, *(bbox + (0.0,) * 4)))
+
+    def _encode_geometry(self, geometry):
+        """Return the shape type and the .shp record contents for GeoJSON geometry."""
+        if not geometry:
+            return NULL_SHAPE, struct.pack('<i', NULL_SHAPE)
+
+        try:
+            geom_type = geometry['type']
+            shape_type = SHAPE_TYPES[geom_type]
+            coords = geometry['coordinates']
+        except (KeyError, TypeError):
+            raise ValueError('Feature %d has no usable geometry: %.100s' %
+                             (self.count + 1, json.dumps(geometry)))
+        if self.shape_type is None:
+            self.shape_type = shape_type
+        elif shape_type != self.shape_type:
+            raise ValueError('Feature %d has a %s geometry, which cannot go in a shapefile of %s'
+                             % (self.count + 1, geom_type, _shape_name(self.shape_type)))
+
+        if geom_type == 'Point':
+            x, y = coords[:2]
+            self._extend_bbox((x, y, x, y))
+            return shape_type, struct.pack('<i2d', POINT, x, y)
+
+        if geom_type == 'MultiPoint':
+            parts = [coords]
+        elif geom_type == 'LineString':
+            parts = [coords]
+        elif geom_type == 'MultiLineString':
+            parts = coords
+        elif geom_type == 'Polygon':
+            parts = _orient_rings(coords)
+        else:
+            parts = [ring for polygon in coords for ring in _orient_rings(polygon)]
+
+        xs = [point[0] for part in parts for point in part]
+        ys = [point[1] for part in parts for point in part]
+        if not xs:
+            return NULL_SHAPE, struct.pack('<i', NULL_SHAPE)
+        bbox = (min(xs), min(ys), max(xs), max(ys))
+        self._extend_bbox(bbox)
+        xy = [c for point in zip(xs, ys) for c in point]
+
+        if shape_type == MULTIPOINT:
+            return shape_type, (struct.pack('<i4di', shape_type, bbox[0], bbox[1], bbox[2],
+                                            bbox[3], len(xs)) +
+                                struct.pack('<%dd' % len(xy), *xy))
+
+        starts = []
+        start = 0
+        for part in parts:
+            starts.append(start)
+            start += len(part)
+        return shape_type, (struct.pack('<i4d2i', shape_type, bbox[0], bbox[1], bbox[2],
+                                        bbox[3], len(parts), len(xs)) +
+                            struct.pack('<%di' % len(starts), *starts) +
+                            struct.pack('<%dd' % len(xy), *xy))
+
+    def _extend_bbox(self, bbox):
+        if self.bbox is None:
+            self.bbox = bbox
+        else:
+            self.bbox = (min(self.bbox[0], bbox[0]), min(self.bbox[1], bbox[1]),
+                         max(self.bbox[2], bbox[2]), max(self.bbox[3], bbox[3]))
+
+    def _write_dbf(self):
+        """Write the .dbf file, from the properties kept in the spool file."""
+        record_size = 1 + sum(field.width for field in self.fields)
+        header_size = 32 + 32 * len(self.fields) + 1
+        today = date.today()
+
+        with open(self.path + '.dbf', 'wb') as dbf:
+            dbf.write(struct.pack('<4BI2H20x', 3, today.year - 1900, today.month, today.day,
+                                  self.count, header_size, record_size))
+            for field in self.fields:
+                dbf.write(struct.pack('<11sc4x2B14x', field.dbf_name, field.dbf_type,
+                                      field.width, field.decimals))
+            dbf.write('\r')
+
+            self._spool.seek(0)
+            formats = [(field.name, field.format, field.width) for field in self.fields]
+            for _ in xrange(self.count):
+                props = marshal.load(self._spool)
+                # the first byte of each record is ' ', or '*' for a deleted record
+                dbf.write(' ' + ''.join([format(props.get(name), width)
+                                         for name, format, width in formats]))
+            dbf.write('\x1a')
+
+        for field in self.fields:
+            if field.truncated:
+                logging.warning('Cut %d values of %s short to %d bytes.', field.truncated,
+                                field.name, MAX_TEXT_LENGTH)
+
+
+class _Field(object):
+    """A column of the .dbf file, with the type and width to fit every value given to add."""
+
+    def __init__(self, name, fields):
+        """Arguments:
+        name   -- property name
+        fields -- the columns so far, whose names this column's DBF name must differ from
+        """
+        self.name = name
+        self.dbf_name = _dbf_name(name, [field.dbf_name for field in fields])
+        if self.dbf_name != name:
+            logging.warning('Column %s is named %s in the shapefile.', name, self.dbf_name)
+        # 'N' for whole numbers, 'F' for decimals, 'L' for true/false, 'C' for text; None
+        # until a value that is not null is given
+        self.kind = None
+        # widest value as text, and most digits before and after the decimal point
+        self.text_width = 1
+        self.int_width = 1
+        self.frac_width = 0
+        self.truncated = 0
+
+    def add(self, value):
+        """Widen the column, or change its type, to fit value.
+
+        Returns value as it is to be written: text as UTF-8, and lists and objects as JSON text.
+        """
+        kind = _KINDS.get(type(value))
+        if kind == 'C':
+            if type(value) is unicode:
+                value = value.encode('utf-8')
+            width = len(value)
+        elif kind == 'N':
+            width = len(str(value))
+            self.int_width = max(self.int_width, width)
+        elif kind == 'F':
+            # repr gives the fewest digits that read back as the same number
+            text = repr(value)
+            width = len(text)
+            if not (math.isinf(value) or math.isnan(value)):
+                if 'e' in text:
+                    text = ('%.*f' % (MAX_DECIMALS, value)).rstrip('0')
+                whole, _, frac = text.partition('.')
+                self.int_width = max(self.int_width, len(whole))
+                self.frac_width = min(max(self.frac_width, len(frac)), MAX_DECIMALS)
+        elif kind == 'L':
+            width = len(str(value))
+        elif value is None:
+            return None
+        else:
+            kind = 'C'
+            value = json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+            width = len(value)
+
+        self.text_width = max(self.text_width, width)
+        if kind != self.kind:
+            if self.kind is None:
+                self.kind = kind
+            elif set((self.kind, kind)) == set(('N', 'F')):
+                self.kind = 'F'
+            else:
+                self.kind = 'C'
+        return value
+
+    @property
+    def dbf_type(self):
+        return {'N': 'N', 'F': 'N', 'L': 'L'}.get(self.kind, 'C')
+
+    @property
+    def decimals(self):
+        return self.frac_width if self.kind == 'F' else 0
+
+    @property
+    def width(self):
+        if self.kind == 'N':
+            return self.int_width
+        if self.kind == 'F':
+            return self.int_width + 1 + self.frac_width
+        if self.kind == 'L':
+            return 1
+        return min(self.text_width, MAX_TEXT_LENGTH)
+
+    def format(self, value, width):
+        """Return value as the column's bytes, width of them, in a .dbf record."""
+        if value is None:
+            return ' ' * width
+        if self.kind == 'N':
+            return str(value).rjust(width)
+        if self.kind == 'F':
+            if math.isinf(value) or math.isnan(value):
+                return ' ' * width
+            return '%*.*f' % (width, self.frac_width, value)
+        if self.kind == 'L':
+            return 'T' if value else 'F'
+
+        if isinstance(value, str):
+            text = value
+        else:
+            text = repr(value) if isinstance(value, float) else str(value)
+        if len(text) > width:
+            self.truncated += 1
+            # cut at a character boundary, not part way through one
+            text = text[:width].decode('utf-8', 'ignore').encode('utf-8')
+        return text.ljust(width)
+
+
+def _dbf_name(name, taken):
+    """Return name as a DBF column name: ASCII, at most 10 characters, and not in taken."""
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    dbf_name = name.encode('ascii', 'ignore')
+    dbf_name = dbf_name.replace('\0', '')[:MAX_NAME_LENGTH] or 'field'
+    # DBF names are not case sensitive
+    taken = set(t.upper() for t in taken)
+    num = 0
+    candidate = dbf_name
+    while candidate.upper() in taken:
+        num += 1
+        suffix = '_%d' % num
+        candidate = dbf_name[:MAX_NAME_LENGTH - len(suffix)] + suffix
+    return candidate
+
+
+def _orient_rings(rings):
+    """Return rings of a GeoJSON polygon turned as a shapefile wants them.
+
+    Shapefiles go round the outer ring of a polygon clockwise and its holes counter-clockwise,
+    the opposite way to GeoJSON.
+    """
+    oriented = []
+    for num, ring in enumerate(rings):
+        # twice the area, positive if clockwise
+        area = sum((x2 - x1) * (y2 + y1) for (x1, y1), (x2, y2) in
+                   zip([p[:2] for p in ring], [p[:2] for p in ring[1:]]))
+        if (area < 0) == (num == 0):
+            ring = ring[::-1]
+        oriented.append(ring)
+    return oriented
+
+
+def _shape_name(shape_type):
+    return {NULL_SHAPE: 'nulls', POINT: 'points', POLYLINE: 'lines', POLYGON: 'polygons',
+            MULTIPOINT: 'multipoints'}[shape_type]